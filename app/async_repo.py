@@ -0,0 +1,110 @@
+from .db_models import PatientARTData
+from .repo import PatientARTCRUD, make_patient_etag, make_patient_list_etag
+from typing import List, Optional, Tuple
+from datetime import datetime, date
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from fastapi import HTTPException, status
+
+
+
+# =============================================
+# ASYNC READ OPERATIONS
+# =============================================
+class AsyncPatientARTCRUD:
+    """
+    AsyncSession counterparts of the PatientARTCRUD read methods, used by the
+    async read routes. Writes stay on PatientARTCRUD.
+    """
+    def __init__(self, db_manager: AsyncSession):
+        self.db_manager = db_manager
+
+    # Pure helpers shared with the sync implementation
+    get_art_outcome = PatientARTCRUD.get_art_outcome
+    get_last_modified = PatientARTCRUD.get_last_modified
+
+    def attach_art_status(self, patients: List[PatientARTData]) -> List[PatientARTData]:
+        today = date.today()
+        for patient in patients:
+            patient.clients_current_art_status = self.get_art_outcome(
+                last_pickup_date=patient.last_drug_pick_up_date,
+                days_of_arv_refill=patient.no_of_days_of_refills,
+                ltfu_days=28,
+                end_date=today,
+            )
+        return patients
+
+    async def get_patient_by_identifier(self, patient_identifier: str) -> PatientARTData:
+        """Get a single patient by patient_identifier"""
+        result = await self.db_manager.execute(
+            select(PatientARTData).where(
+                PatientARTData.patient_identifier == patient_identifier,
+                PatientARTData.voided == False
+            )
+        )
+        patient = result.scalars().first()
+        if not patient:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Specified Patient Identifier not found"
+            )
+        return self.attach_art_status([patient])[0]
+
+    async def get_patients(self, skip, limit, *conditions) -> List[PatientARTData]:
+        """Page of non-voided patients ordered by id, optionally filtered"""
+        result = await self.db_manager.execute(
+            select(PatientARTData)
+            .where(PatientARTData.voided == False, *conditions)
+            .order_by(PatientARTData.id)
+            .offset(skip)
+            .limit(limit)
+        )
+        return self.attach_art_status(list(result.scalars().all()))
+
+    async def get_all_patient_identifiers(self, skip, limit):
+        result = await self.db_manager.execute(
+            select(PatientARTData.state, PatientARTData.datim_code, PatientARTData.patient_identifier)
+            .where(PatientARTData.voided == False)
+            .offset(skip)
+            .limit(limit)
+        )
+        return result.all()
+
+    async def get_patient_validators(self, patient_identifier: str) -> Optional[Tuple[str, datetime]]:
+        """
+        (ETag, Last-Modified) for a single patient from a narrow metadata
+        query, so If-None-Match can be answered without loading the record
+        """
+        result = await self.db_manager.execute(
+            select(PatientARTData.version, PatientARTData.updated_at).where(
+                PatientARTData.patient_identifier == patient_identifier,
+                PatientARTData.voided == False
+            )
+        )
+        row = result.first()
+        if row is None:
+            return None
+        reference_date = date.today()
+        return (
+            make_patient_etag(row.version, reference_date),
+            self.get_last_modified([row.updated_at], reference_date),
+        )
+
+    async def get_patient_list_validators(self, skip, limit, *conditions) -> Tuple[str, datetime]:
+        """
+        (ETag, Last-Modified) for a page of patients, computed over the page's
+        ids and versions only; matches the page returned by get_patients
+        """
+        result = await self.db_manager.execute(
+            select(PatientARTData.id, PatientARTData.version, PatientARTData.updated_at)
+            .where(PatientARTData.voided == False, *conditions)
+            .order_by(PatientARTData.id)
+            .offset(skip)
+            .limit(limit)
+        )
+        rows = result.all()
+        reference_date = date.today()
+        return (
+            make_patient_list_etag(rows, reference_date),
+            self.get_last_modified([row.updated_at for row in rows], reference_date),
+        )
@@ -0,0 +1,137 @@
+"""
+Buffered writer for the patient change log.
+Write paths hand over their field-level diffs and return immediately,
+a background thread inserts them in batches on its own connection.
+"""
+
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+from datetime import date, datetime
+from typing import Any, Dict, Iterable, List, Optional
+
+from sqlalchemy import insert
+
+from .db_models import PatientChangeLog
+
+
+CHANGE_LOG_BATCH_SIZE = int(os.getenv("CHANGE_LOG_BATCH_SIZE", 500))
+CHANGE_LOG_FLUSH_SECONDS = float(os.getenv("CHANGE_LOG_FLUSH_SECONDS", 1.0))
+CHANGE_LOG_MAX_RETRIES = 3
+
+
+def _jsonable(value: Any) -> Any:
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+def diff_fields(old: Dict[str, Any], new: Dict[str, Any]) -> Dict[str, List[Any]]:
+    """{field: [old, new]} for every field in new whose value differs from old"""
+    return {
+        field: [_jsonable(old.get(field)), _jsonable(value)]
+        for field, value in new.items()
+        if _jsonable(old.get(field)) != _jsonable(value)
+    }
+
+
+def change_entry(
+        patient_id: int,
+        patient_identifier: str,
+        change_type: str,
+        changes: Dict[str, List[Any]],
+        changed_by: Optional[str] = None,
+        changed_at: Optional[datetime] = None,
+    ) -> Dict[str, Any]:
+    """Row for patient_change_log"""
+    return {
+        "patient_id": patient_id,
+        "patient_identifier": patient_identifier,
+        "change_type": change_type,
+        "changes": json.dumps(changes),
+        "changed_by": changed_by,
+        "changed_at": changed_at or datetime.now(),
+    }
+
+
+class PatientChangeLogWriter:
+    """
+    Queue change log rows and insert them in batches from a daemon thread.
+    A batch is written when it reaches batch_size or flush_interval seconds
+    after its first row, failed batches are retried before being reported.
+    """
+    def __init__(
+            self,
+            batch_size: int = CHANGE_LOG_BATCH_SIZE,
+            flush_interval: float = CHANGE_LOG_FLUSH_SECONDS,
+        ):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: "queue.Queue[Dict[str, Any]]" = queue.Queue()
+        self._engine = None
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._idle = threading.Condition(self._lock)
+
+    def record(self, bind, entries: Iterable[Dict[str, Any]]):
+        """Queue entries for insertion, bind is the engine or connection of the caller's session"""
+        entries = list(entries)
+        if not entries:
+            return
+        with self._lock:
+            if self._engine is None:
+                self._engine = getattr(bind, "engine", bind)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="patient-change-log", daemon=True)
+                self._thread.start()
+            self._pending += len(entries)
+        for entry in entries:
+            self._queue.put(entry)
+
+    def flush(self, timeout: float = 10.0) -> bool:
+        """Wait until every queued entry has been written, False on timeout"""
+        deadline = time.monotonic() + timeout
+        with self._idle:
+            while self._pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._write(batch)
+            with self._idle:
+                self._pending -= len(batch)
+                if not self._pending:
+                    self._idle.notify_all()
+
+    def _write(self, batch: List[Dict[str, Any]]):
+        for attempt in range(1, CHANGE_LOG_MAX_RETRIES + 1):
+            try:
+                with self._engine.begin() as connection:
+                    connection.execute(insert(PatientChangeLog), batch)
+                return
+            except Exception as e:
+                print(f"✗ Error writing {len(batch)} change log entries (attempt {attempt}): {str(e)}")
+                time.sleep(attempt)
+        print(f"✗ Dropped {len(batch)} change log entries")
+
+
+change_log = PatientChangeLogWriter()
+atexit.register(change_log.flush)
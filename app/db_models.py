@@ -3,14 +3,16 @@ Patient ART Data Management System using SQLAlchemy
 Complete CRUD operations with soft delete functionality
 """
 
-from sqlalchemy import create_engine, Column, Integer, String, Date, Text, DateTime, TIMESTAMP, text, LargeBinary
+from sqlalchemy import create_engine, BigInteger, Column, Float, Integer, String, Date, Text, DateTime, TIMESTAMP, text, LargeBinary, Index, UniqueConstraint, inspect, insert, select
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.dialects.mysql import LONGBLOB
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.pool import NullPool
+from sqlalchemy import event, exc
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import NullPool, QueuePool
 from datetime import datetime
 from typing import List, Optional, Dict, Any
-import pymysql, os
+import pymysql, os, ssl, threading, time, weakref
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -64,6 +66,20 @@ class PatientARTData(Base):
     signature = Column(String(255))
     comment = Column(Text)
     suggestion = Column(Text)
+
+    # Numeric lab results derived from the free-text fields on every write,
+    # parse status: numeric, undetectable, below_limit, above_limit, unparsed, missing
+    last_viral_load_value = Column(Float)
+    last_viral_load_parse_status = Column(String(20))
+    cd4_test_cd4_value = Column(Float)
+    cd4_test_parse_status = Column(String(20))
+
+    # Compact reference to facility.id, set from datim_code on every write
+    facility_id = Column(Integer, nullable=True)
+
+    # Search keys: normalize_identifier of hospital_number and patient_identifier
+    hospital_number_key = Column(String(50), nullable=True)
+    patient_identifier_key = Column(String(50), nullable=True)
     
     # Soft Delete Fields
     voided = Column(Integer, default=0)
@@ -73,6 +89,28 @@ class PatientARTData(Base):
     # Timestamps
     created_at = Column(TIMESTAMP, default=datetime.now)
     updated_at = Column(TIMESTAMP, default=datetime.now, onupdate=datetime.now)
+
+    # Optimistic concurrency: bumped by every write, carried in ETag/If-Match
+    version = Column(Integer, nullable=False, default=1, server_default=text("1"))
+
+    # Position in the change feed, taken from change_sequence when the write commits
+    change_seq = Column(BigInteger, nullable=False, default=0, server_default=text("0"))
+
+    # Indexes supporting delta (since watermark) scans
+    __table_args__ = (
+        Index("ix_patient_art_data_updated_at", "updated_at"),
+        Index("ix_patient_art_data_voided_date", "voided_date"),
+        Index("ix_patient_art_data_datim_code", "datim_code"),
+        Index("ix_patient_art_data_change_seq_id", "change_seq", "id"),
+        Index("ix_patient_art_data_facility_id_change_seq", "facility_id", "change_seq", "id"),
+        Index("ix_patient_art_data_facility_id_viral_load", "facility_id", "last_viral_load_value"),
+        Index("ix_patient_art_data_cd4_value", "cd4_test_cd4_value"),
+        Index("ix_patient_art_data_facility_id", "facility_id"),
+        Index("ix_patient_art_data_facility_id_hospital_number_key", "facility_id", "hospital_number_key"),
+        Index("ix_patient_art_data_facility_id_patient_identifier_key", "facility_id", "patient_identifier_key"),
+        # FULLTEXT on MySQL, a plain index elsewhere
+        Index("ft_patient_art_data_residential_address", "residential_address", mysql_prefix="FULLTEXT"),
+    )
     
     def to_dict(self) -> Dict[str, Any]:
         """Convert model instance to dictionary"""
@@ -118,7 +156,8 @@ class PatientARTData(Base):
             'voided_by': self.voided_by,
             'voided_date': self.voided_date,
             'created_at': self.created_at,
-            'updated_at': self.updated_at
+            'updated_at': self.updated_at,
+            'version': self.version
         }
     
 
@@ -130,9 +169,527 @@ class LineListRequest(Base):
     requested_by_id = Column(String(50), nullable=True)
     request_date = Column(TIMESTAMP, nullable=False, default=datetime.now)
     request_status = Column(String(50), default="Processing")
-    file_data = Column(LONGBLOB, nullable=True)
+    file_data = Column(LargeBinary().with_variant(LONGBLOB, "mysql"), nullable=True)
     file_size = Column(Integer, nullable=True)
 
+    # Delta export fields
+    datim_code = Column(String(50), nullable=True)
+    since = Column(DateTime, nullable=True)
+    watermark = Column(DateTime, nullable=True)
+    # patient change_seq committed when the export started, the next delta chains from it
+    watermark_seq = Column(BigInteger, nullable=True)
+
+    # Partitioned export fields
+    state = Column(String(100), nullable=True)
+    partition_by = Column(String(50), nullable=True)
+    file_name = Column(String(255), nullable=True)
+    content_type = Column(String(100), nullable=True)
+    export_format = Column(String(20), nullable=True, default="xlsx")
+
+    # Job progress and timings
+    phase = Column(String(20), nullable=True)
+    rows_processed = Column(Integer, nullable=True)
+    started_at = Column(DateTime, nullable=True)
+    completed_at = Column(DateTime, nullable=True)
+    progress_at = Column(DateTime, nullable=True)
+    peak_memory_kb = Column(Integer, nullable=True)
+    error_detail = Column(Text, nullable=True)
+
+
+
+class BackgroundJob(Base):
+    """Long running maintenance and analytics jobs, with their progress"""
+    __tablename__ = 'background_job'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    job_id = Column(String(255), nullable=False, unique=True)
+    job_type = Column(String(50), nullable=False, index=True)
+    requested_by_id = Column(String(50), nullable=True)
+    job_status = Column(String(50), default="Processing")
+    phase = Column(String(20), nullable=True)
+    parameters = Column(Text, nullable=True)
+    rows_processed = Column(Integer, default=0)
+    total_rows = Column(Integer, nullable=True)
+    result = Column(Text, nullable=True)
+    error_detail = Column(Text, nullable=True)
+    created_at = Column(TIMESTAMP, default=datetime.now)
+    started_at = Column(DateTime, nullable=True)
+    completed_at = Column(DateTime, nullable=True)
+    progress_at = Column(DateTime, nullable=True)
+
+
+class PatientChangeLog(Base):
+    """Append-only field-level history of patient_art_data writes"""
+    __tablename__ = 'patient_change_log'
+
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True)
+    patient_id = Column(Integer, nullable=False)
+    patient_identifier = Column(String(255), nullable=False)
+    # create, import, update, void, restore, delete
+    change_type = Column(String(20), nullable=False)
+    # JSON {field: [old, new]}
+    changes = Column(Text, nullable=False)
+    changed_by = Column(String(255), nullable=True)
+    changed_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index("ix_patient_change_log_identifier_changed_at", "patient_identifier", "changed_at"),
+    )
+
+
+class PatientFacilityMove(Base):
+    """
+    A patient leaving a facility, written in the same transaction as the
+    datim_code change so the old facility's sync can send a tombstone
+    """
+    __tablename__ = 'patient_facility_move'
+
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True)
+    patient_id = Column(Integer, nullable=False)
+    from_datim_code = Column(String(50), nullable=False)
+    to_datim_code = Column(String(50), nullable=False)
+    # change_seq of the write that moved the patient
+    change_seq = Column(BigInteger, nullable=False)
+    moved_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index("ix_patient_facility_move_from_change_seq", "from_datim_code", "change_seq"),
+    )
+
+
+class PatientDeletion(Base):
+    """
+    A hard-deleted patient, written in the deleting transaction under its
+    change_seq so the change feed and facility syncs can send a tombstone
+    """
+    __tablename__ = 'patient_deletion'
+
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True)
+    patient_id = Column(Integer, nullable=False)
+    patient_identifier = Column(String(50), nullable=False)
+    datim_code = Column(String(50), nullable=False)
+    version = Column(Integer, nullable=False)
+    change_seq = Column(BigInteger, nullable=False)
+    deleted_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index("ix_patient_deletion_change_seq_patient_id", "change_seq", "patient_id"),
+        Index("ix_patient_deletion_datim_code_change_seq", "datim_code", "change_seq"),
+    )
+
+
+class ChangeSequence(Base):
+    """
+    Named counters handed out in commit order: a writer increments its row last,
+    just before committing, and holds the row lock until the commit
+    """
+    __tablename__ = 'change_sequence'
+
+    name = Column(String(50), primary_key=True)
+    value = Column(BigInteger, nullable=False, default=0)
+
+
+# Rows of change_sequence created by DatabaseManager.apply_migrations
+CHANGE_SEQUENCES = ["patient"]
+
+
+class IdempotencyKey(Base):
+    """Stored outcome of a POST made with an Idempotency-Key header, replayed on retries"""
+    __tablename__ = 'idempotency_key'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    idempotency_key = Column(String(255), nullable=False)
+    route = Column(String(100), nullable=False)
+    # sha256 of the request body/parameters, a reused key with another request is rejected
+    fingerprint = Column(String(64), nullable=False)
+    # in_progress or completed
+    state = Column(String(20), nullable=False, default="in_progress")
+    status_code = Column(Integer, nullable=True)
+    response = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.now)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+    __table_args__ = (
+        UniqueConstraint("idempotency_key", "route", name="uq_idempotency_key_route"),
+    )
+
+
+class PatientRetentionSummary(Base):
+    """
+    Non-voided patient counts per state, LGA, facility, sex, age band and
+    ART status, with ART status computed against status_date. Maintained
+    incrementally by the write paths and rebuilt by a background job.
+    Missing dimension values are stored as "".
+    """
+    __tablename__ = 'patient_retention_summary'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    state = Column(String(100), nullable=False, default="")
+    lga = Column(String(100), nullable=False, default="")
+    datim_code = Column(String(50), nullable=False, default="")
+    facility_name_all = Column(String(255), nullable=True)
+    sex = Column(String(20), nullable=False, default="")
+    age_band = Column(String(10), nullable=False, default="")
+    art_status = Column(String(30), nullable=False, default="")
+    patient_count = Column(Integer, nullable=False, default=0)
+    status_date = Column(Date, nullable=False)
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+
+    __table_args__ = (
+        UniqueConstraint("datim_code", "state", "lga", "sex", "age_band", "art_status",
+                         name="uq_patient_retention_summary_key"),
+        Index("ix_patient_retention_summary_state", "state"),
+    )
+
+
+class ArtStatusDailySnapshot(Base):
+    """
+    Nightly ART status counts per day and summary dimensions.
+    On MySQL the table is RANGE partitioned by month on snapshot_date,
+    which every unique key therefore starts with.
+    """
+    __tablename__ = 'art_status_daily_snapshot'
+
+    snapshot_date = Column(Date, primary_key=True)
+    datim_code = Column(String(50), primary_key=True, default="")
+    state = Column(String(100), primary_key=True, default="")
+    lga = Column(String(100), primary_key=True, default="")
+    sex = Column(String(20), primary_key=True, default="")
+    age_band = Column(String(10), primary_key=True, default="")
+    art_status = Column(String(30), primary_key=True, default="")
+    patient_count = Column(Integer, nullable=False, default=0)
+
+
+class ArtStatusTransition(Base):
+    """Per-patient ART status changes detected by the nightly snapshot, partitioned like the snapshot"""
+    __tablename__ = 'art_status_transition'
+
+    snapshot_date = Column(Date, primary_key=True)
+    patient_id = Column(Integer, primary_key=True, autoincrement=False)
+    patient_identifier = Column(String(50), nullable=False)
+    datim_code = Column(String(50), nullable=False, default="")
+    # None for a patient seen for the first time, to_status "Removed" once voided or deleted
+    from_status = Column(String(30), nullable=True)
+    to_status = Column(String(30), nullable=False)
+
+    __table_args__ = (
+        Index("ix_art_status_transition_date_datim_code", "snapshot_date", "datim_code"),
+        Index("ix_art_status_transition_patient_id", "patient_id"),
+    )
+
+
+class ArtStatusLatest(Base):
+    """Status of each patient at the last snapshot, compared against to find transitions"""
+    __tablename__ = 'art_status_latest'
+
+    patient_id = Column(Integer, primary_key=True, autoincrement=False)
+    patient_identifier = Column(String(50), nullable=False)
+    datim_code = Column(String(50), nullable=False, default="")
+    art_status = Column(String(30), nullable=False)
+    snapshot_date = Column(Date, nullable=False)
+
+
+class Facility(Base):
+    """Reference list of facilities, patients point at it through facility_id"""
+    __tablename__ = 'facility'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    datim_code = Column(String(50), nullable=False, unique=True)
+    facility_name = Column(String(255), nullable=True)
+    state = Column(String(100), nullable=True)
+    lga = Column(String(100), nullable=True)
+    active = Column(Integer, nullable=False, default=1, server_default=text("1"))
+    created_at = Column(DateTime, default=datetime.now)
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+
+    __table_args__ = (
+        Index("ix_facility_state_lga", "state", "lga"),
+    )
+
+
+class DuplicateCluster(Base):
+    """Group of patient records the duplicate detection job believes are one person"""
+    __tablename__ = 'duplicate_cluster'
+
+    id = Column(Integer, primary_key=True, index=True)
+    # sha1 of the sorted member patient ids, so a reviewed group is not proposed again
+    cluster_key = Column(String(40), nullable=False, unique=True)
+    job_id = Column(String(36), nullable=True)
+    # pending, confirmed or not_duplicate
+    status = Column(String(20), nullable=False, default="pending")
+    member_count = Column(Integer, nullable=False)
+    max_score = Column(Float, nullable=False)
+    reviewed_by = Column(String(255), nullable=True)
+    reviewed_at = Column(DateTime, nullable=True)
+    review_note = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.now)
+
+    __table_args__ = (
+        Index("ix_duplicate_cluster_status", "status"),
+    )
+
+
+class DuplicateClusterMember(Base):
+    """A patient record in a DuplicateCluster, with its best match score inside the cluster"""
+    __tablename__ = 'duplicate_cluster_member'
+
+    id = Column(Integer, primary_key=True, index=True)
+    cluster_id = Column(Integer, nullable=False)
+    patient_id = Column(Integer, nullable=False)
+    patient_identifier = Column(String(50), nullable=False)
+    datim_code = Column(String(50), nullable=True)
+    score = Column(Float, nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint("cluster_id", "patient_id", name="uq_duplicate_cluster_member"),
+        Index("ix_duplicate_cluster_member_patient_id", "patient_id"),
+    )
+
+
+class DataQualityResult(Base):
+    """Violations of one data quality rule at one facility, found by one scan job"""
+    __tablename__ = 'data_quality_result'
+
+    id = Column(Integer, primary_key=True, index=True)
+    job_id = Column(String(36), nullable=False)
+    datim_code = Column(String(50), nullable=False, default="")
+    rule = Column(String(50), nullable=False)
+    patients_checked = Column(Integer, nullable=False)
+    violation_count = Column(Integer, nullable=False)
+    # JSON list of up to DATA_QUALITY_SAMPLE_SIZE patient identifiers
+    sample_identifiers = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.now)
+
+    __table_args__ = (
+        Index("ix_data_quality_result_job_datim_code", "job_id", "datim_code"),
+    )
+
+
+# =============================================
+# SCHEMA MIGRATIONS
+# =============================================
+# create_all only creates missing tables, so columns and indexes added to
+# existing tables are listed here and applied by DatabaseManager.apply_migrations.
+# "fulltext" entries are MySQL only, "drop_index" entries remove an index if present.
+SCHEMA_MIGRATIONS = [
+    ("index", "patient_art_data", "ix_patient_art_data_updated_at",
+     "CREATE INDEX ix_patient_art_data_updated_at ON patient_art_data (updated_at)"),
+    ("index", "patient_art_data", "ix_patient_art_data_voided_date",
+     "CREATE INDEX ix_patient_art_data_voided_date ON patient_art_data (voided_date)"),
+    ("index", "patient_art_data", "ix_patient_art_data_datim_code",
+     "CREATE INDEX ix_patient_art_data_datim_code ON patient_art_data (datim_code)"),
+    ("column", "patient_art_data", "version",
+     "ALTER TABLE patient_art_data ADD COLUMN version INTEGER NOT NULL DEFAULT 1"),
+    ("column", "patient_art_data", "last_viral_load_value",
+     "ALTER TABLE patient_art_data ADD COLUMN last_viral_load_value FLOAT NULL"),
+    ("column", "patient_art_data", "last_viral_load_parse_status",
+     "ALTER TABLE patient_art_data ADD COLUMN last_viral_load_parse_status VARCHAR(20) NULL"),
+    ("column", "patient_art_data", "cd4_test_cd4_value",
+     "ALTER TABLE patient_art_data ADD COLUMN cd4_test_cd4_value FLOAT NULL"),
+    ("column", "patient_art_data", "cd4_test_parse_status",
+     "ALTER TABLE patient_art_data ADD COLUMN cd4_test_parse_status VARCHAR(20) NULL"),
+    ("drop_index", "patient_art_data", "ix_patient_art_data_datim_code_viral_load",
+     "DROP INDEX ix_patient_art_data_datim_code_viral_load ON patient_art_data"),
+    ("index", "patient_art_data", "ix_patient_art_data_cd4_value",
+     "CREATE INDEX ix_patient_art_data_cd4_value ON patient_art_data (cd4_test_cd4_value)"),
+    ("column", "patient_art_data", "facility_id",
+     "ALTER TABLE patient_art_data ADD COLUMN facility_id INTEGER NULL"),
+    ("index", "patient_art_data", "ix_patient_art_data_facility_id",
+     "CREATE INDEX ix_patient_art_data_facility_id ON patient_art_data (facility_id)"),
+    ("column", "patient_art_data", "hospital_number_key",
+     "ALTER TABLE patient_art_data ADD COLUMN hospital_number_key VARCHAR(50) NULL"),
+    ("column", "patient_art_data", "patient_identifier_key",
+     "ALTER TABLE patient_art_data ADD COLUMN patient_identifier_key VARCHAR(50) NULL"),
+    ("drop_index", "patient_art_data", "ix_patient_art_data_datim_code_hospital_number_key",
+     "DROP INDEX ix_patient_art_data_datim_code_hospital_number_key ON patient_art_data"),
+    ("drop_index", "patient_art_data", "ix_patient_art_data_datim_code_patient_identifier_key",
+     "DROP INDEX ix_patient_art_data_datim_code_patient_identifier_key ON patient_art_data"),
+    ("index", "patient_art_data", "ix_patient_art_data_facility_id_viral_load",
+     "CREATE INDEX ix_patient_art_data_facility_id_viral_load ON patient_art_data (facility_id, last_viral_load_value)"),
+    ("index", "patient_art_data", "ix_patient_art_data_facility_id_hospital_number_key",
+     "CREATE INDEX ix_patient_art_data_facility_id_hospital_number_key "
+     "ON patient_art_data (facility_id, hospital_number_key)"),
+    ("index", "patient_art_data", "ix_patient_art_data_facility_id_patient_identifier_key",
+     "CREATE INDEX ix_patient_art_data_facility_id_patient_identifier_key "
+     "ON patient_art_data (facility_id, patient_identifier_key)"),
+    ("column", "patient_art_data", "change_seq",
+     "ALTER TABLE patient_art_data ADD COLUMN change_seq BIGINT NOT NULL DEFAULT 0"),
+    ("index", "patient_art_data", "ix_patient_art_data_change_seq_id",
+     "CREATE INDEX ix_patient_art_data_change_seq_id ON patient_art_data (change_seq, id)"),
+    ("index", "patient_art_data", "ix_patient_art_data_facility_id_change_seq",
+     "CREATE INDEX ix_patient_art_data_facility_id_change_seq ON patient_art_data (facility_id, change_seq, id)"),
+    ("drop_index", "patient_art_data", "ix_patient_art_data_updated_at_id",
+     "DROP INDEX ix_patient_art_data_updated_at_id ON patient_art_data"),
+    ("fulltext", "patient_art_data", "ft_patient_art_data_residential_address",
+     "CREATE FULLTEXT INDEX ft_patient_art_data_residential_address ON patient_art_data (residential_address)"),
+    ("column", "line_list_request", "datim_code",
+     "ALTER TABLE line_list_request ADD COLUMN datim_code VARCHAR(50) NULL"),
+    ("column", "line_list_request", "since",
+     "ALTER TABLE line_list_request ADD COLUMN since DATETIME NULL"),
+    ("column", "line_list_request", "watermark",
+     "ALTER TABLE line_list_request ADD COLUMN watermark DATETIME NULL"),
+    ("column", "line_list_request", "state",
+     "ALTER TABLE line_list_request ADD COLUMN state VARCHAR(100) NULL"),
+    ("column", "line_list_request", "partition_by",
+     "ALTER TABLE line_list_request ADD COLUMN partition_by VARCHAR(50) NULL"),
+    ("column", "line_list_request", "file_name",
+     "ALTER TABLE line_list_request ADD COLUMN file_name VARCHAR(255) NULL"),
+    ("column", "line_list_request", "content_type",
+     "ALTER TABLE line_list_request ADD COLUMN content_type VARCHAR(100) NULL"),
+    ("column", "line_list_request", "export_format",
+     "ALTER TABLE line_list_request ADD COLUMN export_format VARCHAR(20) NULL"),
+    ("column", "line_list_request", "phase",
+     "ALTER TABLE line_list_request ADD COLUMN phase VARCHAR(20) NULL"),
+    ("column", "line_list_request", "rows_processed",
+     "ALTER TABLE line_list_request ADD COLUMN rows_processed INTEGER NULL"),
+    ("column", "line_list_request", "started_at",
+     "ALTER TABLE line_list_request ADD COLUMN started_at DATETIME NULL"),
+    ("column", "line_list_request", "completed_at",
+     "ALTER TABLE line_list_request ADD COLUMN completed_at DATETIME NULL"),
+    ("column", "line_list_request", "progress_at",
+     "ALTER TABLE line_list_request ADD COLUMN progress_at DATETIME NULL"),
+    ("column", "line_list_request", "watermark_seq",
+     "ALTER TABLE line_list_request ADD COLUMN watermark_seq BIGINT NULL"),
+    ("column", "line_list_request", "peak_memory_kb",
+     "ALTER TABLE line_list_request ADD COLUMN peak_memory_kb INTEGER NULL"),
+    ("column", "line_list_request", "error_detail",
+     "ALTER TABLE line_list_request ADD COLUMN error_detail TEXT NULL"),
+]
+
+
+# =============================================
+# CONNECTION POOL
+# =============================================
+# Per process: every uvicorn/gunicorn worker gets its own pool, so keep
+# workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) below MySQL max_connections
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+# Connections checked out longer than this are reported as possibly leaked
+DB_CONNECTION_HELD_WARN_SECONDS = float(os.getenv("DB_CONNECTION_HELD_WARN_SECONDS", 300))
+
+
+class PoolMetrics:
+    """Process-wide counters for pool checkouts, waits and leaked sessions"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.connections_created = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.held_seconds_max = 0.0
+        self.sessions_opened = 0
+        self.sessions_leaked = 0
+        self._checked_out_at: Dict[int, float] = {}
+
+    def record_wait(self, seconds: float, timed_out: bool = False):
+        with self._lock:
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+            if timed_out:
+                self.timeouts += 1
+
+    def record_connect(self):
+        with self._lock:
+            self.connections_created += 1
+
+    def record_checkout(self, connection_id: int):
+        with self._lock:
+            self.checkouts += 1
+            self._checked_out_at[connection_id] = time.monotonic()
+
+    def record_checkin(self, connection_id: int):
+        with self._lock:
+            self.checkins += 1
+            checked_out_at = self._checked_out_at.pop(connection_id, None)
+            if checked_out_at is not None:
+                self.held_seconds_max = max(self.held_seconds_max, time.monotonic() - checked_out_at)
+
+    def record_session_opened(self):
+        with self._lock:
+            self.sessions_opened += 1
+
+    def record_session_finalized(self, state: Dict[str, bool]):
+        """Called when a session is garbage collected, counts it if it was never closed"""
+        if not state["closed"]:
+            with self._lock:
+                self.sessions_leaked += 1
+
+    def snapshot(self, pool) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self._lock:
+            held = [now - t for t in self._checked_out_at.values()]
+            snapshot = {
+                "pool_size": pool.size() if hasattr(pool, "size") else None,
+                "checked_out": pool.checkedout() if hasattr(pool, "checkedout") else None,
+                "overflow": max(pool.overflow(), 0) if hasattr(pool, "overflow") else None,
+                "max_overflow": getattr(pool, "_max_overflow", None),
+                "connections_created": self.connections_created,
+                "checkouts": self.checkouts,
+                "checkins": self.checkins,
+                "timeouts": self.timeouts,
+                "wait_seconds_avg": round(self.wait_seconds_total / self.checkouts, 6) if self.checkouts else 0.0,
+                "wait_seconds_max": round(self.wait_seconds_max, 6),
+                "held_seconds_max": round(self.held_seconds_max, 6),
+                "held_over_warn_threshold": sum(1 for h in held if h > DB_CONNECTION_HELD_WARN_SECONDS),
+                "sessions_opened": self.sessions_opened,
+                "sessions_leaked": self.sessions_leaked,
+            }
+        return snapshot
+
+
+pool_metrics = PoolMetrics()
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records how long callers wait for a connection"""
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            pool_metrics.record_wait(time.perf_counter() - start, timed_out=True)
+            raise
+        pool_metrics.record_wait(time.perf_counter() - start)
+        return connection
+
+
+def _instrument_engine(engine):
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        pool_metrics.record_connect()
+
+    @event.listens_for(engine, "checkout")
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        pool_metrics.record_checkout(id(connection_record))
+
+    @event.listens_for(engine, "checkin")
+    def on_checkin(dbapi_connection, connection_record):
+        pool_metrics.record_checkin(id(connection_record))
+
+
+class TrackedSession(Session):
+    """Session that reports to pool_metrics when it is garbage collected without close()"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._close_state = {"closed": False}
+        pool_metrics.record_session_opened()
+        weakref.finalize(self, pool_metrics.record_session_finalized, self._close_state)
+
+    def close(self):
+        self._close_state["closed"] = True
+        super().close()
+
+
+# One session factory for the process, bound per DatabaseManager engine
+SessionLocal = sessionmaker(
+    class_=TrackedSession,
+    autoflush=False,
+    autocommit=False,
+)
 
 
 # =============================================
@@ -152,13 +709,15 @@ class DatabaseManager:
             future=True, 
             # poolclass=NullPool,
             # connect_args={"ssl": {"ssl-mode": "REQUIRED"}, "connect_timeout": 10}
+            poolclass=InstrumentedQueuePool,
             pool_pre_ping=True,
-            pool_size=100,
-            max_overflow=50,         
-            pool_timeout=30,         
-            pool_recycle=1800,        
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_recycle=DB_POOL_RECYCLE,
             connect_args={"ssl": {"ssl-mode": "REQUIRED"}}
         )
+        _instrument_engine(self.engine)
 
     def create_databse(self):
         server_url = self.database_url.rsplit("/", 1)[0]
@@ -175,17 +734,121 @@ class DatabaseManager:
         
         # 4) Create tables
         Base.metadata.create_all(self.engine)
+
+        # 5) Bring existing tables up to date
+        self.apply_migrations()
         print("DATABASE CREATION IS COMPLETE!!!")
+
+
+    def apply_migrations(self):
+        """Apply the SCHEMA_MIGRATIONS entries that are not yet present"""
+        inspector = inspect(self.engine)
+        with self.engine.begin() as connection:
+            for kind, table_name, name, ddl in SCHEMA_MIGRATIONS:
+                if kind == "fulltext" and self.engine.dialect.name != "mysql":
+                    continue
+                if kind == "column":
+                    existing = {c["name"] for c in inspector.get_columns(table_name)}
+                else:
+                    existing = {i["name"] for i in inspector.get_indexes(table_name)}
+                if (name in existing) != (kind == "drop_index"):
+                    continue
+                if kind == "drop_index" and self.engine.dialect.name != "mysql":
+                    ddl = f"DROP INDEX {name}"
+                connection.execute(text(ddl))
+                print(f"✓ Applied migration: {name} on {table_name}")
+
+            # Sequences are only ever incremented, so their rows must exist up front
+            for name in CHANGE_SEQUENCES:
+                exists = connection.execute(
+                    select(ChangeSequence.name).where(ChangeSequence.name == name)
+                ).first()
+                if exists is None:
+                    connection.execute(insert(ChangeSequence).values(name=name, value=0))
         
 
     def get_session(self):
-        """Get a new database session"""
-        self.Session = sessionmaker(
-            bind=self.engine,
-            autoflush=False,
-            autocommit=False,
+        """Get a new database session, the caller must close it"""
+        return SessionLocal(bind=self.engine)
+
+    def get_db(self):
+        """
+        FastAPI dependency: one session per request, rolled back if the
+        request fails and always closed so its connection returns to the pool
+        """
+        session = self.get_session()
+        try:
+            yield session
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def get_pool_metrics(self) -> Dict[str, Any]:
+        return pool_metrics.snapshot(self.engine.pool)
+
+
+# =============================================
+# ASYNC DATABASE CONNECTION SETUP
+# =============================================
+# Sync driver -> async driver used for the same database
+ASYNC_DRIVERS = {
+    "mysql+pymysql": "mysql+aiomysql",
+    "mysql": "mysql+aiomysql",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+AsyncSessionLocal = async_sessionmaker(
+    autoflush=False,
+    expire_on_commit=False,
+)
+
+
+def get_async_database_url(database_url: str) -> str:
+    """ASYNC_DATABASE_URL, or DATABASE_URL with its driver swapped for the async one"""
+    if os.getenv("ASYNC_DATABASE_URL"):
+        return os.getenv("ASYNC_DATABASE_URL")
+    scheme, rest = database_url.split("://", 1)
+    return f"{ASYNC_DRIVERS.get(scheme, scheme)}://{rest}"
+
+
+class AsyncDatabaseManager:
+    """
+    AsyncSession access for the async read routes. Connections wait on the
+    event loop instead of holding a threadpool thread; the pool is separate
+    from the sync engine's and sized by the same DB_POOL_* settings.
+    """
+    def __init__(self, database_url: str = os.getenv("DATABASE_URL")):
+        self.database_url = get_async_database_url(database_url)
+        connect_args = {}
+        if self.database_url.startswith("mysql"):
+            # Same as ssl-mode REQUIRED: encrypted, server certificate not verified
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            connect_args["ssl"] = context
+        self.engine = create_async_engine(
+            self.database_url,
+            echo=False,
+            pool_pre_ping=True,
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_recycle=DB_POOL_RECYCLE,
+            connect_args=connect_args,
         )
-        return self.Session()
+
+    async def get_db(self):
+        """FastAPI dependency: one AsyncSession per request, always closed"""
+        session = AsyncSessionLocal(bind=self.engine)
+        try:
+            yield session
+        except Exception:
+            await session.rollback()
+            raise
+        finally:
+            await session.close()
 
 
 if __name__ == "__main__":
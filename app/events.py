@@ -0,0 +1,75 @@
+"""
+In-process publish/subscribe for line list export events.
+Export workers publish progress from background threads and
+Server-Sent Events subscribers receive them on the event loop.
+"""
+
+import asyncio
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+
+# Request statuses after which no further events are published
+TERMINAL_STATUSES = ("Completed", "Failed")
+
+
+class ExportEventBroker:
+    """
+    Fan out export events to the asyncio queues subscribed to a request id.
+    Events only reach subscribers in the same process as the export worker,
+    the latest event per request is kept so late subscribers start from it.
+    """
+    def __init__(self, max_latest: int = 1000):
+        self._lock = threading.Lock()
+        self._subscribers: Dict[str, Set[Tuple[asyncio.AbstractEventLoop, asyncio.Queue]]] = {}
+        self._latest: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._max_latest = max_latest
+
+    def publish(self, request_id: str, event: Dict[str, Any]):
+        """Thread-safe: deliver an event to every subscriber of request_id"""
+        event = {"request_id": request_id, **event}
+        with self._lock:
+            self._latest[request_id] = event
+            self._latest.move_to_end(request_id)
+            while len(self._latest) > self._max_latest:
+                self._latest.popitem(last=False)
+            subscribers = list(self._subscribers.get(request_id, ()))
+
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, event)
+            except RuntimeError:
+                # Subscriber's loop already closed
+                pass
+
+    def subscribe(self, request_ids: Iterable[str]) -> asyncio.Queue:
+        """Register a queue for request_ids, must be called from the event loop"""
+        queue: asyncio.Queue = asyncio.Queue()
+        subscriber = (asyncio.get_running_loop(), queue)
+        with self._lock:
+            for request_id in request_ids:
+                self._subscribers.setdefault(request_id, set()).add(subscriber)
+        return queue
+
+    def unsubscribe(self, request_ids: Iterable[str], queue: asyncio.Queue):
+        with self._lock:
+            for request_id in request_ids:
+                subscribers = self._subscribers.get(request_id)
+                if not subscribers:
+                    continue
+                subscribers.difference_update({s for s in subscribers if s[1] is queue})
+                if not subscribers:
+                    del self._subscribers[request_id]
+
+    def latest(self, request_ids: Iterable[str]) -> List[Dict[str, Any]]:
+        """Most recent event published for each request id, where one exists"""
+        with self._lock:
+            return [self._latest[r] for r in request_ids if r in self._latest]
+
+    def get_latest(self, request_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._latest.get(request_id)
+
+
+export_events = ExportEventBroker()
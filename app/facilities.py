@@ -0,0 +1,118 @@
+"""
+In-memory facility registry.
+The facility reference table is small and read on every patient write, so
+each worker process keeps it as a dict keyed by datim_code, loaded at
+startup, reloaded after FACILITY_CACHE_TTL_SECONDS and on refresh.
+datim_code validation is off until FACILITY_VALIDATION is set, which should
+be done once POST /facilities/backfill has registered the existing codes.
+"""
+
+import os
+import threading
+import time
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from .db_models import Facility
+
+
+FACILITY_CACHE_TTL_SECONDS = float(os.getenv("FACILITY_CACHE_TTL_SECONDS", 300))
+FACILITY_VALIDATION = os.getenv("FACILITY_VALIDATION", "false").lower() in ("1", "true", "yes", "on")
+
+
+class FacilityEntry(NamedTuple):
+    id: int
+    datim_code: str
+    facility_name: Optional[str]
+    state: Optional[str]
+    lga: Optional[str]
+
+
+class FacilityRegistry:
+    """
+    datim_code -> FacilityEntry. Lookups are plain dict reads; a reload
+    builds new dicts and swaps them in, so readers never see a partial one.
+    Validation is only enforced when enforce is set and the reference table
+    has facilities.
+    """
+    def __init__(self, ttl: float = FACILITY_CACHE_TTL_SECONDS, enforce: bool = FACILITY_VALIDATION):
+        self.ttl = ttl
+        self.enforce = enforce
+        self._by_code: Dict[str, FacilityEntry] = {}
+        self._by_id: Dict[int, FacilityEntry] = {}
+        # Codes looked up and not found since the last load
+        self._unknown: Set[str] = set()
+        self._loaded_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def _query(self):
+        return (
+            select(Facility.id, Facility.datim_code, Facility.facility_name, Facility.state, Facility.lga)
+            .where(Facility.active == 1)
+        )
+
+    def load(self, session: Session) -> int:
+        """(Re)load every active facility, returns the number loaded"""
+        rows = session.execute(self._query()).all()
+        with self._lock:
+            self._by_code = {row.datim_code: FacilityEntry(*row) for row in rows}
+            self._by_id = {entry.id: entry for entry in self._by_code.values()}
+            self._unknown = set()
+            self._loaded_at = time.monotonic()
+        return len(rows)
+
+    def ensure_loaded(self, session: Session):
+        """Load on first use and once the cached copy is older than ttl"""
+        if self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl:
+            self.load(session)
+
+    def ensure_known(self, session: Session, datim_codes: Iterable[Optional[str]]):
+        """
+        ensure_loaded, then look up codes missing from the cache, so a write
+        picks up a facility registered by another worker since this one last
+        loaded. Codes not found are not looked up again until the next load,
+        at most ttl later; facility_condition still finds the NULL facility_id
+        rows written meanwhile by datim_code.
+        """
+        self.ensure_loaded(session)
+        missing = {
+            code for code in datim_codes
+            if code and code not in self._by_code and code not in self._unknown
+        }
+        if not missing:
+            return
+        rows = session.execute(self._query().where(Facility.datim_code.in_(missing))).all()
+        with self._lock:
+            if rows:
+                by_code = {**self._by_code, **{row.datim_code: FacilityEntry(*row) for row in rows}}
+                self._by_code = by_code
+                self._by_id = {entry.id: entry for entry in by_code.values()}
+            self._unknown = self._unknown | (missing - {row.datim_code for row in rows})
+
+    @property
+    def enforced(self) -> bool:
+        return self.enforce and bool(self._by_code)
+
+    def get(self, datim_code: Optional[str]) -> Optional[FacilityEntry]:
+        return self._by_code.get(datim_code) if datim_code else None
+
+    def get_by_id(self, facility_id: Optional[int]) -> Optional[FacilityEntry]:
+        return self._by_id.get(facility_id) if facility_id is not None else None
+
+    def get_id(self, datim_code: Optional[str]) -> Optional[int]:
+        entry = self.get(datim_code)
+        return entry.id if entry else None
+
+    def is_valid(self, datim_code: Optional[str]) -> bool:
+        return not self.enforced or datim_code in self._by_code
+
+    def ids_by_code(self) -> Dict[str, int]:
+        return {code: entry.id for code, entry in self._by_code.items()}
+
+    def all(self) -> List[FacilityEntry]:
+        return sorted(self._by_code.values(), key=lambda entry: entry.datim_code)
+
+
+facility_registry = FacilityRegistry()
@@ -0,0 +1,118 @@
+"""
+Scheduled maintenance jobs, run from cron outside the API process.
+Each run is recorded as a BackgroundJob, visible at GET /patient_data/jobs/job_id.
+
+Usage:
+    python -m app.jobs snapshot [--date YYYY-MM-DD]   # daily ART status snapshot
+    python -m app.jobs summary [--date YYYY-MM-DD]    # retention summary rebuild
+    python -m app.jobs nightly [--date YYYY-MM-DD]    # both, snapshot first
+
+Example crontab entry:
+    15 0 * * * cd /srv/app && python -m app.jobs nightly
+"""
+
+import argparse
+import sys
+from datetime import date
+from typing import Any, Callable, Dict, Optional
+
+from .db_models import DatabaseManager
+from .repo import PatientARTCRUD, BackgroundJobTracker
+
+
+def run_job(
+        db_session_factory,
+        job_id: str,
+        job_type: str,
+        phase: str,
+        work: Callable[[PatientARTCRUD, BackgroundJobTracker], Dict[str, Any]],
+    ) -> Optional[Dict[str, Any]]:
+    """
+    Run work(patient_manager, tracker) for an existing BackgroundJob on a
+    session of its own, recording start, completion or failure.
+    work returns the job result, whose "patients" count is stored as rows
+    processed. Returns the result, None on failure.
+    """
+    db = db_session_factory()
+    tracker = BackgroundJobTracker(db_session_factory, job_id)
+    try:
+        tracker.start(phase)
+        result = work(PatientARTCRUD(db_manager=db), tracker)
+        tracker.rows_processed = result["patients"]
+        tracker.complete(result)
+        print(f"✓ {job_type} {job_id}: {result}")
+        return result
+    except Exception as e:
+        print(f"✗ {job_type} {job_id} failed: {str(e)}")
+        tracker.fail(e)
+        return None
+    finally:
+        db.close()
+
+
+def run_tracked_job(
+        db_manager: DatabaseManager,
+        job_type: str,
+        parameters: Dict[str, Any],
+        phase: str,
+        work: Callable[[PatientARTCRUD, BackgroundJobTracker], Dict[str, Any]],
+    ) -> Optional[Dict[str, Any]]:
+    """Record a new BackgroundJob and run it now with run_job, None on failure"""
+    db = db_manager.get_session()
+    try:
+        job_id = PatientARTCRUD(db_manager=db).create_background_job(
+            job_type=job_type,
+            parameters=parameters,
+            requested_by="SCHEDULER",
+        ).job_id
+    finally:
+        db.close()
+    return run_job(db_manager.get_session, job_id, job_type, phase, work)
+
+
+def run_snapshot(db_manager: DatabaseManager, snapshot_date: Optional[date]) -> Optional[Dict[str, Any]]:
+    return run_tracked_job(
+        db_manager,
+        job_type="art_status_snapshot",
+        parameters={"snapshot_date": snapshot_date},
+        phase="snapshotting",
+        work=lambda patient_manager, tracker: patient_manager.take_art_status_snapshot(
+            snapshot_date=snapshot_date,
+            progress_callback=tracker.update,
+        ),
+    )
+
+
+def run_summary_rebuild(db_manager: DatabaseManager, status_date: Optional[date]) -> Optional[Dict[str, Any]]:
+    return run_tracked_job(
+        db_manager,
+        job_type="retention_summary_rebuild",
+        parameters={"status_date": status_date},
+        phase="aggregating",
+        work=lambda patient_manager, tracker: patient_manager.rebuild_retention_summary(
+            status_date=status_date,
+            progress_callback=tracker.update,
+        ),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run scheduled patient data jobs")
+    parser.add_argument("job", choices=["snapshot", "summary", "nightly"])
+    parser.add_argument("--date", type=date.fromisoformat, default=None,
+                        help="Status date, default today")
+    args = parser.parse_args()
+
+    db_manager = DatabaseManager()
+    db_manager.create_databse()
+
+    results = []
+    if args.job in ("snapshot", "nightly"):
+        results.append(run_snapshot(db_manager, args.date))
+    if args.job in ("summary", "nightly"):
+        results.append(run_summary_rebuild(db_manager, args.date))
+    sys.exit(0 if all(r is not None for r in results) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,37 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
-from .routes import router as patient_art_router
+from .routes import router as patient_art_router, db_manager
+from .facilities import facility_registry
 
 
 # ============================================
 # FASTAPI APPLICATION
 # ============================================
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Fill the facility lookup cache before the first request"""
+    db = db_manager.get_session()
+    try:
+        print(f"✓ Facility registry loaded: {facility_registry.load(db)} facilities")
+    except Exception as e:
+        # Loaded lazily on first use instead, e.g. before the facility table exists
+        print(f"✗ Error loading facility registry: {str(e)}")
+    finally:
+        db.close()
+    yield
+
+
 app = FastAPI(
     title="Patient ART Management System",
     description="This is for the management of patient data",
     version="1.0.0",
     docs_url="/docs",
     redoc_url="/redoc",
-    openapi_url="/openapi.json"
+    openapi_url="/openapi.json",
+    lifespan=lifespan,
 )
 
 
@@ -45,6 +62,11 @@ async def root():
         "status": "operational"
     }
 
+@app.get("/metrics/db-pool", tags=["Root"])
+def db_pool_metrics():
+    """Connection pool usage of this worker process"""
+    return db_manager.get_pool_metrics()
+
 app.include_router(patient_art_router, prefix="/app/v1", tags=["Patient Art Data Management"])
 
 
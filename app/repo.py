@@ -1,24 +1,526 @@
-from .db_models import PatientARTData, LineListRequest
-from typing import Any, Dict, Optional, List
+from .db_models import (
+    PatientARTData, LineListRequest, BackgroundJob, PatientChangeLog, IdempotencyKey,
+    PatientRetentionSummary, ArtStatusDailySnapshot, ArtStatusTransition, ArtStatusLatest,
+    DuplicateCluster, DuplicateClusterMember, DataQualityResult, Facility, ChangeSequence,
+    PatientFacilityMove, PatientDeletion,
+)
+from typing import Any, BinaryIO, Callable, Dict, Iterator, Optional, List, Tuple
 from datetime import datetime, date, timedelta
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, defer
+from sqlalchemy.exc import IntegrityError
 from fastapi import UploadFile, HTTPException, status
-from io import BytesIO
+from io import BytesIO, TextIOWrapper
+import numpy as np
 import pandas as pd
-from .schemas import PatientARTCreate, LineListRequestResponse
-from sqlalchemy import delete
+from .schemas import PatientARTCreate, LineListRequestResponse, BackgroundJobResponse
+from .events import export_events
+from .audit import change_log, change_entry, diff_fields
+from .facilities import facility_registry
+from sqlalchemy import Date, DateTime, Float, and_, bindparam, case, delete, func, insert, literal, or_, select, text, type_coerce, union_all, update
+from sqlalchemy.dialects.mysql import insert as mysql_insert, match as mysql_match
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from openpyxl.styles import Border, Side
 from openpyxl.styles import Border, Side, Alignment
 from openpyxl import load_workbook
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from collections import Counter, OrderedDict
+from difflib import SequenceMatcher
+from itertools import islice
+import base64, gzip, hashlib, json, multiprocessing, os, re, sys, threading, time, uuid, zipfile, zlib
 
 
 
+# Line list columns / headers in export order
+LINE_LIST_COLUMNS = [
+    "state",
+    "lga",
+    "facility_name_all",
+    "datim_code",
+    "sex",
+    "hospital_number",
+    "patient_identifier",
+    "current_age",
+    "date_of_birth",
+    "care_entry_point",
+    "art_start_date",
+    "age_at_art_initiation",
+    "clients_current_art_status",
+    "educational_status",
+    "residential_address",
+    "last_drug_pick_up_date",
+    "last_viral_load_result",
+    "cd4_test_cd4_result",
+    "adherence_outcome_classification",
+    "marital_status",
+    "employment_status",
+    "no_of_days_of_refills",
+    "who_stage_at_art_start",
+    "last_drug_art_pick_up_date",
+    "duration_on_art_months",
+    "previous_art_regimen",
+    "current_art_regimen",
+    "current_art_regimen_line",
+    "last_viral_load_sample_collection_date",
+    "last_viral_load_result_date",
+    "cd4_test_sample_collection_date",
+    "cd4_test_result_date",
+    "date",
+    "signature",
+    "comment",
+    "suggestion",
+]
+
+LINE_LIST_INTEGER_COLUMNS = [
+    "current_age",
+    "age_at_art_initiation",
+    "no_of_days_of_refills",
+    "duration_on_art_months",
+]
+
+LINE_LIST_DATE_COLUMNS = [
+    "date_of_birth",
+    "art_start_date",
+    "last_drug_pick_up_date",
+    "last_drug_art_pick_up_date",
+    "last_viral_load_sample_collection_date",
+    "last_viral_load_result_date",
+    "cd4_test_sample_collection_date",
+    "cd4_test_result_date",
+]
+
+CHANGE_FEED_MAX_LIMIT = 5000
+
+# How long a stored Idempotency-Key response is replayed, and how often expired keys are purged
+IDEMPOTENCY_KEY_TTL_HOURS = float(os.getenv("IDEMPOTENCY_KEY_TTL_HOURS", 24))
+IDEMPOTENCY_PURGE_INTERVAL_SECONDS = 600
+# An in_progress key older than this belongs to a worker that died, a retry may reclaim it
+IDEMPOTENCY_IN_PROGRESS_LEASE_MINUTES = float(os.getenv("IDEMPOTENCY_IN_PROGRESS_LEASE_MINUTES", 5))
+_last_idempotency_purge = 0.0
+
+# Free-text lab result column -> (numeric value column, parse status column),
+# derived on every write by apply_derived_fields
+LAB_RESULT_FIELDS = {
+    "last_viral_load_result": ("last_viral_load_value", "last_viral_load_parse_status"),
+    "cd4_test_cd4_result": ("cd4_test_cd4_value", "cd4_test_parse_status"),
+}
+LAB_DERIVED_COLUMNS = [column for columns in LAB_RESULT_FIELDS.values() for column in columns]
+# Columns set by apply_derived_fields from the columns they are derived from
+# Search key column -> column it normalizes
+SEARCH_KEY_FIELDS = {
+    "hospital_number_key": "hospital_number",
+    "patient_identifier_key": "patient_identifier",
+}
+DERIVED_COLUMNS = LAB_DERIVED_COLUMNS + ["facility_id"] + list(SEARCH_KEY_FIELDS)
+DERIVED_SOURCE_COLUMNS = list(LAB_RESULT_FIELDS) + ["datim_code"] + list(SEARCH_KEY_FIELDS.values())
+SEARCH_BACKFILL_BATCH_SIZE = int(os.getenv("SEARCH_BACKFILL_BATCH_SIZE", 5000))
+SEARCH_MAX_LIMIT = 100
+# Rank of each kind of search match, address matches add the MySQL relevance score
+SEARCH_RANKS = {
+    "patient_identifier": 100,
+    "hospital_number": 90,
+    "patient_identifier_prefix": 70,
+    "hospital_number_prefix": 60,
+    "residential_address": 20,
+}
+FACILITY_BACKFILL_BATCH_SIZE = int(os.getenv("FACILITY_BACKFILL_BATCH_SIZE", 5000))
+LAB_BACKFILL_BATCH_SIZE = int(os.getenv("LAB_BACKFILL_BATCH_SIZE", 5000))
+
+# Viral load analytics: copies/ml below which a result counts as suppressed,
+# days on ART before a first result is due, and age after which a result is overdue
+VL_SUPPRESSION_THRESHOLD = float(os.getenv("VL_SUPPRESSION_THRESHOLD", 1000))
+VL_FIRST_DUE_DAYS = 180
+VL_OVERDUE_DAYS = 365
+
+# Columns whose changes are written to the change log
+AUDITED_COLUMNS = [
+    c.name for c in PatientARTData.__table__.columns
+    if c.name not in ("id", "created_at", "updated_at", "version", "change_seq") and c.name not in DERIVED_COLUMNS
+]
+
+# Retention summary: age bands as (label, lowest age), dimensions of a summary
+# row, and the patient columns those dimensions are computed from
+AGE_BANDS = [
+    ("<1", 0), ("1-4", 1), ("5-9", 5), ("10-14", 10), ("15-19", 15), ("20-24", 20),
+    ("25-29", 25), ("30-34", 30), ("35-39", 35), ("40-44", 40), ("45-49", 45), ("50+", 50),
+]
+SUMMARY_DIMENSIONS = ("state", "lga", "datim_code", "sex", "age_band", "art_status")
+SUMMARY_SOURCE_COLUMNS = [
+    "state", "lga", "datim_code", "facility_name_all", "sex",
+    "current_age", "last_drug_pick_up_date", "no_of_days_of_refills",
+]
+SUMMARY_REBUILD_BATCH_SIZE = int(os.getenv("SUMMARY_REBUILD_BATCH_SIZE", 50000))
+
+# Nightly ART status snapshot: rows read per batch, and the MySQL tables
+# RANGE partitioned by month with partitions created this many months ahead
+SNAPSHOT_BATCH_SIZE = int(os.getenv("SNAPSHOT_BATCH_SIZE", 50000))
+SNAPSHOT_PARTITIONED_TABLES = ("art_status_daily_snapshot", "art_status_transition")
+SNAPSHOT_PARTITION_MONTHS_AHEAD = 2
+
+# Retention cohorts: months after ART start at which retention is reported,
+# and how long computed cohorts are reused for the same filters and as-of date
+COHORT_MILESTONE_MONTHS = (3, 6, 12, 24)
+COHORT_SOURCE_COLUMNS = ["art_start_date", "last_drug_pick_up_date", "no_of_days_of_refills"]
+COHORT_CACHE_TTL_SECONDS = float(os.getenv("COHORT_CACHE_TTL_SECONDS", 600))
+COHORT_CACHE_MAX_ENTRIES = 256
+
+# Duplicate detection: columns compared, weight of each field in a pair score,
+# minimum score of a candidate pair; blocks above the size cap are skipped
+# (a hospital number like "1" shared by every facility), blocks per worker task
+DUPLICATE_SOURCE_COLUMNS = [
+    "patient_identifier", "datim_code", "facility_id", "sex", "date_of_birth", "art_start_date",
+    "hospital_number", "hospital_number_key", "residential_address", "current_art_regimen", "age_at_art_initiation",
+]
+DUPLICATE_FIELD_WEIGHTS = (
+    ("date_of_birth", 3), ("art_start_date", 2), ("age_at_art_initiation", 1),
+    ("hospital_number", 2), ("residential_address", 2), ("current_art_regimen", 1),
+)
+# Blocking keys -> fields a pair in that block agrees on by construction (or
+# that follow from them), left out of the pair's score
+DUPLICATE_BLOCK_FIELDS = {
+    "demographic": ("date_of_birth", "art_start_date", "age_at_art_initiation"),
+    "hospital_number": ("hospital_number",),
+}
+# Pairs sharing less than this much weight of present, scored fields are not scored
+DUPLICATE_MIN_COMPARED_WEIGHT = 3
+DUPLICATE_MATCH_THRESHOLD = float(os.getenv("DUPLICATE_MATCH_THRESHOLD", 0.85))
+DUPLICATE_MAX_BLOCK_SIZE = int(os.getenv("DUPLICATE_MAX_BLOCK_SIZE", 200))
+DUPLICATE_BLOCKS_PER_TASK = 5000
+DUPLICATE_CLUSTER_STATUSES = ("pending", "confirmed", "not_duplicate")
+
+# Data quality scan: rule -> description, rows read per batch, patient
+# identifiers kept per facility and rule, and the valid DATIM org unit format
+DATA_QUALITY_RULES = {
+    "age_dob_mismatch": "current_age differs from the age computed from date_of_birth by more than a year",
+    "art_initiation_age_mismatch": "age_at_art_initiation differs from the age at art_start_date by more than a year",
+    "art_start_before_birth": "art_start_date is before date_of_birth",
+    "future_pickup_date": "last_drug_pick_up_date or last_drug_art_pick_up_date is after the scan date",
+    "refill_days_out_of_range": "no_of_days_of_refills is outside 0-180",
+    "invalid_datim_code": "datim_code is not an 11 character DATIM org unit id",
+    "date_out_of_range": "a date is before 1900 or more than a year after the scan date (e.g. a typo'd year)",
+}
+DATA_QUALITY_DATE_COLUMNS = ["date_of_birth", "art_start_date", "last_drug_pick_up_date", "last_drug_art_pick_up_date"]
+DATA_QUALITY_MIN_DATE = date(1900, 1, 1)
+DATA_QUALITY_SOURCE_COLUMNS = [
+    "patient_identifier", "datim_code", "current_age", "date_of_birth", "art_start_date",
+    "age_at_art_initiation", "last_drug_pick_up_date", "last_drug_art_pick_up_date", "no_of_days_of_refills",
+]
+DATA_QUALITY_BATCH_SIZE = int(os.getenv("DATA_QUALITY_BATCH_SIZE", 20000))
+DATA_QUALITY_SAMPLE_SIZE = 10
+DATIM_CODE_PATTERN = r"^[A-Za-z][A-Za-z0-9]{10}$"
+
+# Offline facility sync: patient columns sent to devices (voided rows become
+# tombstones, search keys stay on the server), rows read per batch, and the
+# bundle formats -> media type
+SYNC_COLUMNS = [
+    c.name for c in PatientARTData.__table__.columns
+    if c.name not in ("voided", "voided_by", "voided_date") and c.name not in SEARCH_KEY_FIELDS
+]
+SYNC_BATCH_SIZE = int(os.getenv("SYNC_BATCH_SIZE", 2000))
+SYNC_MAX_EDITS = 5000
+# Upload body limits, before and after gzip decompression
+SYNC_MAX_UPLOAD_BYTES = int(os.getenv("SYNC_MAX_UPLOAD_BYTES", 16 * 1024 * 1024))
+SYNC_MAX_DECOMPRESSED_BYTES = int(os.getenv("SYNC_MAX_DECOMPRESSED_BYTES", 64 * 1024 * 1024))
+SYNC_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "msgpack": "application/x-msgpack",
+}
+
+# Export format -> (file extension, media type)
+EXPORT_FORMATS = {
+    "xlsx": ("xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "csv": ("csv", "text/csv"),
+    "csv.gz": ("csv.gz", "application/gzip"),
+    "parquet": ("parquet", "application/vnd.apache.parquet"),
+}
+ZIP_MEDIA_TYPE = "application/zip"
+
+# Excel sheets hold 1,048,576 rows including the header
+XLSX_MAX_ROWS = 1_048_575
+
+# Rows fetched from the database per export batch
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", 5000))
+
+# Identifiers per IN (...) lookup in bulk operations
+BULK_IN_CHUNK_SIZE = 1000
+
+# Chunked deletion defaults for drop_all_patients
+DELETE_CHUNK_SIZE = int(os.getenv("PATIENT_DELETE_CHUNK_SIZE", 1000))
+DELETE_PAUSE_SECONDS = float(os.getenv("PATIENT_DELETE_PAUSE_SECONDS", 0.1))
+
+# Values returned by PatientARTCRUD.get_art_outcome
+ART_STATUSES = ["Active", "Inactive", "No last pickup date"]
+
+# Columns a line list export can be partitioned by
+PARTITION_COLUMNS = ("datim_code", "lga")
+
+
+# =============================================
+# ETAGS
+# =============================================
+def make_patient_etag(version: int, reference_date: Optional[date] = None) -> str:
+    """
+    Strong ETag for a patient representation: the row version plus the date
+    clients_current_art_status was computed against, since that changes daily
+    """
+    reference_date = reference_date or date.today()
+    return f'"{version}-{reference_date:%Y%m%d}"'
+
+
+def make_patient_list_etag(rows, reference_date: date) -> str:
+    """Strong ETag for a page of patients from its (id, version) rows"""
+    digest = hashlib.sha1(f"{reference_date:%Y%m%d}".encode())
+    for row in rows:
+        digest.update(f";{row.id}:{row.version}".encode())
+    return f'"{digest.hexdigest()}"'
+
+
+def parse_etag_version(etag: Optional[str]) -> Optional[int]:
+    """
+    Version carried by an If-Match header, None when absent or "*".
+    Raises ValueError for a header that is not one of our ETags.
+    """
+    if etag is None:
+        return None
+    etag = etag.strip()
+    if etag in ("", "*"):
+        return None
+    if etag.startswith("W/"):
+        etag = etag[2:]
+    return int(etag.strip('"').split("-", 1)[0])
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak comparison of an If-None-Match header against an ETag"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [c.strip() for c in if_none_match.split(",")]
+    return any((c[2:] if c.startswith("W/") else c) == etag for c in candidates)
+
+
+_UNDETECTABLE_RESULTS = {
+    "undetectable", "undetected", "not detected", "target not detected", "tnd",
+    "ldl", "<ldl", "below detection limit", "below detectable limit",
+}
+# Optional limit sign, the number, then at most one known unit
+_LAB_RESULT = re.compile(
+    r"^(?P<sign>[<>]=?)?\s*(?P<number>[\d.,^*x+\-e ]+?)\s*"
+    r"(?P<unit>copies/ml|copies|cp/ml|c/ml|cells/mm3|cells/ul|cells/µl|/mm3|/ul)?$"
+)
+# "1.2e3", "1.2 x 10^3", "1.2*10^3"
+_EXPONENT = re.compile(r"^(\d+(?:\.\d+)?)\s*(?:e|x\s*10\^|\*\s*10\^)\s*([+-]?\d+)$")
+_INTEGER = re.compile(r"^\d+$")
+# "1,200" / "1,200.5" and "1 200" / "1 200.5": thousands groups with an optional decimal part
+_COMMA_GROUPED = re.compile(r"^\d{1,3}(?:,\d{3})+(?:\.\d+)?$")
+_SPACE_GROUPED = re.compile(r"^\d{1,3}(?: \d{3})+(?:\.\d+)?$")
+# "1.200.000" / "1.200,5": dot thousands, only when more than one group or a decimal comma follows
+_DOT_GROUPED = re.compile(r"^\d{1,3}(?:\.\d{3}){2,}(?:,\d+)?$|^\d{1,3}(?:\.\d{3})+,\d+$")
+# A single decimal point or comma before one or two digits, three or more could be thousands
+_DECIMAL = re.compile(r"^\d+[.,]\d{1,2}$")
+
+
+def _parse_lab_number(number: str) -> Optional[float]:
+    """Value of a lab result number, None when it is not one unambiguous number"""
+    exponent = _EXPONENT.match(number)
+    if exponent:
+        return float(exponent.group(1)) * 10 ** int(exponent.group(2))
+    if _INTEGER.match(number):
+        return float(number)
+    if _COMMA_GROUPED.match(number):
+        return float(number.replace(",", ""))
+    if _SPACE_GROUPED.match(number):
+        return float(number.replace(" ", ""))
+    if _DOT_GROUPED.match(number):
+        return float(number.replace(".", "").replace(",", "."))
+    if _DECIMAL.match(number):
+        return float(number.replace(",", "."))
+    return None
+
+
+def parse_lab_result(value: Any) -> Tuple[Optional[float], str]:
+    """
+    Numeric value and parse status of a free-text lab result:
+    "550" -> (550, numeric), "1,200 copies/ml" -> (1200, numeric),
+    "1 200" -> (1200, numeric), "1.2e3" -> (1200, numeric),
+    "1,200.5" -> (1200.5, numeric), "1,5" -> (1.5, numeric),
+    "Undetectable" -> (0, undetectable), "<20" -> (20, below_limit),
+    ">10000000" -> (10000000, above_limit), "" -> (None, missing),
+    anything else, "1.200" (1.2 or 1200) included -> (None, unparsed).
+    """
+    if value is None:
+        return None, "missing"
+    text_value = str(value).strip().lower()
+    if not text_value:
+        return None, "missing"
+    if text_value in _UNDETECTABLE_RESULTS:
+        return 0.0, "undetectable"
+    match = _LAB_RESULT.match(text_value)
+    numeric = _parse_lab_number(match.group("number").strip()) if match else None
+    if numeric is None:
+        return None, "unparsed"
+    sign = match.group("sign")
+    if sign and sign.startswith("<"):
+        return numeric, "below_limit"
+    if sign and sign.startswith(">"):
+        return numeric, "above_limit"
+    return numeric, "numeric"
+
+
+def normalize_identifier(value: Any) -> Optional[str]:
+    """
+    Search key of a hospital number or identifier: upper case, separators
+    dropped and leading zeros stripped from every part, so "00720/19",
+    "720-19" and "720 19" all become "72019"
+    """
+    if value is None:
+        return None
+    parts = re.split(r"[^A-Z0-9]+", str(value).upper())
+    key = "".join(part.lstrip("0") or "0" for part in parts if part)
+    return key[:50] or None
+
+
+def apply_derived_fields(values: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Set the LAB_RESULT_FIELDS value and parse status of every lab result
+    present in values, facility_id when datim_code is present, and the
+    search key of every SEARCH_KEY_FIELDS column present
+    """
+    for source, (value_column, status_column) in LAB_RESULT_FIELDS.items():
+        if source in values:
+            values[value_column], values[status_column] = parse_lab_result(values[source])
+    if "datim_code" in values:
+        values["facility_id"] = facility_registry.get_id(values["datim_code"])
+    for key_column, source in SEARCH_KEY_FIELDS.items():
+        if source in values:
+            values[key_column] = normalize_identifier(values[source])
+    return values
+
+
+def facility_condition(datim_code: str):
+    """
+    Patients of one facility. Registered facilities are matched on the
+    indexed integer facility_id, plus rows still without one: a write that
+    checked the registry before the facility was registered and committed
+    after upsert_facilities stamped the existing rows keeps a NULL facility_id
+    until backfill_facility_ids. Codes this worker does not know are matched
+    on datim_code.
+    """
+    facility_id = facility_registry.get_id(datim_code)
+    if facility_id is None:
+        return PatientARTData.datim_code == datim_code
+    return or_(
+        PatientARTData.facility_id == facility_id,
+        and_(PatientARTData.facility_id.is_(None), PatientARTData.datim_code == datim_code),
+    )
+
+
+def get_age_band(age: Optional[int]) -> str:
+    """AGE_BANDS label for an age, "" when unknown"""
+    if age is None:
+        return ""
+    label = ""
+    for band, lowest in AGE_BANDS:
+        if age >= lowest:
+            label = band
+    return label
+
+
+def _add_months(month_start: date, months: int) -> date:
+    """First day of the month months after month_start"""
+    month_index = month_start.year * 12 + month_start.month - 1 + months
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+
+class ResultCache:
+    """
+    Thread-safe in-process cache of computed results. An entry is reused while
+    it is younger than ttl seconds and was stored under the same freshness
+    token; the oldest entries are evicted beyond max_entries.
+    """
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Any, Tuple[float, Any, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, token) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, stored_token, value = entry
+            if stored_token != token or time.monotonic() - stored_at > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, token, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), token, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+cohort_cache = ResultCache(ttl=COHORT_CACHE_TTL_SECONDS, max_entries=COHORT_CACHE_MAX_ENTRIES)
+
+
+def encode_change_cursor(change_seq: int, patient_id: int) -> str:
+    """Opaque change feed cursor for the (change_seq, id) keyset position"""
+    payload = json.dumps({"s": change_seq, "i": patient_id})
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_change_cursor(cursor: Optional[str]) -> Optional[Tuple[int, int]]:
+    """Keyset position of a cursor, None for the start of the feed. Raises ValueError if malformed"""
+    if not cursor:
+        return None
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return int(payload["s"]), int(payload["i"])
+    except Exception:
+        raise ValueError(f"Invalid change feed cursor: {cursor}")
+
+
+def _sync_value(value: Any) -> Any:
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+def encode_sync_bundle(records: Iterator[Dict[str, Any]], bundle_format: str = "ndjson") -> Iterator[bytes]:
+    """
+    gzip stream of sync records, one JSON object per line for ndjson or
+    concatenated MessagePack maps for msgpack (needs the msgpack package)
+    """
+    if bundle_format == "msgpack":
+        import msgpack
+        encode = msgpack.packb
+    else:
+        encode = lambda record: json.dumps(record, separators=(",", ":")).encode() + b"\n"
+
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31: gzip container
+    for record in records:
+        chunk = compressor.compress(encode(record))
+        if chunk:
+            yield chunk
+    yield compressor.flush()
+
+
 # =============================================
 # CRUD OPERATIONS
 # =============================================
 class PatientARTCRUD:
     def __init__(self, db_manager: Session):
         self.db_manager = db_manager
+        # Highest peak memory of the partitioned export worker processes, which live for one export
+        self.worker_peak_memory_kb: Optional[int] = None
 
     def parse_date(self, value):
         """
@@ -88,7 +590,15 @@ class PatientARTCRUD:
             excel_file = BytesIO(file_bytes)
             dataframe = pd.read_excel(excel_file)
 
+            if "datim_code" in dataframe:
+                facility_registry.ensure_known(
+                    self.db_manager, dataframe["datim_code"].dropna().astype(str).str.strip().unique()
+                )
+            else:
+                facility_registry.ensure_loaded(self.db_manager)
             created_count = 0
+            rejected_count = 0
+            created_patients: List[PatientARTData] = []
             # Helper to read safely from a row
             def get_val(row, col):
                 return None if (col not in row or pd.isna(row[col])) else row[col]
@@ -139,15 +649,34 @@ class PatientARTCRUD:
                     cd4_test_sample_collection_date=self.parse_date(get_val(row, "cd4_test_sample_collection_date")),
                     cd4_test_result_date=self.parse_date(get_val(row, "cd4_test_result_date"))
                 )
+                if not facility_registry.is_valid(patient.datim_code):
+                    rejected_count += 1
+                    continue
+                for key, value in apply_derived_fields({c: getattr(patient, c) for c in DERIVED_SOURCE_COLUMNS}).items():
+                    setattr(patient, key, value)
 
                 self.db_manager.add(patient)
+                created_patients.append(patient)
                 created_count += 1
             
+            # Flush to get the new ids for the change log, then commit
+            self.db_manager.flush()
+            self.update_retention_summary([
+                (None, {c: getattr(p, c) for c in SUMMARY_SOURCE_COLUMNS}) for p in created_patients
+            ])
+            entries = [
+                change_entry(p.id, p.patient_identifier, "import",
+                             diff_fields({}, {c: getattr(p, c) for c in AUDITED_COLUMNS}))
+                for p in created_patients
+            ]
+            self.stamp_change_sequence([p.id for p in created_patients])
             self.db_manager.commit()
+            change_log.record(self.db_manager.get_bind(), entries)
             return {
                 "patient_data": {
                     "message": "Line list import completed",
-                    "total_patient_inserted": created_count
+                    "total_patient_inserted": created_count,
+                    "total_unknown_facility": rejected_count,
                 }
             }
         except Exception as e:
@@ -157,25 +686,35 @@ class PatientARTCRUD:
 
     # 1. CREATE - Single patient
     def create_patient(self, patient_payload: PatientARTCreate):
-        """Create a single patient record"""
+        """
+        Create a single patient record with a single INSERT.
+        The unique constraint on patient_identifier detects duplicates, so two
+        concurrent creates cannot both pass a check and insert twice.
+        """
         try:
-            # Verify patient with identifer doesnt exist
-            patient_exist = self.db_manager.query(PatientARTData).filter(PatientARTData.patient_identifier==patient_payload.patient_identifier).first()
-            if patient_exist:
-                raise HTTPException(
-                    status_code=status.HTTP_409_CONFLICT,
-                    detail=f"A patient with same patient identifier already exist"
-                )
             # Convert Pydantic model to plain dict (only provided fields)
-            patient_data = patient_payload.model_dump(exclude_unset=True)
+            self.validate_facilities([patient_payload.datim_code])
+            patient_data = apply_derived_fields(patient_payload.model_dump(exclude_unset=True))
 
             patient = PatientARTData(**patient_data)
             self.db_manager.add(patient)
+            self.db_manager.flush()
+            self.update_retention_summary([(None, {c: getattr(patient, c) for c in SUMMARY_SOURCE_COLUMNS})])
+            entry = change_entry(patient.id, patient.patient_identifier, "create",
+                                 diff_fields({}, {c: getattr(patient, c) for c in AUDITED_COLUMNS}))
+            self.stamp_change_sequence([patient.id])
             self.db_manager.commit()
-            self.db_manager.refresh(patient)
+            change_log.record(self.db_manager.get_bind(), [entry])
             return {
                 "message": "Patient created successfully"
             }
+        except IntegrityError:
+            self.db_manager.rollback()
+            print(f"✗ Patient already exists: {patient_payload.patient_identifier}")
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail=f"A patient with same patient identifier already exist"
+            )
         except Exception as e:
             self.db_manager.rollback()
             print(f"✗ Error creating patient: {str(e)}")
@@ -183,129 +722,29 @@ class PatientARTCRUD:
 
     
     # 2. READ - Get patient records
-    def get_patient_by_identifier(self, patient_identifier: str) -> Optional[PatientARTData]:
-        """Get a single patient by patient_identifier"""
-        try:
-            query = self.db_manager.query(PatientARTData).filter(
-                PatientARTData.patient_identifier == patient_identifier,
-                PatientARTData.voided==False
-            )
-            patient = query.first()
-            if not patient:
-                raise HTTPException(
-                    status_code=status.HTTP_404_NOT_FOUND,
-                    detail=f"Specified Patient Identifier not found"
-                )
-            # Compute and attach current ART status
-            patient.clients_current_art_status = self.get_art_outcome(
-                last_pickup_date=patient.last_drug_pick_up_date,
-                days_of_arv_refill=patient.no_of_days_of_refills,
-                ltfu_days=28,
-                end_date=date.today(),
-            )
-
-            return patient
-        except:
-            raise
-
-    def get_all_patient_identifiers(self, skip, limit):
-        """Get all patient records"""
-        try:
-            query = (
-                self.db_manager
-                .query(
-                    PatientARTData.state,
-                    PatientARTData.datim_code, 
-                    PatientARTData.patient_identifier)
-                .filter(PatientARTData.voided==False)
-                .offset(skip)
-                .limit(limit)
-            )
-            patients = query.all()
-            return patients
-        except Exception as e:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail=f"Error fetching all patients records -> {str(e)})"
-            )
-    
-
-    def get_all_patients(self, skip, limit) -> List[PatientARTData]:
-        """Get all patient records"""
-        try:
-            query = self.db_manager.query(PatientARTData).filter(PatientARTData.voided==False).offset(skip).limit(limit)
-            
-            patients = query.all()
-            list_of_patients: List[PatientARTData] = []
-            for patient in patients:
-                patient.clients_current_art_status = self.get_art_outcome(
-                    last_pickup_date=patient.last_drug_pick_up_date,
-                    days_of_arv_refill=patient.no_of_days_of_refills,
-                    ltfu_days=28,
-                    end_date=date.today(),
-                )
-                list_of_patients.append(patient)
-                
-            return list_of_patients
-        except Exception as e:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail=f"Error fetching all patients records -> {str(e)})"
-            )
-    
-
-    def get_patients_by_datim_code(self, datim_code: str, skip, limit) -> List[PatientARTData]:
-        """Get all patients from a specific facility using datim code"""
-        try:
-            query = self.db_manager.query(PatientARTData).filter(
-                PatientARTData.datim_code == datim_code, PatientARTData.voided==False
-            ).offset(skip).limit(limit)
-            
-            patients = query.all()
-            list_of_patients: List[PatientARTData] = []
-            for patient in patients:
-                patient.clients_current_art_status = self.get_art_outcome(
-                    last_pickup_date=patient.last_drug_pick_up_date,
-                    days_of_arv_refill=patient.no_of_days_of_refills,
-                    ltfu_days=28,
-                    end_date=date.today(),
-                )
-                list_of_patients.append(patient)
-                
-            return list_of_patients
-        finally:
-            self.db_manager.close()
-    
+    # The read routes query through AsyncPatientARTCRUD (async_repo), which
+    # shares this helper
+    def get_last_modified(self, updated_at: List[Optional[datetime]], reference_date: Optional[date] = None) -> datetime:
+        """Latest row change, or midnight of the ART status reference date if later"""
+        reference_date = reference_date or date.today()
+        start_of_day = datetime.combine(reference_date, datetime.min.time())
+        return max([start_of_day] + [u for u in updated_at if u is not None])
 
-    def get_patients_by_state(self, state: str, skip, limit) -> List[PatientARTData]:
-        """Get all patients from a specific state"""
-        try:
-            query = self.db_manager.query(PatientARTData).filter(
-                PatientARTData.state == state, PatientARTData.voided==False
-            ).offset(skip).limit(limit)
-            
-            patients = query.all()
-            list_of_patients: List[PatientARTData] = []
-            for patient in patients:
-                patient.clients_current_art_status = self.get_art_outcome(
-                    last_pickup_date=patient.last_drug_pick_up_date,
-                    days_of_arv_refill=patient.no_of_days_of_refills,
-                    ltfu_days=28,
-                    end_date=date.today(),
-                )
-                list_of_patients.append(patient)
-                
-            return list_of_patients
-        except Exception as e:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail=f"Error fetching all patients records -> {str(e)})"
-            )
-    
 
     # 3. UPDATE - Modify existing patient record
-    def update_patient(self, patient_identifier: str, update_data: Dict[str, Any]) -> Optional[PatientARTData]:
-        """Update an existing patient record"""
+    def update_patient(
+            self,
+            patient_identifier: str,
+            update_data: Dict[str, Any],
+            expected_version: Optional[int] = None,
+        ) -> Optional[PatientARTData]:
+        """
+        Update an existing patient record.
+        The write is a conditional UPDATE ... WHERE version = <version read>,
+        so a concurrent change in between is reported as a 409 instead of
+        being overwritten. expected_version (from If-Match) must match the
+        stored version when given.
+        """
         try:
             patient = self.db_manager.query(PatientARTData).filter(
                 PatientARTData.patient_identifier == patient_identifier,
@@ -315,14 +754,57 @@ class PatientARTCRUD:
             if not patient:
                 print(f"✗ Patient not found: {patient_identifier}")
                 return None
-            
-            # Update fields
-            for key, value in update_data.items():
-                if hasattr(patient, key):
-                    setattr(patient, key, value)
-            
+
+            if expected_version is not None and patient.version != expected_version:
+                raise HTTPException(
+                    status_code=status.HTTP_409_CONFLICT,
+                    detail=f"Patient was modified by someone else (version {patient.version}), reload and retry",
+                )
+
+            changes = {
+                k: v for k, v in update_data.items()
+                if hasattr(PatientARTData, k) and k != "version" and k not in DERIVED_COLUMNS
+            }
+            if "datim_code" in changes:
+                self.validate_facilities([changes["datim_code"]])
+            diff = diff_fields({k: getattr(patient, k) for k in changes}, changes)
+            apply_derived_fields(changes)
+            now = datetime.now()
+            result = self.db_manager.connection().execute(
+                update(PatientARTData)
+                .where(
+                    PatientARTData.id == patient.id,
+                    PatientARTData.version == patient.version,
+                )
+                .values(**changes, updated_at=now, version=PatientARTData.version + 1)
+            )
+            if result.rowcount == 0:
+                raise HTTPException(
+                    status_code=status.HTTP_409_CONFLICT,
+                    detail="Patient was modified by someone else, reload and retry",
+                )
+            if any(k in changes for k in SUMMARY_SOURCE_COLUMNS):
+                old = {c: getattr(patient, c) for c in SUMMARY_SOURCE_COLUMNS}
+                self.update_retention_summary([(old, {**old, **changes})])
+
+            change_seq = self.stamp_change_sequence([patient.id])
+            if "datim_code" in changes:
+                self.record_facility_moves([(patient.id, patient.datim_code, changes["datim_code"])], change_seq)
+
+            # Detach so commit does not expire it, then mirror the update in memory
+            # instead of re-reading the row
+            self.db_manager.expunge(patient)
             self.db_manager.commit()
-            self.db_manager.refresh(patient)
+            for key, value in changes.items():
+                setattr(patient, key, value)
+            patient.updated_at = now
+            patient.version += 1
+            patient.change_seq = change_seq
+            if diff:
+                change_log.record(
+                    self.db_manager.get_bind(),
+                    [change_entry(patient.id, patient_identifier, "update", diff, changed_at=now)],
+                )
             
             print(f"✓ Patient updated successfully: {patient_identifier}")
             return patient
@@ -333,6 +815,122 @@ class PatientARTCRUD:
             raise
     
 
+    def bulk_update_patients(self, items: List[Tuple[str, Dict[str, Any]]]) -> List[Dict[str, Any]]:
+        """
+        Apply partial updates to many patients in one transaction.
+        Args:
+            items: (patient_identifier, changes) pairs, changes already validated
+        Returns:
+            List[Dict]: one {patient_identifier, status, detail} per item, in order.
+                status is "updated", "not_found" or "no_changes".
+        """
+        try:
+            # Resolve identifiers to primary keys with one query per IN chunk,
+            # reading the current value of every changed column for the change log.
+            # The rows stay locked until commit so no concurrent write lands
+            # between this read and the UPDATE, which would make the logged old
+            # values and the retention summary delta wrong
+            identifiers = list(dict.fromkeys(identifier for identifier, _ in items))
+            changed_columns = sorted({
+                k for _, changes in items for k in changes
+                if k in AUDITED_COLUMNS
+            } | set(SUMMARY_SOURCE_COLUMNS))
+            id_by_identifier: Dict[str, int] = {}
+            old_values: Dict[str, Dict[str, Any]] = {}
+            for start in range(0, len(identifiers), BULK_IN_CHUNK_SIZE):
+                rows = (
+                    self.db_manager
+                    .query(
+                        PatientARTData.id,
+                        PatientARTData.patient_identifier,
+                        *[getattr(PatientARTData, c) for c in changed_columns],
+                    )
+                    .filter(
+                        PatientARTData.patient_identifier.in_(identifiers[start:start + BULK_IN_CHUNK_SIZE]),
+                        PatientARTData.voided == False,
+                    )
+                    .with_for_update()
+                    .all()
+                )
+                for row in rows:
+                    id_by_identifier[row.patient_identifier] = row.id
+                    old_values[row.patient_identifier] = {c: getattr(row, c) for c in changed_columns}
+
+            # Merge repeated identifiers, later items win
+            merged: Dict[str, Dict[str, Any]] = {}
+            for identifier, changes in items:
+                if identifier in id_by_identifier:
+                    merged.setdefault(identifier, {}).update({
+                        k: v for k, v in changes.items()
+                        if hasattr(PatientARTData, k) and k != "version" and k not in DERIVED_COLUMNS
+                    })
+            self.validate_facilities([changes["datim_code"] for changes in merged.values() if "datim_code" in changes])
+
+            # Group rows by the set of columns they change, one executemany per group
+            groups: Dict[frozenset, List[Dict[str, Any]]] = {}
+            now = datetime.now()
+            for identifier, changes in merged.items():
+                if not changes:
+                    continue
+                changes = apply_derived_fields(dict(changes))
+                params = {f"b_{k}": v for k, v in changes.items()}
+                params["b_id"] = id_by_identifier[identifier]
+                params["b_updated_at"] = now
+                groups.setdefault(frozenset(changes), []).append(params)
+
+            for keys, params in groups.items():
+                stmt = (
+                    update(PatientARTData)
+                    .where(PatientARTData.id == bindparam("b_id"))
+                    .values({
+                        **{k: bindparam(f"b_{k}") for k in keys},
+                        "updated_at": bindparam("b_updated_at"),
+                        "version": PatientARTData.version + 1,
+                    })
+                )
+                # Core executemany on the session's connection, no ORM bulk synchronize
+                self.db_manager.connection().execute(stmt, params)
+
+            self.update_retention_summary([
+                (old_values[identifier], {**old_values[identifier], **changes})
+                for identifier, changes in merged.items()
+                if any(k in changes for k in SUMMARY_SOURCE_COLUMNS)
+            ])
+            change_seq = self.stamp_change_sequence(
+                [id_by_identifier[identifier] for identifier, changes in merged.items() if changes]
+            )
+            self.record_facility_moves([
+                (id_by_identifier[identifier], old_values[identifier]["datim_code"], changes["datim_code"])
+                for identifier, changes in merged.items() if "datim_code" in changes
+            ], change_seq)
+            self.db_manager.commit()
+
+            entries = []
+            for identifier, changes in merged.items():
+                diff = diff_fields(old_values[identifier], changes)
+                if diff:
+                    entries.append(change_entry(id_by_identifier[identifier], identifier, "update", diff, changed_at=now))
+            change_log.record(self.db_manager.get_bind(), entries)
+
+            results = []
+            for identifier, _ in items:
+                if identifier not in id_by_identifier:
+                    results.append({"patient_identifier": identifier, "status": "not_found",
+                                    "detail": "Patient not found or voided"})
+                elif not merged.get(identifier):
+                    results.append({"patient_identifier": identifier, "status": "no_changes", "detail": None})
+                else:
+                    results.append({"patient_identifier": identifier, "status": "updated", "detail": None})
+
+            print(f"✓ Bulk updated {sum(len(p) for p in groups.values())} patients in {len(groups)} statement group(s)")
+            return results
+
+        except Exception as e:
+            self.db_manager.rollback()
+            print(f"✗ Error bulk updating patients: {str(e)}")
+            raise
+    
+
     # 4. SOFT DELETE - Void a patient record
     def soft_delete_patient(self, patient_identifier: str, voided_by: str) -> bool:
         """Soft delete a patient record by setting voided = 1"""
@@ -346,11 +944,23 @@ class PatientARTCRUD:
                 print(f"✗ Patient not found or already voided: {patient_identifier}")
                 return False
             
+            entry = change_entry(
+                patient.id, patient.patient_identifier, "void",
+                diff_fields(
+                    {"voided": patient.voided, "voided_by": patient.voided_by, "voided_date": patient.voided_date},
+                    {"voided": 1, "voided_by": voided_by, "voided_date": datetime.now()},
+                ),
+                changed_by=voided_by,
+            )
+            self.update_retention_summary([({c: getattr(patient, c) for c in SUMMARY_SOURCE_COLUMNS}, None)])
             patient.voided = 1
             patient.voided_by = voided_by
             patient.voided_date = datetime.now()
+            patient.version = PatientARTData.version + 1
+            self.stamp_change_sequence([patient.id])
             
             self.db_manager.commit()
+            change_log.record(self.db_manager.get_bind(), [entry])
             
             print(f"✓ Patient voided successfully: {patient_identifier}")
             return True
@@ -380,11 +990,22 @@ class PatientARTCRUD:
                 )
             
             
+            entry = change_entry(
+                patient.id, patient.patient_identifier, "restore",
+                diff_fields(
+                    {"voided": patient.voided, "voided_by": patient.voided_by, "voided_date": patient.voided_date},
+                    {"voided": 0, "voided_by": None, "voided_date": None},
+                ),
+            )
+            self.update_retention_summary([(None, {c: getattr(patient, c) for c in SUMMARY_SOURCE_COLUMNS})])
             patient.voided = 0
             patient.voided_by = None
             patient.voided_date = None
+            patient.version = PatientARTData.version + 1
+            self.stamp_change_sequence([patient.id])
             
             self.db_manager.commit()
+            change_log.record(self.db_manager.get_bind(), [entry])
             
             print(f"✓ Patient restored successfully: {patient_identifier}")
             return True
@@ -395,193 +1016,2866 @@ class PatientARTCRUD:
             raise
 
 
-    def drop_all_patients(self, datim_code: Optional[str] = None) -> int:
+    def stamp_change_sequence(self, patient_ids: List[int]) -> Optional[int]:
         """
-        Delete ALL patient records from patient_art_data table.
+        Give the patients written by the current transaction the next change_seq.
+        Call it last, right before commit: the change_sequence row stays locked
+        until the commit, so sequence values become visible in commit order and
+        a change feed reader never sees n + 1 while n can still commit.
+        Only rows this transaction already wrote (and locked) are stamped.
+        """
+        if not patient_ids:
+            return None
+        self.db_manager.flush()
+        change_seq = self.take_change_sequence()
+        ids = list(dict.fromkeys(patient_ids))
+        for start in range(0, len(ids), BULK_IN_CHUNK_SIZE):
+            self.db_manager.execute(
+                update(PatientARTData)
+                .where(PatientARTData.id.in_(ids[start:start + BULK_IN_CHUNK_SIZE]))
+                # Keep updated_at as the write set it
+                .values(change_seq=change_seq, updated_at=PatientARTData.updated_at)
+                .execution_options(synchronize_session=False)
+            )
+        return change_seq
+
+    def take_change_sequence(self) -> int:
+        """Increment the patient change sequence in the current transaction and return the new value"""
+        self.db_manager.execute(
+            update(ChangeSequence)
+            .where(ChangeSequence.name == "patient")
+            .values(value=ChangeSequence.value + 1)
+        )
+        return self.db_manager.execute(
+            select(ChangeSequence.value).where(ChangeSequence.name == "patient")
+        ).scalar_one()
+
+    def get_change_sequence(self) -> int:
+        """
+        Last committed patient change_seq. change_seq is handed out in commit
+        order, so every write up to it has committed and later ones are above it
+        """
+        return self.db_manager.execute(
+            select(ChangeSequence.value).where(ChangeSequence.name == "patient")
+        ).scalar() or 0
+
+    def record_facility_moves(self, moves: List[Tuple[int, Optional[str], Optional[str]]], change_seq: int):
+        """
+        Record (patient_id, from_datim_code, to_datim_code) moves made by the current
+        transaction under its change_seq; moves that keep the datim_code are skipped
+        """
+        rows = [
+            {"patient_id": patient_id, "from_datim_code": old, "to_datim_code": new,
+             "change_seq": change_seq, "moved_at": datetime.now()}
+            for patient_id, old, new in moves if old and new and old != new
+        ]
+        if rows:
+            self.db_manager.execute(insert(PatientFacilityMove), rows)
+
+
+    def get_bulk_filter_conditions(
+            self,
+            datim_code: Optional[str] = None,
+            patient_identifiers: Optional[List[str]] = None,
+            created_from: Optional[datetime] = None,
+            created_to: Optional[datetime] = None,
+        ) -> list:
+        """WHERE conditions for filter-based bulk operations, at least one filter is required"""
+        conditions = []
+        if datim_code:
+            conditions.append(facility_condition(datim_code))
+        if patient_identifiers:
+            conditions.append(PatientARTData.patient_identifier.in_(patient_identifiers))
+        if created_from:
+            conditions.append(PatientARTData.created_at >= created_from)
+        if created_to:
+            conditions.append(PatientARTData.created_at < created_to)
+        if not conditions:
+            raise ValueError("At least one filter is required for a bulk operation")
+        return conditions
+
+
+    def bulk_void_patients(self, voided_by: str, **filters) -> int:
+        """
+        Void every non-voided patient matching the filter with one set-based UPDATE.
+        Filters: datim_code, patient_identifiers, created_from, created_to
         Returns:
-            int: number of rows deleted
+            int: number of rows voided
         """
         try:
-            # For SQLAlchemy 1.4+ using the Core delete
-            if datim_code:
-                stmt = delete(PatientARTData).where(PatientARTData.datim_code==datim_code)
-            else:
-                stmt = delete(PatientARTData)
+            conditions = self.get_bulk_filter_conditions(**filters)
+            now = datetime.now()
+            # Lock and list the affected rows for the change log
+            affected = (
+                self.db_manager
+                .query(PatientARTData.id, PatientARTData.patient_identifier,
+                       *[getattr(PatientARTData, c) for c in SUMMARY_SOURCE_COLUMNS])
+                .filter(PatientARTData.voided == False, *conditions)
+                .with_for_update()
+                .all()
+            )
+            stmt = (
+                update(PatientARTData)
+                .where(PatientARTData.voided == False, *conditions)
+                .values(voided=1, voided_by=voided_by, voided_date=now, updated_at=now,
+                        version=PatientARTData.version + 1)
+                .execution_options(synchronize_session=False)
+            )
             result = self.db_manager.execute(stmt)
+            self.update_retention_summary([
+                ({c: getattr(r, c) for c in SUMMARY_SOURCE_COLUMNS}, None) for r in affected
+            ])
+            self.stamp_change_sequence([r.id for r in affected])
             self.db_manager.commit()
 
-            deleted_count = result.rowcount or 0
-            print(f"✓ Deleted {deleted_count} patient records")
-            return deleted_count
+            voided_count = result.rowcount or 0
+            diff = diff_fields({"voided": 0}, {"voided": 1, "voided_by": voided_by, "voided_date": now})
+            change_log.record(
+                self.db_manager.get_bind(),
+                [change_entry(r.id, r.patient_identifier, "void", diff, changed_by=voided_by, changed_at=now)
+                 for r in affected],
+            )
+            print(f"✓ Bulk voided {voided_count} patient records")
+            return voided_count
 
         except Exception as e:
             self.db_manager.rollback()
-            print(f"✗ Error deleting all patient records: {str(e)}")
+            print(f"✗ Error bulk voiding patients: {str(e)}")
             raise
 
 
-    
-    def generate_patient_line_list(
-            self,  
-            datim_code: Optional[str] = None
-        ) -> BytesIO:
+    def bulk_restore_patients(self, **filters) -> int:
         """
-        Generate patient line list from the database.
-        Args:
-            datim_code (str, optional): Filter by facility DATIM code
+        Restore every voided patient matching the filter with one set-based UPDATE.
+        Filters: datim_code, patient_identifiers, created_from, created_to
         Returns:
-            BytesIO: An in-memory Excel file containing the line list
+            int: number of rows restored
         """
         try:
-            # Base query: only non-voided
-            query = (
+            conditions = self.get_bulk_filter_conditions(**filters)
+            now = datetime.now()
+            # Lock and list the affected rows, with what restoring clears, for the change log
+            affected = (
                 self.db_manager
-                .query(PatientARTData).filter(PatientARTData.voided == False)
+                .query(PatientARTData.id, PatientARTData.patient_identifier,
+                       PatientARTData.voided_by, PatientARTData.voided_date,
+                       *[getattr(PatientARTData, c) for c in SUMMARY_SOURCE_COLUMNS])
+                .filter(PatientARTData.voided == True, *conditions)
+                .with_for_update()
+                .all()
             )
+            stmt = (
+                update(PatientARTData)
+                .where(PatientARTData.voided == True, *conditions)
+                .values(voided=0, voided_by=None, voided_date=None, updated_at=now,
+                        version=PatientARTData.version + 1)
+                .execution_options(synchronize_session=False)
+            )
+            result = self.db_manager.execute(stmt)
+            self.update_retention_summary([
+                (None, {c: getattr(r, c) for c in SUMMARY_SOURCE_COLUMNS}) for r in affected
+            ])
+            self.stamp_change_sequence([r.id for r in affected])
+            self.db_manager.commit()
 
-            # Optional filter by datim_code
-            if datim_code:
-                query = query.filter(PatientARTData.datim_code == datim_code)
-
-            patients_list: List[PatientARTData] = query.all()
-            list_of_patients: List[PatientARTData] = []
-            for patient in patients_list:
-                patient.clients_current_art_status = self.get_art_outcome(
-                    last_pickup_date=patient.last_drug_pick_up_date,
-                    days_of_arv_refill=patient.no_of_days_of_refills,
-                    ltfu_days=28,
-                    end_date=date.today(),
-                )
-                list_of_patients.append(patient)
-
-            # Define the exact columns / headers as in your Excel
-            columns = [
-                "state",
-                "lga",
-                "facility_name_all",
-                "datim_code",
-                "sex",
-                "hospital_number",
-                "patient_identifier",
-                "current_age",
-                "date_of_birth",
-                "care_entry_point",
-                "art_start_date",
-                "age_at_art_initiation",
-                "clients_current_art_status",
-                "educational_status",
-                "residential_address",
-                "last_drug_pick_up_date",
-                "last_viral_load_result",
-                "cd4_test_cd4_result",
-                "adherence_outcome_classification",
-                "marital_status",
-                "employment_status",
-                "no_of_days_of_refills",
-                "who_stage_at_art_start",
-                "last_drug_art_pick_up_date",
-                "duration_on_art_months",
-                "previous_art_regimen",
-                "current_art_regimen",
-                "current_art_regimen_line",
-                "last_viral_load_sample_collection_date",
-                "last_viral_load_result_date",
-                "cd4_test_sample_collection_date",
-                "cd4_test_result_date",
-                "date",
-                "signature",
-                "comment",
-                "suggestion",
-            ]
-
-            # Build rows from ORM objects
-            data = []
-            for p in list_of_patients:
-                row = {
-                    "state": p.state,
-                    "lga": p.lga,
-                    "facility_name_all": p.facility_name_all,
-                    "datim_code": p.datim_code,
-                    "sex": p.sex,
-                    "hospital_number": p.hospital_number,
-                    "patient_identifier": p.patient_identifier,
-                    "current_age": p.current_age,
-                    "date_of_birth": p.date_of_birth,
-                    "care_entry_point": p.care_entry_point,
-                    "art_start_date": p.art_start_date,
-                    "age_at_art_initiation": p.age_at_art_initiation,
-                    "clients_current_art_status": p.clients_current_art_status,
-                    "educational_status": p.educational_status,
-                    "residential_address": p.residential_address,
-                    "last_drug_pick_up_date": p.last_drug_pick_up_date,
-                    "last_viral_load_result": p.last_viral_load_result,
-                    "cd4_test_cd4_result": p.cd4_test_cd4_result,
-                    "adherence_outcome_classification": p.adherence_outcome_classification,
-                    "marital_status": p.marital_status,
-                    "employment_status": p.employment_status,
-                    "no_of_days_of_refills": p.no_of_days_of_refills,
-                    "who_stage_at_art_start": p.who_stage_at_art_start,
-                    "last_drug_art_pick_up_date": p.last_drug_art_pick_up_date,
-                    "duration_on_art_months": p.duration_on_art_months,
-                    "previous_art_regimen": p.previous_art_regimen,
-                    "current_art_regimen": p.current_art_regimen,
-                    "current_art_regimen_line": p.current_art_regimen_line,
-                    "last_viral_load_sample_collection_date": p.last_viral_load_sample_collection_date,
-                    "last_viral_load_result_date": p.last_viral_load_result_date,
-                    "cd4_test_sample_collection_date": p.cd4_test_sample_collection_date,
-                    "cd4_test_result_date": p.cd4_test_result_date,
-                    "date": getattr(p, "date", None),
-                    "signature": p.signature,
-                    "comment": p.comment,
-                    "suggestion": p.suggestion,
-                }
-                data.append(row)
+            restored_count = result.rowcount or 0
+            change_log.record(
+                self.db_manager.get_bind(),
+                [
+                    change_entry(
+                        r.id, r.patient_identifier, "restore",
+                        diff_fields(
+                            {"voided": 1, "voided_by": r.voided_by, "voided_date": r.voided_date},
+                            {"voided": 0, "voided_by": None, "voided_date": None},
+                        ),
+                        changed_at=now,
+                    )
+                    for r in affected
+                ],
+            )
+            print(f"✓ Bulk restored {restored_count} patient records")
+            return restored_count
 
-            # Create DataFrame with the defined column order
-            df = pd.DataFrame(data, columns=columns)
+        except Exception as e:
+            self.db_manager.rollback()
+            print(f"✗ Error bulk restoring patients: {str(e)}")
+            raise
 
-            # Write to an in-memory Excel file
-            output = BytesIO()
-            with pd.ExcelWriter(output, engine="openpyxl") as writer:
-                df.to_excel(writer, index=False, sheet_name="Patient Line List")
-            output.seek(0)
 
-            return output
-        except Exception as e:
-            print(f"✗ Error generating patient line list: {str(e)}")
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail=f"Error generating patient line list -> {str(e)}",
-            )
-        
+    # 6. HISTORY - Change log queries
+    def get_patient_history(self, patient_identifier: str, skip: int = 0, limit: int = 100) -> List[Dict[str, Any]]:
+        """Change log entries for a patient, newest first"""
+        # Pending entries are written by the change log thread, wait for them first
+        change_log.flush(timeout=5)
+        entries = (
+            self.db_manager.query(PatientChangeLog)
+            .filter(PatientChangeLog.patient_identifier == patient_identifier)
+            .order_by(PatientChangeLog.changed_at.desc(), PatientChangeLog.id.desc())
+            .offset(skip)
+            .limit(limit)
+            .all()
+        )
+        return [
+            {
+                "patient_identifier": e.patient_identifier,
+                "change_type": e.change_type,
+                "changes": json.loads(e.changes),
+                "changed_by": e.changed_by,
+                "changed_at": e.changed_at.isoformat(),
+            }
+            for e in entries
+        ]
 
-    def get_line_list_requests(self, skip, limit) -> List["LineListRequestResponse"]:
+    def get_patient_as_of(self, patient_identifier: str, as_of: datetime) -> Optional[Dict[str, Any]]:
         """
-        Fetch all line list export requests from the database,
-        ordered by most recent request date.
+        Reconstruct a patient record as it was at as_of by starting from the
+        current row and reverse-applying every later change log entry.
+        Returns None when the patient did not exist yet at as_of.
         """
-        try:
-            line_list_data = (
-                self.db_manager
-                .query(LineListRequest)
-                .order_by(LineListRequest.request_date.desc())
-                .offset(skip)
-                .limit(limit)
-                .all()
+        change_log.flush(timeout=5)
+        patient = self.db_manager.query(PatientARTData).filter(
+            PatientARTData.patient_identifier == patient_identifier
+        ).first()
+        if not patient:
+            return None
+
+        record = {c: getattr(patient, c) for c in AUDITED_COLUMNS}
+        later = (
+            self.db_manager.query(PatientChangeLog)
+            .filter(
+                PatientChangeLog.patient_id == patient.id,
+                PatientChangeLog.changed_at > as_of,
             )
+            .order_by(PatientChangeLog.changed_at.desc(), PatientChangeLog.id.desc())
+            .all()
+        )
+        columns = PatientARTData.__table__.columns
+        for entry in later:
+            if entry.change_type in ("create", "import"):
+                return None
+            for field, (old, _new) in json.loads(entry.changes).items():
+                if old is not None and isinstance(columns[field].type, (Date, DateTime)):
+                    old = (datetime if isinstance(columns[field].type, DateTime) else date).fromisoformat(old)
+                record[field] = old
 
-            line_list_requests = [
-                LineListRequestResponse(
-                    request_id=req.request_id,
-                    requested_by=req.requested_by_id,
-                    request_date=req.request_date.strftime("%Y-%m-%d %H:%M:%S"),
-                    request_status=req.request_status,
-                )
-                for req in line_list_data
-            ]
+        record["id"] = patient.id
+        record["clients_current_art_status"] = self.get_art_outcome(
+            last_pickup_date=record["last_drug_pick_up_date"],
+            days_of_arv_refill=record["no_of_days_of_refills"],
+            ltfu_days=28,
+            end_date=as_of.date(),
+        )
+        record["as_of"] = as_of.isoformat()
+        return record
 
-            return line_list_requests
-        except Exception as e:
+
+    # =============================================
+    # IDEMPOTENCY KEYS
+    # =============================================
+    def begin_idempotent_request(self, key: str, route: str, fingerprint: str) -> Optional[Tuple[int, Any]]:
+        """
+        Claim an Idempotency-Key for route. The unique (key, route) row is the lock,
+        held for IDEMPOTENCY_IN_PROGRESS_LEASE_MINUTES while in progress.
+        Returns:
+            None when the caller should process the request, or the stored
+            (status_code, response) of the completed original request
+        Raises:
+            HTTPException 422 if the key was used with a different request,
+            409 while the original request is still being processed
+        """
+        global _last_idempotency_purge
+        now = datetime.now()
+        if time.monotonic() - _last_idempotency_purge > IDEMPOTENCY_PURGE_INTERVAL_SECONDS:
+            _last_idempotency_purge = time.monotonic()
+            self.db_manager.execute(delete(IdempotencyKey).where(IdempotencyKey.expires_at < now))
+            self.db_manager.commit()
+
+        for _ in range(2):
+            try:
+                self.db_manager.add(IdempotencyKey(
+                    idempotency_key=key,
+                    route=route,
+                    fingerprint=fingerprint,
+                    state="in_progress",
+                    created_at=now,
+                    expires_at=now + timedelta(hours=IDEMPOTENCY_KEY_TTL_HOURS),
+                ))
+                self.db_manager.commit()
+                return None
+            except IntegrityError:
+                self.db_manager.rollback()
+
+            existing = self.db_manager.query(IdempotencyKey).filter(
+                IdempotencyKey.idempotency_key == key,
+                IdempotencyKey.route == route,
+            ).first()
+            if existing is None:
+                continue
+            lease_expired = (
+                existing.state == "in_progress"
+                and existing.created_at + timedelta(minutes=IDEMPOTENCY_IN_PROGRESS_LEASE_MINUTES) < now
+            )
+            if existing.expires_at < now or lease_expired:
+                # Expired or abandoned, free the key unless another retry already
+                # reclaimed it, and claim it again
+                self.db_manager.expunge(existing)
+                self.db_manager.execute(
+                    delete(IdempotencyKey)
+                    .where(IdempotencyKey.id == existing.id)
+                    .execution_options(synchronize_session=False)
+                )
+                self.db_manager.commit()
+                continue
+            if existing.fingerprint != fingerprint:
+                raise HTTPException(
+                    status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                    detail="Idempotency-Key was already used with a different request",
+                )
+            if existing.state != "completed":
+                raise HTTPException(
+                    status_code=status.HTTP_409_CONFLICT,
+                    detail="A request with this Idempotency-Key is still being processed",
+                )
+            return existing.status_code, json.loads(existing.response)
+
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Could not claim Idempotency-Key, retry the request",
+        )
+
+    def complete_idempotent_request(self, key: str, route: str, status_code: int, response: Any):
+        """Store the JSON-compatible response replayed for retries of the key"""
+        self.db_manager.execute(
+            update(IdempotencyKey)
+            .where(IdempotencyKey.idempotency_key == key, IdempotencyKey.route == route)
+            .values(state="completed", status_code=status_code, response=json.dumps(response, default=str))
+        )
+        self.db_manager.commit()
+
+    def release_idempotent_request(self, key: str, route: str):
+        """Drop the claim of a request that failed so a retry processes it again"""
+        self.db_manager.rollback()
+        self.db_manager.execute(
+            delete(IdempotencyKey)
+            .where(IdempotencyKey.idempotency_key == key, IdempotencyKey.route == route)
+        )
+        self.db_manager.commit()
+
+
+    def count_patients(self, datim_code: Optional[str] = None) -> int:
+        """Count all patient rows (voided included), optionally for one facility"""
+        query = self.db_manager.query(func.count(PatientARTData.id))
+        if datim_code:
+            query = query.filter(facility_condition(datim_code))
+        return query.scalar() or 0
+
+
+    def drop_all_patients(
+            self,
+            datim_code: Optional[str] = None,
+            chunk_size: int = 1000,
+            pause_seconds: float = 0.0,
+            progress_callback: Optional[Callable[[str, int], None]] = None,
+        ) -> int:
+        """
+        Delete ALL patient records from patient_art_data table.
+        Rows are deleted in primary key order, chunk_size rows per short
+        transaction with pause_seconds between chunks, so locks are held
+        briefly and readers and writers can interleave. Each chunk records
+        its patients in patient_deletion under one change_seq, for the change
+        feed and sync tombstones, and in the change log.
+        Returns:
+            int: number of rows deleted
+        """
+        deleted_count = 0
+        last_id = 0
+        try:
+            while True:
+                # Lock the next chunk after the last one deleted
+                query = (
+                    self.db_manager
+                    .query(PatientARTData.id, PatientARTData.patient_identifier,
+                           PatientARTData.datim_code, PatientARTData.version)
+                    .filter(PatientARTData.id > last_id)
+                )
+                if datim_code:
+                    query = query.filter(facility_condition(datim_code))
+                chunk = query.order_by(PatientARTData.id).limit(chunk_size).with_for_update().all()
+                if not chunk:
+                    break
+
+                chunk_ids = [row.id for row in chunk]
+                for start in range(0, len(chunk_ids), BULK_IN_CHUNK_SIZE):
+                    self.db_manager.execute(
+                        delete(PatientARTData)
+                        .where(PatientARTData.id.in_(chunk_ids[start:start + BULK_IN_CHUNK_SIZE]))
+                        .execution_options(synchronize_session=False)
+                    )
+                now = datetime.now()
+                change_seq = self.take_change_sequence()
+                self.db_manager.execute(insert(PatientDeletion), [
+                    {"patient_id": row.id, "patient_identifier": row.patient_identifier,
+                     "datim_code": row.datim_code, "version": row.version,
+                     "change_seq": change_seq, "deleted_at": now}
+                    for row in chunk
+                ])
+                self.db_manager.commit()
+                change_log.record(
+                    self.db_manager.get_bind(),
+                    [change_entry(row.id, row.patient_identifier, "delete", {}, changed_at=now) for row in chunk],
+                )
+
+                deleted_count += len(chunk)
+                last_id = chunk_ids[-1]
+                if progress_callback:
+                    progress_callback("deleting", deleted_count)
+                if pause_seconds:
+                    time.sleep(pause_seconds)
+
+            # Deleted patients leave the summary with their facility, or entirely
+            summary_delete = delete(PatientRetentionSummary)
+            if datim_code:
+                summary_delete = summary_delete.where(PatientRetentionSummary.datim_code == datim_code)
+            self.db_manager.execute(summary_delete)
+            self.db_manager.commit()
+
+            print(f"✓ Deleted {deleted_count} patient records")
+            return deleted_count
+
+        except Exception as e:
+            self.db_manager.rollback()
+            print(f"✗ Error deleting all patient records after {deleted_count} rows: {str(e)}")
+            raise
+
+
+    # =============================================
+    # RETENTION SUMMARY
+    # =============================================
+    def get_summary_status_date(self) -> Optional[date]:
+        """Date the summary's ART statuses are computed against, None before the first rebuild"""
+        return self.db_manager.query(func.max(PatientRetentionSummary.status_date)).scalar()
+
+    def get_summary_key(self, values: Dict[str, Any], status_date: date) -> Tuple[str, ...]:
+        """Summary row key (SUMMARY_DIMENSIONS order) of a patient's SUMMARY_SOURCE_COLUMNS values"""
+        art_status = self.get_art_outcome(
+            last_pickup_date=values.get("last_drug_pick_up_date"),
+            days_of_arv_refill=values.get("no_of_days_of_refills"),
+            ltfu_days=28,
+            end_date=status_date,
+        )
+        return (
+            values.get("state") or "",
+            values.get("lga") or "",
+            values.get("datim_code") or "",
+            values.get("sex") or "",
+            get_age_band(values.get("current_age")),
+            art_status,
+        )
+
+    def update_retention_summary(self, changes: List[Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]]):
+        """
+        Move patients between summary rows inside the caller's transaction.
+        Args:
+            changes: (old, new) SUMMARY_SOURCE_COLUMNS values per patient,
+                old is None for a new/restored patient, new is None for a voided one
+        """
+        if not changes:
+            return
+        status_date = self.get_summary_status_date()
+        if status_date is None:
+            # Nothing to maintain until the first rebuild
+            return
+
+        deltas: Counter = Counter()
+        facility_names: Dict[str, Optional[str]] = {}
+        for old, new in changes:
+            if old is not None:
+                deltas[self.get_summary_key(old, status_date)] -= 1
+            if new is not None:
+                key = self.get_summary_key(new, status_date)
+                deltas[key] += 1
+                facility_names[key[2]] = new.get("facility_name_all")
+
+        rows = [
+            {
+                **dict(zip(SUMMARY_DIMENSIONS, key)),
+                "facility_name_all": facility_names.get(key[2]),
+                "patient_count": delta,
+                "status_date": status_date,
+                "updated_at": datetime.now(),
+            }
+            for key, delta in deltas.items() if delta
+        ]
+        if rows:
+            self.upsert_summary_counts(rows)
+
+    def upsert_summary_counts(self, rows: List[Dict[str, Any]]):
+        """Add patient_count of each row to its summary row, creating missing rows"""
+        self.upsert_rows(
+            PatientRetentionSummary,
+            rows,
+            key_columns=list(SUMMARY_DIMENSIONS),
+            update_columns=["updated_at"],
+            increment_columns=["patient_count"],
+        )
+
+    def rebuild_retention_summary(
+            self,
+            status_date: Optional[date] = None,
+            batch_size: int = SUMMARY_REBUILD_BATCH_SIZE,
+            progress_callback: Optional[Callable[[str, int], None]] = None,
+        ) -> Dict[str, Any]:
+        """
+        Recompute the whole summary against status_date (default today).
+        Patients are read in keyset batches of the summary columns only and
+        aggregated with pandas; the summary is then replaced in one transaction.
+        Writes committed while the rebuild reads are not reflected until the
+        next rebuild, so run it when the write load is low (e.g. nightly).
+        """
+        status_date = status_date or date.today()
+        columns = ["id"] + SUMMARY_SOURCE_COLUMNS
+        totals: Optional[pd.Series] = None
+        facility_names: Dict[str, str] = {}
+        rows_processed = 0
+        last_id = 0
+
+        while True:
+            batch = self.db_manager.execute(
+                select(*[getattr(PatientARTData, c) for c in columns])
+                .where(PatientARTData.voided == False, PatientARTData.id > last_id)
+                .order_by(PatientARTData.id)
+                .limit(batch_size)
+            ).all()
+            if not batch:
+                break
+            last_id = batch[-1].id
+            rows_processed += len(batch)
+
+            df = self.build_summary_dimensions(pd.DataFrame(batch, columns=columns), status_date)
+            counts = df.groupby(list(SUMMARY_DIMENSIONS)).size()
+            totals = counts if totals is None else totals.add(counts, fill_value=0)
+            facility_names.update(
+                df.dropna(subset=["facility_name_all"]).groupby("datim_code")["facility_name_all"].first().to_dict()
+            )
+            if progress_callback:
+                progress_callback("aggregating", rows_processed)
+
+        now = datetime.now()
+        rows = []
+        if totals is not None:
+            for key, count in totals.items():
+                rows.append({
+                    **dict(zip(SUMMARY_DIMENSIONS, key)),
+                    "facility_name_all": facility_names.get(key[2]),
+                    "patient_count": int(count),
+                    "status_date": status_date,
+                    "updated_at": now,
+                })
+
+        if progress_callback:
+            progress_callback("writing", rows_processed)
+        try:
+            self.db_manager.execute(delete(PatientRetentionSummary))
+            for start in range(0, len(rows), BULK_IN_CHUNK_SIZE):
+                self.db_manager.connection().execute(
+                    insert(PatientRetentionSummary), rows[start:start + BULK_IN_CHUNK_SIZE]
+                )
+            self.db_manager.commit()
+        except Exception:
+            self.db_manager.rollback()
+            raise
+
+        print(f"✓ Rebuilt retention summary: {len(rows)} rows from {rows_processed} patients as of {status_date}")
+        return {"status_date": status_date.isoformat(), "patients": rows_processed, "summary_rows": len(rows)}
+
+    def build_summary_dimensions(self, df: pd.DataFrame, status_date: date) -> pd.DataFrame:
+        """Vectorized get_summary_key: adds age_band and art_status, blanks missing dimensions"""
+        # Out of range dates (a typo'd year) count as no pickup date rather than failing the rebuild
+        pickup = pd.to_datetime(df["last_drug_pick_up_date"], errors="coerce")
+        refills = pd.to_numeric(df["no_of_days_of_refills"]).fillna(0)
+        ltfu_date = pickup + pd.to_timedelta(refills + 28, unit="D")
+        df["art_status"] = np.where(
+            pickup.isna(),
+            "No last pickup date",
+            np.where(ltfu_date >= pd.Timestamp(status_date), "Active", "Inactive"),
+        )
+
+        bins = [lowest for _, lowest in AGE_BANDS] + [np.inf]
+        df["age_band"] = (
+            pd.cut(pd.to_numeric(df["current_age"]), bins=bins, right=False,
+                   labels=[label for label, _ in AGE_BANDS])
+            .astype(object)
+            .fillna("")
+        )
+        for column in ("state", "lga", "datim_code", "sex"):
+            df[column] = df[column].fillna("")
+        return df
+
+    def get_retention_summary(self, group_by: List[str], **filters) -> Dict[str, Any]:
+        """
+        Patient counts from the summary table grouped by any of SUMMARY_DIMENSIONS.
+        Filters: equality on SUMMARY_DIMENSIONS, None values are ignored
+        """
+        group_columns = [getattr(PatientRetentionSummary, g) for g in group_by]
+        selected = group_columns + [func.sum(PatientRetentionSummary.patient_count).label("patient_count")]
+        if "datim_code" in group_by:
+            selected.append(func.max(PatientRetentionSummary.facility_name_all).label("facility_name_all"))
+
+        query = self.db_manager.query(*selected)
+        for name, value in filters.items():
+            if value is not None:
+                query = query.filter(getattr(PatientRetentionSummary, name) == value)
+        rows = (
+            query
+            .group_by(*group_columns)
+            .having(func.sum(PatientRetentionSummary.patient_count) > 0)
+            .order_by(*group_columns)
+            .all()
+        )
+        results = [dict(row._mapping) for row in rows]
+        for row in results:
+            row["patient_count"] = int(row["patient_count"])
+        return {
+            "status_date": self.get_summary_status_date(),
+            "total": sum(row["patient_count"] for row in results),
+            "rows": results,
+        }
+
+
+    def upsert_rows(
+            self,
+            model,
+            rows: List[Dict[str, Any]],
+            key_columns: List[str],
+            update_columns: List[str],
+            increment_columns: List[str] = (),
+        ):
+        """
+        Insert rows. Where a row's key already exists, overwrite its
+        update_columns and add the row's increment_columns to the stored values.
+        """
+        if not rows:
+            return
+        connection = self.db_manager.connection()
+        dialect = connection.dialect.name
+        if dialect == "mysql":
+            stmt = mysql_insert(model)
+            new_values = stmt.inserted
+        elif dialect == "sqlite":
+            stmt = sqlite_insert(model)
+            new_values = stmt.excluded
+        else:
+            raise RuntimeError(f"Upserts need a MySQL or SQLite database, the configured database is {dialect}")
+        values = {
+            **{c: new_values[c] for c in update_columns},
+            **{c: getattr(model, c) + new_values[c] for c in increment_columns},
+        }
+        if dialect == "mysql":
+            stmt = stmt.on_duplicate_key_update(values)
+        else:
+            stmt = stmt.on_conflict_do_update(index_elements=key_columns, set_=values)
+        for start in range(0, len(rows), BULK_IN_CHUNK_SIZE):
+            connection.execute(stmt, rows[start:start + BULK_IN_CHUNK_SIZE])
+
+
+    # =============================================
+    # ART STATUS SNAPSHOTS
+    # =============================================
+    def ensure_snapshot_partitions(self, through: date):
+        """
+        MySQL only: RANGE partition the snapshot tables by month and keep
+        monthly partitions available up to SNAPSHOT_PARTITION_MONTHS_AHEAD
+        months after through, splitting them off the p_future partition.
+        """
+        connection = self.db_manager.connection()
+        if connection.dialect.name != "mysql":
+            return
+
+        through_month = through.replace(day=1)
+        last_month = _add_months(through_month, SNAPSHOT_PARTITION_MONTHS_AHEAD)
+
+        def partition(month: date) -> str:
+            return (f"PARTITION p{month:%Y%m} VALUES LESS THAN "
+                    f"(TO_DAYS('{_add_months(month, 1):%Y-%m-%d}'))")
+
+        def months_between(first: date, last: date) -> List[date]:
+            months = [first]
+            while months[-1] < last:
+                months.append(_add_months(months[-1], 1))
+            return months
+
+        for table in SNAPSHOT_PARTITIONED_TABLES:
+            existing = connection.execute(
+                text(
+                    "SELECT PARTITION_NAME FROM information_schema.PARTITIONS "
+                    "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table "
+                    "AND PARTITION_NAME IS NOT NULL"
+                ),
+                {"table": table},
+            ).scalars().all()
+
+            if not existing:
+                first_date = connection.execute(text(f"SELECT MIN(snapshot_date) FROM {table}")).scalar()
+                first_month = min(first_date, through).replace(day=1) if first_date else through_month
+                parts = [partition(m) for m in months_between(first_month, last_month)]
+                ddl = (f"ALTER TABLE {table} PARTITION BY RANGE (TO_DAYS(snapshot_date)) "
+                       f"({', '.join(parts)}, PARTITION p_future VALUES LESS THAN MAXVALUE)")
+            else:
+                monthly = sorted(name for name in existing if name != "p_future")
+                latest = datetime.strptime(monthly[-1], "p%Y%m").date() if monthly else _add_months(through_month, -1)
+                if latest >= last_month:
+                    continue
+                parts = [partition(m) for m in months_between(_add_months(latest, 1), last_month)]
+                ddl = (f"ALTER TABLE {table} REORGANIZE PARTITION p_future INTO "
+                       f"({', '.join(parts)}, PARTITION p_future VALUES LESS THAN MAXVALUE)")
+
+            connection.execute(text(ddl))
+            print(f"✓ Partitioned {table} through {last_month:%Y-%m}")
+
+    def take_art_status_snapshot(
+            self,
+            snapshot_date: Optional[date] = None,
+            batch_size: int = SNAPSHOT_BATCH_SIZE,
+            progress_callback: Optional[Callable[[str, int], None]] = None,
+        ) -> Dict[str, Any]:
+        """
+        Compute ART status as of snapshot_date (default today) for every
+        non-voided patient and store the day's counts per summary dimension,
+        plus one transition row per patient whose status changed since the
+        previous snapshot. Patients are processed in keyset batches with
+        vectorized pandas; each batch's transitions commit on their own.
+        Re-running a day replaces its counts.
+        """
+        snapshot_date = snapshot_date or date.today()
+        self.ensure_snapshot_partitions(snapshot_date)
+
+        columns = ["id", "patient_identifier"] + SUMMARY_SOURCE_COLUMNS
+        totals: Optional[pd.Series] = None
+        rows_processed = 0
+        transition_count = 0
+        last_id = 0
+
+        while True:
+            batch = self.db_manager.execute(
+                select(*[getattr(PatientARTData, c) for c in columns])
+                .where(PatientARTData.voided == False, PatientARTData.id > last_id)
+                .order_by(PatientARTData.id)
+                .limit(batch_size)
+            ).all()
+            upper_id = batch[-1].id if batch else None
+
+            # Previous statuses for the same id range, including patients voided or deleted since
+            latest_query = select(ArtStatusLatest.patient_id, ArtStatusLatest.patient_identifier,
+                                  ArtStatusLatest.datim_code, ArtStatusLatest.art_status
+                                  ).where(ArtStatusLatest.patient_id > last_id)
+            if upper_id is not None:
+                latest_query = latest_query.where(ArtStatusLatest.patient_id <= upper_id)
+            latest = pd.DataFrame(
+                self.db_manager.execute(latest_query).all(),
+                columns=["id", "latest_identifier", "latest_datim_code", "previous_status"],
+            )
+
+            df = self.build_summary_dimensions(pd.DataFrame(batch, columns=columns), snapshot_date)
+            merged = df.merge(latest[["id", "previous_status"]], on="id", how="left")
+            changed = merged[merged["previous_status"].ne(merged["art_status"])]
+            removed = latest[~latest["id"].isin(df["id"])]
+
+            transitions = [
+                {
+                    "snapshot_date": snapshot_date,
+                    "patient_id": int(row.id),
+                    "patient_identifier": row.patient_identifier,
+                    "datim_code": row.datim_code,
+                    "from_status": row.previous_status if isinstance(row.previous_status, str) else None,
+                    "to_status": row.art_status,
+                }
+                for row in changed.itertuples(index=False)
+            ] + [
+                {
+                    "snapshot_date": snapshot_date,
+                    "patient_id": int(row.id),
+                    "patient_identifier": row.latest_identifier,
+                    "datim_code": row.latest_datim_code,
+                    "from_status": row.previous_status,
+                    "to_status": "Removed",
+                }
+                for row in removed.itertuples(index=False)
+            ]
+            try:
+                self.upsert_rows(ArtStatusTransition, transitions,
+                                 key_columns=["snapshot_date", "patient_id"], update_columns=["to_status"])
+                self.upsert_rows(
+                    ArtStatusLatest,
+                    [
+                        {
+                            "patient_id": t["patient_id"],
+                            "patient_identifier": t["patient_identifier"],
+                            "datim_code": t["datim_code"],
+                            "art_status": t["to_status"],
+                            "snapshot_date": snapshot_date,
+                        }
+                        for t in transitions if t["to_status"] != "Removed"
+                    ],
+                    key_columns=["patient_id"],
+                    update_columns=["patient_identifier", "datim_code", "art_status", "snapshot_date"],
+                )
+                removed_ids = [int(i) for i in removed["id"]]
+                for start in range(0, len(removed_ids), BULK_IN_CHUNK_SIZE):
+                    self.db_manager.execute(
+                        delete(ArtStatusLatest)
+                        .where(ArtStatusLatest.patient_id.in_(removed_ids[start:start + BULK_IN_CHUNK_SIZE]))
+                    )
+                self.db_manager.commit()
+            except Exception:
+                self.db_manager.rollback()
+                raise
+            transition_count += len(transitions)
+
+            if not batch:
+                break
+            last_id = upper_id
+            rows_processed += len(batch)
+            counts = df.groupby(list(SUMMARY_DIMENSIONS)).size()
+            totals = counts if totals is None else totals.add(counts, fill_value=0)
+            if progress_callback:
+                progress_callback("snapshotting", rows_processed)
+
+        rows = []
+        if totals is not None:
+            rows = [
+                {**dict(zip(SUMMARY_DIMENSIONS, key)), "snapshot_date": snapshot_date, "patient_count": int(count)}
+                for key, count in totals.items()
+            ]
+        if progress_callback:
+            progress_callback("writing", rows_processed)
+        try:
+            self.db_manager.execute(
+                delete(ArtStatusDailySnapshot).where(ArtStatusDailySnapshot.snapshot_date == snapshot_date)
+            )
+            for start in range(0, len(rows), BULK_IN_CHUNK_SIZE):
+                self.db_manager.connection().execute(
+                    insert(ArtStatusDailySnapshot), rows[start:start + BULK_IN_CHUNK_SIZE]
+                )
+            self.db_manager.commit()
+        except Exception:
+            self.db_manager.rollback()
+            raise
+
+        print(f"✓ ART status snapshot {snapshot_date}: {rows_processed} patients, "
+              f"{len(rows)} rows, {transition_count} transitions")
+        return {
+            "snapshot_date": snapshot_date.isoformat(),
+            "patients": rows_processed,
+            "snapshot_rows": len(rows),
+            "transitions": transition_count,
+        }
+
+    def get_art_status_trend(
+            self,
+            date_from: date,
+            date_to: date,
+            group_by: List[str],
+            interval: str = "day",
+            **filters,
+        ) -> Dict[str, Any]:
+        """
+        Snapshot counts per snapshot date between date_from and date_to,
+        grouped by any of SUMMARY_DIMENSIONS. interval "month" keeps the
+        first snapshot of each month. Filters: equality on SUMMARY_DIMENSIONS.
+        """
+        dates = [
+            d for (d,) in self.db_manager.query(ArtStatusDailySnapshot.snapshot_date)
+            .filter(ArtStatusDailySnapshot.snapshot_date.between(date_from, date_to))
+            .distinct()
+            .order_by(ArtStatusDailySnapshot.snapshot_date)
+            .all()
+        ]
+        if interval == "month":
+            first_per_month: Dict[Tuple[int, int], date] = {}
+            for d in dates:
+                first_per_month.setdefault((d.year, d.month), d)
+            dates = list(first_per_month.values())
+        if not dates:
+            return {"dates": [], "rows": []}
+
+        group_columns = [getattr(ArtStatusDailySnapshot, g) for g in group_by]
+        query = self.db_manager.query(
+            ArtStatusDailySnapshot.snapshot_date,
+            *group_columns,
+            func.sum(ArtStatusDailySnapshot.patient_count).label("patient_count"),
+        ).filter(ArtStatusDailySnapshot.snapshot_date.in_(dates))
+        for name, value in filters.items():
+            if value is not None:
+                query = query.filter(getattr(ArtStatusDailySnapshot, name) == value)
+        rows = (
+            query
+            .group_by(ArtStatusDailySnapshot.snapshot_date, *group_columns)
+            .order_by(ArtStatusDailySnapshot.snapshot_date, *group_columns)
+            .all()
+        )
+        results = [dict(row._mapping) for row in rows]
+        for row in results:
+            row["patient_count"] = int(row["patient_count"])
+        return {"dates": dates, "rows": results}
+
+    def get_art_status_transitions(
+            self,
+            date_from: date,
+            date_to: date,
+            datim_code: Optional[str] = None,
+        ) -> List[Dict[str, Any]]:
+        """Number of patients per snapshot date and (from_status, to_status) change"""
+        query = self.db_manager.query(
+            ArtStatusTransition.snapshot_date,
+            ArtStatusTransition.from_status,
+            ArtStatusTransition.to_status,
+            func.count().label("patient_count"),
+        ).filter(ArtStatusTransition.snapshot_date.between(date_from, date_to))
+        if datim_code:
+            query = query.filter(ArtStatusTransition.datim_code == datim_code)
+        rows = (
+            query
+            .group_by(ArtStatusTransition.snapshot_date, ArtStatusTransition.from_status, ArtStatusTransition.to_status)
+            .order_by(ArtStatusTransition.snapshot_date)
+            .all()
+        )
+        return [dict(row._mapping) for row in rows]
+
+
+    # =============================================
+    # RETENTION COHORTS
+    # =============================================
+    def get_age_band_condition(self, age_band: str):
+        """SQL condition on current_age for an AGE_BANDS label"""
+        labels = [label for label, _ in AGE_BANDS]
+        if age_band not in labels:
+            raise ValueError(f"Unknown age band {age_band!r}, expected one of {labels}")
+        index = labels.index(age_band)
+        condition = PatientARTData.current_age >= AGE_BANDS[index][1]
+        if index + 1 < len(AGE_BANDS):
+            condition = and_(condition, PatientARTData.current_age < AGE_BANDS[index + 1][1])
+        return condition
+
+    def read_patient_columns(self, columns: List[str], *conditions, batch_size: int = SUMMARY_REBUILD_BATCH_SIZE) -> pd.DataFrame:
+        """Columnar extract of non-voided patients, read in keyset batches of plain tuples"""
+        selected = [PatientARTData.id] + [getattr(PatientARTData, c) for c in columns]
+        frames = []
+        last_id = 0
+        while True:
+            batch = self.db_manager.execute(
+                select(*selected)
+                .where(PatientARTData.voided == False, PatientARTData.id > last_id, *conditions)
+                .order_by(PatientARTData.id)
+                .limit(batch_size)
+            ).all()
+            if not batch:
+                break
+            frames.append(pd.DataFrame(batch, columns=["id"] + columns))
+            last_id = batch[-1].id
+        if not frames:
+            return pd.DataFrame(columns=["id"] + columns)
+        return pd.concat(frames, ignore_index=True)
+
+    def compute_retention_cohorts(
+            self,
+            df: pd.DataFrame,
+            as_of: date,
+            period: str = "month",
+            milestones: Tuple[int, ...] = COHORT_MILESTONE_MONTHS,
+        ) -> List[Dict[str, Any]]:
+        """
+        Group patients by ART start month ("2024-01") or quarter ("2024Q1")
+        and count those Active at each milestone month after ART start and
+        as of as_of, using the same rule as get_art_outcome.
+        Only the latest pickup is stored, so a pickup after a milestone counts
+        the patient as retained at it. Milestones after as_of are not yet
+        reached and leave the patient out of that milestone's denominator.
+        """
+        # Out of range dates (a typo'd year) are left out like missing ones
+        start = pd.to_datetime(df["art_start_date"], errors="coerce")
+        as_of_ts = pd.Timestamp(as_of)
+        keep = start.notna() & (start <= as_of_ts)
+        start = start[keep]
+        if start.empty:
+            return []
+
+        pickup = pd.to_datetime(df.loc[keep, "last_drug_pick_up_date"], errors="coerce")
+        refills = pd.to_numeric(df.loc[keep, "no_of_days_of_refills"]).fillna(0)
+        ltfu_date = pickup + pd.to_timedelta(refills + 28, unit="D")
+
+        frame = pd.DataFrame({
+            "cohort": start.dt.to_period("Q" if period == "quarter" else "M").astype(str),
+            "active": (ltfu_date >= as_of_ts).to_numpy(),
+        })
+        start_months = start.to_numpy().astype("datetime64[M]")
+        start_days = start.to_numpy().astype("datetime64[D]") - start_months.astype("datetime64[D]")
+        for months in milestones:
+            # Same day of month, months later (month overflow lands early in the next month)
+            milestone_date = pd.to_datetime((start_months + np.timedelta64(months, "M")).astype("datetime64[D]") + start_days)
+            reached = milestone_date <= as_of_ts
+            frame[f"eligible_{months}"] = reached
+            frame[f"active_{months}"] = reached & (ltfu_date.to_numpy() >= milestone_date)
+
+        grouped = frame.groupby("cohort", sort=True)
+        totals = grouped.sum()
+        sizes = grouped.size()
+
+        def rate(numerator: int, denominator: int) -> Optional[float]:
+            return round(numerator / denominator, 4) if denominator else None
+
+        cohorts = []
+        for cohort, row in totals.iterrows():
+            patients = int(sizes[cohort])
+            cohorts.append({
+                "cohort": cohort,
+                "patients": patients,
+                "active": int(row["active"]),
+                "retention_rate": rate(int(row["active"]), patients),
+                "milestones": [
+                    {
+                        "months": months,
+                        "eligible": int(row[f"eligible_{months}"]),
+                        "active": int(row[f"active_{months}"]),
+                        "retention_rate": rate(int(row[f"active_{months}"]), int(row[f"eligible_{months}"])),
+                    }
+                    for months in milestones
+                ],
+            })
+        return cohorts
+
+    def get_retention_cohorts(
+            self,
+            as_of: Optional[date] = None,
+            period: str = "month",
+            datim_code: Optional[str] = None,
+            state: Optional[str] = None,
+            sex: Optional[str] = None,
+            age_band: Optional[str] = None,
+        ) -> Dict[str, Any]:
+        """
+        Retention by ART start cohort as of as_of (default today), computed
+        over a columnar extract of the filtered patients. Results are cached
+        per (filters, as_of, period) and recomputed once a patient changes or
+        after COHORT_CACHE_TTL_SECONDS. The patient change_seq, shared by every
+        worker and moved by deletes too, is the freshness token.
+        """
+        as_of = as_of or date.today()
+        conditions = []
+        for column, value in (("datim_code", datim_code), ("state", state), ("sex", sex)):
+            if value is not None:
+                conditions.append(getattr(PatientARTData, column) == value)
+        if age_band is not None:
+            conditions.append(self.get_age_band_condition(age_band))
+
+        key = (as_of, period, datim_code, state, sex, age_band)
+        token = self.get_change_sequence()
+        cached = cohort_cache.get(key, token)
+        if cached is not None:
+            return cached
+
+        df = self.read_patient_columns(COHORT_SOURCE_COLUMNS, *conditions)
+        result = {
+            "as_of": as_of,
+            "period": period,
+            "milestone_months": list(COHORT_MILESTONE_MONTHS),
+            "cohorts": self.compute_retention_cohorts(df, as_of, period),
+        }
+        cohort_cache.set(key, token, result)
+        return result
+
+
+    # =============================================
+    # LAB RESULTS
+    # =============================================
+    def backfill_lab_values(
+            self,
+            recompute: bool = False,
+            batch_size: int = LAB_BACKFILL_BATCH_SIZE,
+            progress_callback: Optional[Callable[[str, int], None]] = None,
+        ) -> Dict[str, Any]:
+        """
+        Derive the numeric lab columns of existing rows, in keyset batches of
+        one executemany UPDATE each, committed per batch so the job can be
+        stopped and resumed. Only rows never derived are touched unless
+        recompute. Derived columns are not user edits: version and
+        updated_at are left as they are.
+        """
+        conditions = []
+        if not recompute:
+            conditions.append(or_(*[
+                getattr(PatientARTData, status_column).is_(None)
+                for _, status_column in LAB_RESULT_FIELDS.values()
+            ]))
+        sources = list(LAB_RESULT_FIELDS)
+        derived = LAB_DERIVED_COLUMNS
+        stmt = (
+            update(PatientARTData)
+            .where(PatientARTData.id == bindparam("b_id"))
+            .values({
+                **{c: bindparam(f"b_{c}") for c in derived},
+                # Keep the TIMESTAMP from auto-updating, so change feeds do not see these rows
+                "updated_at": PatientARTData.updated_at,
+            })
+        )
+
+        rows_processed = 0
+        status_counts: Counter = Counter()
+        last_id = 0
+        while True:
+            batch = self.db_manager.execute(
+                select(PatientARTData.id, *[getattr(PatientARTData, c) for c in sources])
+                .where(PatientARTData.id > last_id, *conditions)
+                .order_by(PatientARTData.id)
+                .limit(batch_size)
+            ).all()
+            if not batch:
+                break
+            # Results repeat a lot ("Undetectable", "<20", ...), parse each distinct value once
+            parsed = {
+                source: {value: parse_lab_result(value) for value in {getattr(row, source) for row in batch}}
+                for source in sources
+            }
+            params = []
+            for row in batch:
+                values = {"b_id": row.id}
+                for source, (value_column, status_column) in LAB_RESULT_FIELDS.items():
+                    numeric, parse_status = parsed[source][getattr(row, source)]
+                    values[f"b_{value_column}"] = numeric
+                    values[f"b_{status_column}"] = parse_status
+                    status_counts[f"{source}:{parse_status}"] += 1
+                params.append(values)
+            try:
+                self.db_manager.connection().execute(stmt, params)
+                self.db_manager.commit()
+            except Exception:
+                self.db_manager.rollback()
+                raise
+            last_id = batch[-1].id
+            rows_processed += len(batch)
+            if progress_callback:
+                progress_callback("backfilling", rows_processed)
+
+        print(f"✓ Backfilled lab values for {rows_processed} patients")
+        return {"patients": rows_processed, "parse_status": dict(sorted(status_counts.items()))}
+
+    def get_viral_load_suppression(
+            self,
+            as_of: Optional[date] = None,
+            threshold: float = VL_SUPPRESSION_THRESHOLD,
+            state: Optional[str] = None,
+            datim_code: Optional[str] = None,
+        ) -> Dict[str, Any]:
+        """
+        Viral load suppression per facility over non-voided patients, one
+        aggregate query on the derived numeric columns. A patient is overdue
+        when on ART for VL_FIRST_DUE_DAYS as of as_of with no result dated
+        within VL_OVERDUE_DAYS. Patients are grouped on facility_id, the
+        codes and names of registered facilities come from the registry;
+        only patients without a facility_id are grouped on their datim_code.
+        """
+        as_of = as_of or date.today()
+        value = PatientARTData.last_viral_load_value
+        parse_status = PatientARTData.last_viral_load_parse_status
+        result_date = func.coalesce(
+            PatientARTData.last_viral_load_result_date,
+            PatientARTData.last_viral_load_sample_collection_date,
+        )
+
+        def count_if(condition):
+            return func.sum(case((condition, 1), else_=0))
+
+        unregistered = PatientARTData.facility_id.is_(None)
+        unregistered_code = case((unregistered, PatientARTData.datim_code), else_=None)
+        query = self.db_manager.query(
+            PatientARTData.facility_id,
+            unregistered_code.label("datim_code"),
+            func.max(case((unregistered, PatientARTData.facility_name_all), else_=None)).label("facility_name_all"),
+            func.count().label("patients"),
+            count_if(value < threshold).label("suppressed"),
+            count_if(value >= threshold).label("unsuppressed"),
+            count_if(or_(parse_status.is_(None), parse_status == "missing")).label("missing"),
+            count_if(parse_status == "unparsed").label("unparsed"),
+            count_if(and_(
+                PatientARTData.art_start_date <= as_of - timedelta(days=VL_FIRST_DUE_DAYS),
+                or_(result_date.is_(None), result_date < as_of - timedelta(days=VL_OVERDUE_DAYS)),
+            )).label("overdue"),
+        ).filter(PatientARTData.voided == False)
+        if state:
+            query = query.filter(PatientARTData.state == state)
+        if datim_code:
+            query = query.filter(facility_condition(datim_code))
+        rows = query.group_by(PatientARTData.facility_id, unregistered_code).all()
+
+        by_code: Dict[Optional[str], Dict[str, Any]] = {}
+        for row in rows:
+            counts = {
+                k: int(v or 0) for k, v in row._mapping.items()
+                if k not in ("facility_id", "datim_code", "facility_name_all")
+            }
+            # Rows of a registered facility still without a facility_id join its entry
+            facility = facility_registry.get_by_id(row.facility_id) or facility_registry.get(row.datim_code)
+            code = facility.datim_code if facility else row.datim_code
+            entry = by_code.setdefault(code, {
+                "datim_code": code,
+                "facility_name_all": facility.facility_name if facility else row.facility_name_all,
+                **{k: 0 for k in counts},
+            })
+            for k, v in counts.items():
+                entry[k] += v
+        facilities = sorted(by_code.values(), key=lambda facility: facility["datim_code"] or "")
+        for facility in facilities:
+            tested = facility["suppressed"] + facility["unsuppressed"]
+            facility["suppression_rate"] = round(facility["suppressed"] / tested, 4) if tested else None
+        return {"as_of": as_of, "threshold": threshold, "facilities": facilities}
+
+
+    # =============================================
+    # DUPLICATE DETECTION
+    # =============================================
+    def build_duplicate_blocks(
+            self,
+            df: pd.DataFrame,
+            max_block_size: int = DUPLICATE_MAX_BLOCK_SIZE,
+        ) -> Tuple[List[Tuple[str, np.ndarray]], int]:
+        """
+        Row positions sharing a blocking key: sex + date_of_birth +
+        art_start_date ("demographic"), or sex + normalized hospital_number
+        ("hospital_number"). Only rows within a block are compared. Returns
+        ((DUPLICATE_BLOCK_FIELDS key, positions) per block, number of
+        oversized blocks skipped).
+        """
+        sex = df["sex"].fillna("").astype(str).str.strip().str.upper().str[:1]
+        date_of_birth = pd.to_datetime(df["date_of_birth"], errors="coerce").dt.strftime("%Y-%m-%d")
+        art_start = pd.to_datetime(df["art_start_date"], errors="coerce").dt.strftime("%Y-%m-%d")
+        demographic = (sex + "|" + date_of_birth + "|" + art_start)[date_of_birth.notna() & art_start.notna()]
+        hospital = (sex + "|" + df["hospital_number_key"])[df["hospital_number_key"] != ""]
+
+        blocks: List[Tuple[str, np.ndarray]] = []
+        skipped = 0
+        for block_key, keys in (("demographic", demographic), ("hospital_number", hospital)):
+            if keys.empty:
+                continue
+            codes = pd.factorize(keys)[0]
+            counts = np.bincount(codes)
+            positions = keys.index.to_numpy()[np.argsort(codes, kind="stable")]
+            for block in np.split(positions, np.cumsum(counts)[:-1]):
+                if len(block) > max_block_size:
+                    skipped += 1
+                elif len(block) > 1:
+                    blocks.append((block_key, block))
+        return blocks, skipped
+
+    def detect_duplicates(
+            self,
+            job_id: Optional[str] = None,
+            threshold: float = DUPLICATE_MATCH_THRESHOLD,
+            max_workers: Optional[int] = None,
+            progress_callback: Optional[Callable[[str, int], None]] = None,
+        ) -> Dict[str, Any]:
+        """
+        Find patient records that are probably the same person, typically
+        re-registered after a transfer. Records are blocked on shared keys,
+        pairs within each block are scored in a process pool, and pairs at or
+        above threshold are joined into clusters. Pending clusters from the
+        previous run are replaced; reviewed clusters are kept and never
+        proposed again with the same members.
+        """
+        df = self.read_patient_columns(DUPLICATE_SOURCE_COLUMNS)
+        if progress_callback:
+            progress_callback("blocking", len(df))
+        # Stored search key, derived the same way for rows the search backfill has not reached
+        missing_key = df["hospital_number_key"].isna()
+        df.loc[missing_key, "hospital_number_key"] = df.loc[missing_key, "hospital_number"].map(normalize_identifier)
+        df["hospital_number_key"] = df["hospital_number_key"].fillna("")
+        blocks, skipped_blocks = self.build_duplicate_blocks(df)
+
+        # Plain tuples for the workers: id, facility (facility_id, datim_code if
+        # unregistered), then fields in DUPLICATE_FIELD_WEIGHTS order
+        def text_key(column: str) -> pd.Series:
+            return (df[column].fillna("").astype(str).str.lower()
+                    .str.replace(r"[^a-z0-9]+", " ", regex=True).str.strip())
+        records = list(zip(
+            df["id"].tolist(),
+            df["facility_id"].astype(object).where(df["facility_id"].notna(), df["datim_code"]).tolist(),
+            pd.to_datetime(df["date_of_birth"], errors="coerce").dt.strftime("%Y-%m-%d").fillna("").tolist(),
+            pd.to_datetime(df["art_start_date"], errors="coerce").dt.strftime("%Y-%m-%d").fillna("").tolist(),
+            df["age_at_art_initiation"].astype(object).where(df["age_at_art_initiation"].notna(), None).tolist(),
+            df["hospital_number_key"].tolist(),
+            text_key("residential_address").tolist(),
+            text_key("current_art_regimen").tolist(),
+        ))
+        tasks = [
+            [(block_key, [records[i] for i in block]) for block_key, block in blocks[start:start + DUPLICATE_BLOCKS_PER_TASK]]
+            for start in range(0, len(blocks), DUPLICATE_BLOCKS_PER_TASK)
+        ]
+
+        pair_scores: Dict[Tuple[int, int], float] = {}
+        comparisons = 0
+
+        def collect(result):
+            nonlocal comparisons
+            pairs, compared = result
+            comparisons += compared
+            for a, b, score in pairs:
+                if score > pair_scores.get((a, b), 0):
+                    pair_scores[(a, b)] = score
+
+        if progress_callback:
+            progress_callback("scoring", 0)
+        if len(tasks) <= 1:
+            for task in tasks:
+                collect(_score_duplicate_blocks(task, threshold))
+        else:
+            workers = max_workers or int(os.getenv("DUPLICATE_MAX_WORKERS", os.cpu_count() or 1))
+            workers = max(1, min(workers, len(tasks)))
+            # spawn so workers never share the parent's pooled connections
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+                futures = [executor.submit(_score_duplicate_blocks, task, threshold) for task in tasks]
+                for done, future in enumerate(as_completed(futures), start=1):
+                    collect(future.result())
+                    if progress_callback:
+                        progress_callback("scoring", done * DUPLICATE_BLOCKS_PER_TASK)
+
+        # Union-find over candidate pairs
+        parent: Dict[int, int] = {}
+
+        def find(x: int) -> int:
+            parent.setdefault(x, x)
+            while parent[x] != x:
+                parent[x] = parent[parent[x]]
+                x = parent[x]
+            return x
+
+        for a, b in pair_scores:
+            root_a, root_b = find(a), find(b)
+            if root_a != root_b:
+                parent[max(root_a, root_b)] = min(root_a, root_b)
+        member_scores: Dict[int, float] = {}
+        for (a, b), score in pair_scores.items():
+            member_scores[a] = max(member_scores.get(a, 0), score)
+            member_scores[b] = max(member_scores.get(b, 0), score)
+        clusters: Dict[int, List[int]] = {}
+        for patient_id in member_scores:
+            clusters.setdefault(find(patient_id), []).append(patient_id)
+
+        if progress_callback:
+            progress_callback("writing", len(df))
+        rows_by_id = df.set_index("id")[["patient_identifier", "datim_code"]]
+        try:
+            reviewed_keys = set(
+                self.db_manager.execute(
+                    select(DuplicateCluster.cluster_key).where(DuplicateCluster.status != "pending")
+                ).scalars().all()
+            )
+            pending_ids = select(DuplicateCluster.id).where(DuplicateCluster.status == "pending")
+            self.db_manager.execute(
+                delete(DuplicateClusterMember).where(DuplicateClusterMember.cluster_id.in_(pending_ids))
+            )
+            self.db_manager.execute(delete(DuplicateCluster).where(DuplicateCluster.status == "pending"))
+
+            new_clusters: List[Tuple[DuplicateCluster, List[int]]] = []
+            for members in clusters.values():
+                members.sort()
+                cluster_key = hashlib.sha1(",".join(map(str, members)).encode()).hexdigest()
+                if cluster_key in reviewed_keys:
+                    continue
+                cluster = DuplicateCluster(
+                    cluster_key=cluster_key,
+                    job_id=job_id,
+                    status="pending",
+                    member_count=len(members),
+                    max_score=max(member_scores[m] for m in members),
+                )
+                self.db_manager.add(cluster)
+                new_clusters.append((cluster, members))
+            self.db_manager.flush()
+
+            member_rows = [
+                {
+                    "cluster_id": cluster.id,
+                    "patient_id": patient_id,
+                    "patient_identifier": rows_by_id.at[patient_id, "patient_identifier"],
+                    "datim_code": rows_by_id.at[patient_id, "datim_code"],
+                    "score": member_scores[patient_id],
+                }
+                for cluster, members in new_clusters
+                for patient_id in members
+            ]
+            for start in range(0, len(member_rows), BULK_IN_CHUNK_SIZE):
+                self.db_manager.connection().execute(
+                    insert(DuplicateClusterMember), member_rows[start:start + BULK_IN_CHUNK_SIZE]
+                )
+            self.db_manager.commit()
+        except Exception:
+            self.db_manager.rollback()
+            raise
+
+        print(f"✓ Duplicate detection: {len(new_clusters)} clusters from {len(df)} patients, "
+              f"{comparisons} comparisons")
+        return {
+            "patients": len(df),
+            "blocks": len(blocks),
+            "skipped_blocks": skipped_blocks,
+            "comparisons": comparisons,
+            "candidate_pairs": len(pair_scores),
+            "clusters": len(new_clusters),
+        }
+
+    def get_duplicate_cluster_response(self, cluster: DuplicateCluster) -> Dict[str, Any]:
+        members = (
+            self.db_manager.query(DuplicateClusterMember, PatientARTData)
+            .outerjoin(PatientARTData, PatientARTData.id == DuplicateClusterMember.patient_id)
+            .filter(DuplicateClusterMember.cluster_id == cluster.id)
+            .order_by(DuplicateClusterMember.patient_id)
+            .all()
+        )
+        return {
+            "id": cluster.id,
+            "status": cluster.status,
+            "member_count": cluster.member_count,
+            "max_score": cluster.max_score,
+            "created_at": cluster.created_at,
+            "reviewed_by": cluster.reviewed_by,
+            "reviewed_at": cluster.reviewed_at,
+            "review_note": cluster.review_note,
+            "members": [
+                {
+                    "patient_id": member.patient_id,
+                    "patient_identifier": member.patient_identifier,
+                    "datim_code": member.datim_code,
+                    "score": member.score,
+                    "facility_name_all": patient.facility_name_all if patient else None,
+                    "hospital_number": patient.hospital_number if patient else None,
+                    "sex": patient.sex if patient else None,
+                    "date_of_birth": patient.date_of_birth if patient else None,
+                    "art_start_date": patient.art_start_date if patient else None,
+                    "last_drug_pick_up_date": patient.last_drug_pick_up_date if patient else None,
+                    "voided": bool(patient.voided) if patient else True,
+                }
+                for member, patient in members
+            ],
+        }
+
+    def get_duplicate_clusters(
+            self,
+            cluster_status: Optional[str] = "pending",
+            datim_code: Optional[str] = None,
+            skip: int = 0,
+            limit: int = 50,
+        ) -> List[Dict[str, Any]]:
+        """Clusters with their members, highest score first, optionally those touching a facility"""
+        query = self.db_manager.query(DuplicateCluster)
+        if cluster_status:
+            query = query.filter(DuplicateCluster.status == cluster_status)
+        if datim_code:
+            query = query.filter(DuplicateCluster.id.in_(
+                select(DuplicateClusterMember.cluster_id).where(DuplicateClusterMember.datim_code == datim_code)
+            ))
+        clusters = (
+            query
+            .order_by(DuplicateCluster.max_score.desc(), DuplicateCluster.id)
+            .offset(skip)
+            .limit(limit)
+            .all()
+        )
+        return [self.get_duplicate_cluster_response(cluster) for cluster in clusters]
+
+    def review_duplicate_cluster(
+            self,
+            cluster_id: int,
+            cluster_status: str,
+            reviewed_by: str,
+            note: Optional[str] = None,
+        ) -> Optional[Dict[str, Any]]:
+        """Record a reviewer's decision on a cluster, None when it does not exist"""
+        try:
+            cluster = self.db_manager.query(DuplicateCluster).filter(DuplicateCluster.id == cluster_id).first()
+            if not cluster:
+                return None
+            cluster.status = cluster_status
+            cluster.reviewed_by = reviewed_by
+            cluster.reviewed_at = datetime.now()
+            cluster.review_note = note
+            self.db_manager.commit()
+            print(f"✓ Duplicate cluster {cluster_id} marked {cluster_status}")
+            return self.get_duplicate_cluster_response(cluster)
+        except Exception as e:
+            self.db_manager.rollback()
+            print(f"✗ Error reviewing duplicate cluster: {str(e)}")
+            raise
+
+
+    # =============================================
+    # DATA QUALITY
+    # =============================================
+    def apply_data_quality_rules(self, df: pd.DataFrame, as_of: date) -> Dict[str, pd.Series]:
+        """Boolean violation mask per DATA_QUALITY_RULES rule, computed column-wise over a batch"""
+        as_of_ts = pd.Timestamp(as_of)
+        # Dates pandas cannot represent (years after 2262) become NaT, so one
+        # bad row is reported by date_out_of_range instead of failing the scan
+        dates = {c: pd.to_datetime(df[c], errors="coerce") for c in DATA_QUALITY_DATE_COLUMNS}
+        date_of_birth = dates["date_of_birth"]
+        art_start = dates["art_start_date"]
+        current_age = pd.to_numeric(df["current_age"])
+        initiation_age = pd.to_numeric(df["age_at_art_initiation"])
+        refills = pd.to_numeric(df["no_of_days_of_refills"])
+
+        def years_between(start: pd.Series, end) -> pd.Series:
+            return (end - start).dt.days / 365.25
+
+        min_date = pd.Timestamp(DATA_QUALITY_MIN_DATE)
+        max_date = as_of_ts + pd.DateOffset(years=1)
+        date_out_of_range = pd.Series(False, index=df.index)
+        for column, parsed in dates.items():
+            date_out_of_range |= (df[column].notna() & parsed.isna()) | (parsed < min_date) | (parsed > max_date)
+
+        datim_code = df["datim_code"].fillna("").astype(str)
+        return {
+            "age_dob_mismatch": (years_between(date_of_birth, as_of_ts) - current_age).abs() > 1,
+            "art_initiation_age_mismatch": (years_between(date_of_birth, art_start) - initiation_age).abs() > 1,
+            "art_start_before_birth": art_start < date_of_birth,
+            "future_pickup_date": (
+                (dates["last_drug_pick_up_date"] > as_of_ts)
+                | (dates["last_drug_art_pick_up_date"] > as_of_ts)
+            ),
+            "refill_days_out_of_range": (refills < 0) | (refills > 180),
+            "invalid_datim_code": ~datim_code.str.match(DATIM_CODE_PATTERN),
+            "date_out_of_range": date_out_of_range,
+        }
+
+    def run_data_quality_scan(
+            self,
+            job_id: str,
+            as_of: Optional[date] = None,
+            batch_size: int = DATA_QUALITY_BATCH_SIZE,
+            progress_callback: Optional[Callable[[str, int], None]] = None,
+        ) -> Dict[str, Any]:
+        """
+        Check every non-voided patient against DATA_QUALITY_RULES, reading
+        the table in keyset batches. Each batch read ends its transaction, so
+        no snapshot or lock is held between batches and memory stays bounded
+        by the batch and the per-facility counters. Results are stored under
+        job_id, one row per facility and rule.
+        """
+        as_of = as_of or date.today()
+        patients_checked: Counter = Counter()
+        violations: Counter = Counter()
+        samples: Dict[Tuple[str, str], List[str]] = {}
+        rows_processed = 0
+        last_id = 0
+
+        while True:
+            batch = self.db_manager.execute(
+                select(PatientARTData.id, *[getattr(PatientARTData, c) for c in DATA_QUALITY_SOURCE_COLUMNS])
+                .where(PatientARTData.voided == False, PatientARTData.id > last_id)
+                .order_by(PatientARTData.id)
+                .limit(batch_size)
+            ).all()
+            self.db_manager.rollback()
+            if not batch:
+                break
+            last_id = batch[-1].id
+            df = pd.DataFrame(batch, columns=["id"] + DATA_QUALITY_SOURCE_COLUMNS)
+            df["datim_code"] = df["datim_code"].fillna("")
+            patients_checked.update(df["datim_code"].value_counts().to_dict())
+
+            for rule, mask in self.apply_data_quality_rules(df, as_of).items():
+                flagged = df.loc[mask.fillna(False).astype(bool), ["datim_code", "patient_identifier"]]
+                if flagged.empty:
+                    continue
+                for datim_code, count in flagged["datim_code"].value_counts().items():
+                    violations[(datim_code, rule)] += int(count)
+                for datim_code, identifiers in flagged.groupby("datim_code")["patient_identifier"]:
+                    kept = samples.setdefault((datim_code, rule), [])
+                    if len(kept) < DATA_QUALITY_SAMPLE_SIZE:
+                        kept.extend(identifiers.head(DATA_QUALITY_SAMPLE_SIZE - len(kept)).tolist())
+
+            rows_processed += len(batch)
+            if progress_callback:
+                progress_callback("scanning", rows_processed)
+
+        rows = [
+            {
+                "job_id": job_id,
+                "datim_code": datim_code,
+                "rule": rule,
+                "patients_checked": checked,
+                "violation_count": violations[(datim_code, rule)],
+                "sample_identifiers": json.dumps(samples.get((datim_code, rule), [])),
+                "created_at": datetime.now(),
+            }
+            for datim_code, checked in sorted(patients_checked.items())
+            for rule in DATA_QUALITY_RULES
+        ]
+        if progress_callback:
+            progress_callback("writing", rows_processed)
+        try:
+            for start in range(0, len(rows), BULK_IN_CHUNK_SIZE):
+                self.db_manager.connection().execute(insert(DataQualityResult), rows[start:start + BULK_IN_CHUNK_SIZE])
+            self.db_manager.commit()
+        except Exception:
+            self.db_manager.rollback()
+            raise
+
+        totals = Counter()
+        for (_, rule), count in violations.items():
+            totals[rule] += count
+        print(f"✓ Data quality scan {job_id}: {rows_processed} patients, {sum(totals.values())} violations")
+        return {
+            "as_of": as_of.isoformat(),
+            "patients": rows_processed,
+            "facilities": len(patients_checked),
+            "violations": {rule: totals[rule] for rule in DATA_QUALITY_RULES},
+        }
+
+    def get_data_quality_report(
+            self,
+            job_id: Optional[str] = None,
+            datim_code: Optional[str] = None,
+            rule: Optional[str] = None,
+        ) -> Optional[Dict[str, Any]]:
+        """
+        Results of a data quality scan (default the latest completed one),
+        per rule and per facility. None when no scan has completed.
+        """
+        job_query = self.db_manager.query(BackgroundJob).filter(
+            BackgroundJob.job_type == "data_quality_scan",
+            BackgroundJob.job_status == "Completed",
+        )
+        if job_id:
+            job_query = job_query.filter(BackgroundJob.job_id == job_id)
+        job = job_query.order_by(BackgroundJob.completed_at.desc(), BackgroundJob.id.desc()).first()
+        if job is None:
+            return None
+
+        query = self.db_manager.query(DataQualityResult).filter(DataQualityResult.job_id == job.job_id)
+        if datim_code:
+            query = query.filter(DataQualityResult.datim_code == datim_code)
+        if rule:
+            query = query.filter(DataQualityResult.rule == rule)
+        results = query.order_by(DataQualityResult.datim_code, DataQualityResult.rule).all()
+
+        rules: Dict[str, int] = {r: 0 for r in DATA_QUALITY_RULES if not rule or r == rule}
+        facilities: Dict[str, Dict[str, Any]] = {}
+        for result in results:
+            rules[result.rule] = rules.get(result.rule, 0) + result.violation_count
+            facility = facilities.setdefault(result.datim_code, {
+                "datim_code": result.datim_code,
+                "patients_checked": result.patients_checked,
+                "violations": {},
+                "sample_identifiers": {},
+            })
+            if result.violation_count:
+                facility["violations"][result.rule] = result.violation_count
+                facility["sample_identifiers"][result.rule] = json.loads(result.sample_identifiers or "[]")
+
+        return {
+            "job_id": job.job_id,
+            "scanned_at": job.completed_at,
+            "parameters": json.loads(job.parameters) if job.parameters else None,
+            "rules": [
+                {"rule": name, "description": DATA_QUALITY_RULES.get(name, ""), "violations": count}
+                for name, count in rules.items()
+            ],
+            "facilities": list(facilities.values()),
+        }
+
+
+    # =============================================
+    # FACILITIES
+    # =============================================
+    def validate_facilities(self, datim_codes: List[Optional[str]]):
+        """422 listing the datim_codes missing from the facility registry, when validation is enforced"""
+        facility_registry.ensure_known(self.db_manager, datim_codes)
+        unknown = sorted({str(code) for code in datim_codes if not facility_registry.is_valid(code)})
+        if unknown:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=f"Unknown datim_code: {', '.join(unknown[:20])}",
+            )
+
+    def get_facilities(self, state: Optional[str] = None, lga: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Active facilities from the registry cache"""
+        facility_registry.ensure_loaded(self.db_manager)
+        return [
+            entry._asdict() for entry in facility_registry.all()
+            if (state is None or entry.state == state) and (lga is None or entry.lga == lga)
+        ]
+
+    def upsert_facilities(self, facilities: List[Dict[str, Any]]) -> int:
+        """
+        Insert or update facilities by datim_code, set facility_id on their
+        existing patients that have none, then reload the registry
+        """
+        try:
+            now = datetime.now()
+            rows = [{**facility, "active": 1, "created_at": now, "updated_at": now} for facility in facilities]
+            self.upsert_rows(
+                Facility, rows,
+                key_columns=["datim_code"],
+                update_columns=["facility_name", "state", "lga", "active", "updated_at"],
+            )
+            ids = self.db_manager.execute(
+                select(Facility.datim_code, Facility.id)
+                .where(Facility.datim_code.in_([row["datim_code"] for row in rows]))
+            ).all()
+            if ids:
+                self.db_manager.connection().execute(
+                    update(PatientARTData)
+                    .where(PatientARTData.datim_code == bindparam("b_datim_code"), PatientARTData.facility_id.is_(None))
+                    .values(facility_id=bindparam("b_facility_id"), updated_at=PatientARTData.updated_at),
+                    [{"b_datim_code": code, "b_facility_id": facility_id} for code, facility_id in ids],
+                )
+            self.db_manager.commit()
+        except Exception as e:
+            self.db_manager.rollback()
+            print(f"✗ Error saving facilities: {str(e)}")
+            raise
+        loaded = facility_registry.load(self.db_manager)
+        print(f"✓ Saved {len(rows)} facilities, {loaded} in registry")
+        return len(rows)
+
+    def refresh_facility_registry(self) -> int:
+        count = facility_registry.load(self.db_manager)
+        print(f"✓ Facility registry reloaded: {count} facilities")
+        return count
+
+    def backfill_facility_ids(
+            self,
+            batch_size: int = FACILITY_BACKFILL_BATCH_SIZE,
+            progress_callback: Optional[Callable[[str, int], None]] = None,
+        ) -> Dict[str, Any]:
+        """
+        Migration to facility_id: add every datim_code found on patients but
+        missing from the facility table (name, state and LGA taken from its
+        patients), then set facility_id on patients without one in keyset
+        batches, committed per batch. version and updated_at are left as they
+        are since nothing the user sees changes.
+        """
+        try:
+            known = select(Facility.datim_code)
+            missing = self.db_manager.execute(
+                select(
+                    PatientARTData.datim_code,
+                    func.max(PatientARTData.facility_name_all),
+                    func.max(PatientARTData.state),
+                    func.max(PatientARTData.lga),
+                )
+                .where(PatientARTData.datim_code.isnot(None), PatientARTData.datim_code.notin_(known))
+                .group_by(PatientARTData.datim_code)
+            ).all()
+            now = datetime.now()
+            if missing:
+                self.db_manager.connection().execute(insert(Facility), [
+                    {"datim_code": code, "facility_name": name, "state": state, "lga": lga,
+                     "active": 1, "created_at": now, "updated_at": now}
+                    for code, name, state, lga in missing
+                ])
+            self.db_manager.commit()
+        except Exception:
+            self.db_manager.rollback()
+            raise
+        facility_registry.load(self.db_manager)
+        ids_by_code = facility_registry.ids_by_code()
+
+        stmt = (
+            update(PatientARTData)
+            .where(PatientARTData.id == bindparam("b_id"))
+            .values(facility_id=bindparam("b_facility_id"), updated_at=PatientARTData.updated_at)
+        )
+        rows_processed = 0
+        unmatched = 0
+        last_id = 0
+        while True:
+            batch = self.db_manager.execute(
+                select(PatientARTData.id, PatientARTData.datim_code)
+                .where(PatientARTData.id > last_id, PatientARTData.facility_id.is_(None))
+                .order_by(PatientARTData.id)
+                .limit(batch_size)
+            ).all()
+            if not batch:
+                break
+            last_id = batch[-1].id
+            params = []
+            for row in batch:
+                facility_id = ids_by_code.get(row.datim_code)
+                if facility_id is None:
+                    unmatched += 1
+                else:
+                    params.append({"b_id": row.id, "b_facility_id": facility_id})
+            try:
+                if params:
+                    self.db_manager.connection().execute(stmt, params)
+                self.db_manager.commit()
+            except Exception:
+                self.db_manager.rollback()
+                raise
+            rows_processed += len(batch)
+            if progress_callback:
+                progress_callback("backfilling", rows_processed)
+
+        print(f"✓ Backfilled facility_id for {rows_processed - unmatched} patients, {len(missing)} facilities added")
+        return {
+            "patients": rows_processed,
+            "facilities_added": len(missing),
+            "unmatched": unmatched,
+        }
+
+
+    # =============================================
+    # SEARCH
+    # =============================================
+    def backfill_search_keys(
+            self,
+            batch_size: int = SEARCH_BACKFILL_BATCH_SIZE,
+            progress_callback: Optional[Callable[[str, int], None]] = None,
+        ) -> Dict[str, Any]:
+        """
+        Set the SEARCH_KEY_FIELDS columns of rows that have none, in keyset
+        batches committed one by one, leaving version and updated_at as they are
+        """
+        stmt = (
+            update(PatientARTData)
+            .where(PatientARTData.id == bindparam("b_id"))
+            .values({
+                **{c: bindparam(f"b_{c}") for c in SEARCH_KEY_FIELDS},
+                "updated_at": PatientARTData.updated_at,
+            })
+        )
+        rows_processed = 0
+        last_id = 0
+        while True:
+            batch = self.db_manager.execute(
+                select(PatientARTData.id, *[getattr(PatientARTData, c) for c in SEARCH_KEY_FIELDS.values()])
+                .where(PatientARTData.id > last_id, PatientARTData.patient_identifier_key.is_(None))
+                .order_by(PatientARTData.id)
+                .limit(batch_size)
+            ).all()
+            if not batch:
+                break
+            last_id = batch[-1].id
+            params = [
+                {
+                    "b_id": row.id,
+                    **{f"b_{c}": normalize_identifier(getattr(row, source)) for c, source in SEARCH_KEY_FIELDS.items()},
+                }
+                for row in batch
+            ]
+            try:
+                self.db_manager.connection().execute(stmt, params)
+                self.db_manager.commit()
+            except Exception:
+                self.db_manager.rollback()
+                raise
+            rows_processed += len(batch)
+            if progress_callback:
+                progress_callback("backfilling", rows_processed)
+
+        print(f"✓ Backfilled search keys for {rows_processed} patients")
+        return {"patients": rows_processed}
+
+    def search_patients(self, query: str, datim_code: str, skip: int = 0, limit: int = 20) -> List[Dict[str, Any]]:
+        """
+        Ranked search within a facility: exact then prefix matches on the
+        normalized patient_identifier and hospital_number, then address
+        matches (MySQL FULLTEXT, LIKE elsewhere). Each kind of match is its
+        own index-backed query limited to its best skip + limit rows; the
+        union is ranked and paginated, then only that page of patients is loaded.
+        """
+        key = normalize_identifier(query)
+        words = query.strip()
+        window = skip + limit
+        scope = and_(facility_condition(datim_code), PatientARTData.voided == False)
+
+        def branch(condition, match: str, rank=None):
+            # Same order as the final ranking, so each branch keeps its best rows.
+            # A constant rank is left out, MySQL reads ORDER BY <integer> as a column position
+            order_by = [PatientARTData.id] if rank is None else [rank.desc(), PatientARTData.id]
+            rank = rank if rank is not None else literal(SEARCH_RANKS[match])
+            return (
+                select(PatientARTData.id.label("id"), rank.label("search_rank"))
+                .where(scope, condition)
+                .order_by(*order_by)
+                .limit(window)
+                .subquery()
+            )
+
+        branches = []
+        if key:
+            # Keys are A-Z0-9 only, nothing to escape
+            prefix = key + "%"
+            branches += [
+                branch(PatientARTData.patient_identifier_key == key, "patient_identifier"),
+                branch(PatientARTData.hospital_number_key == key, "hospital_number"),
+                branch(PatientARTData.patient_identifier_key.like(prefix), "patient_identifier_prefix"),
+                branch(PatientARTData.hospital_number_key.like(prefix), "hospital_number_prefix"),
+            ]
+        if len(words) >= 3:
+            if self.db_manager.get_bind().dialect.name == "mysql":
+                relevance = type_coerce(
+                    mysql_match(PatientARTData.residential_address, against=words).in_natural_language_mode(),
+                    Float,
+                )
+                branches.append(branch(relevance > 0, "residential_address", SEARCH_RANKS["residential_address"] + relevance))
+            else:
+                pattern = "%" + words.replace("%", "").replace("_", "") + "%"
+                branches.append(branch(PatientARTData.residential_address.ilike(pattern), "residential_address"))
+        if not branches:
+            return []
+
+        matches = union_all(*[select(b.c.id, b.c.search_rank) for b in branches]).subquery()
+        best = (
+            select(matches.c.id, func.max(matches.c.search_rank).label("search_rank"))
+            .group_by(matches.c.id)
+            .order_by(func.max(matches.c.search_rank).desc(), matches.c.id)
+            .offset(skip)
+            .limit(limit)
+        )
+        ranked = self.db_manager.execute(best).all()
+        if not ranked:
+            return []
+
+        ids = [row.id for row in ranked]
+        best_rank = {row.id: float(row.search_rank) for row in ranked}
+
+        def matched_on(patient: PatientARTData) -> str:
+            # Same precedence as SEARCH_RANKS
+            if key and patient.patient_identifier_key == key:
+                return "patient_identifier"
+            if key and patient.hospital_number_key == key:
+                return "hospital_number"
+            if key and (patient.patient_identifier_key or "").startswith(key):
+                return "patient_identifier_prefix"
+            if key and (patient.hospital_number_key or "").startswith(key):
+                return "hospital_number_prefix"
+            return "residential_address"
+
+        patients = {
+            patient.id: patient
+            for patient in self.db_manager.query(PatientARTData).filter(PatientARTData.id.in_(ids)).all()
+        }
+        today = date.today()
+        results = []
+        for patient_id in ids:
+            patient = patients[patient_id]
+            patient.clients_current_art_status = self.get_art_outcome(
+                last_pickup_date=patient.last_drug_pick_up_date,
+                days_of_arv_refill=patient.no_of_days_of_refills,
+                ltfu_days=28,
+                end_date=today,
+            )
+            results.append({
+                "search_rank": best_rank[patient_id],
+                "matched_on": matched_on(patient),
+                "patient": patient,
+            })
+        return results
+
+
+    # =============================================
+    # OFFLINE SYNC
+    # =============================================
+    def iter_sync_records(
+            self,
+            datim_code: str,
+            cursor: Optional[str] = None,
+            batch_size: int = SYNC_BATCH_SIZE,
+        ) -> Iterator[Dict[str, Any]]:
+        """
+        Records of a facility sync bundle: a header with the column order,
+        one "patient" record (values in that order) per changed patient,
+        one "tombstone" per patient voided, deleted or moved to another facility
+        since cursor, and an "end" record whose watermark is the cursor of the next
+        sync. Without a cursor every non-voided patient is sent and tombstones
+        are left out. Rows are read in keyset batches on (change_seq, id), like
+        the change feed, up to the change_seq committed when the bundle starts.
+        """
+        position = decode_change_cursor(cursor)
+        full = position is None
+        since_seq = position[0] if position else 0
+        high = self.get_change_sequence()
+        yield {
+            "type": "header",
+            "datim_code": datim_code,
+            "since": cursor or None,
+            "full": full,
+            "generated_at": datetime.now().isoformat(),
+            "columns": SYNC_COLUMNS,
+        }
+
+        selected = [getattr(PatientARTData, c) for c in SYNC_COLUMNS] + [PatientARTData.voided]
+        patients = 0
+        tombstones = 0
+        sent = set()
+        while True:
+            query = select(*selected, PatientARTData.change_seq).where(
+                facility_condition(datim_code),
+                PatientARTData.change_seq <= high,
+            )
+            if full:
+                query = query.where(PatientARTData.voided == False)
+            if position is not None:
+                change_seq, patient_id = position
+                query = query.where(or_(
+                    PatientARTData.change_seq > change_seq,
+                    and_(PatientARTData.change_seq == change_seq, PatientARTData.id > patient_id),
+                ))
+            batch = self.db_manager.execute(
+                query.order_by(PatientARTData.change_seq, PatientARTData.id).limit(batch_size)
+            ).all()
+            # End the read transaction between batches, a slow device must not hold a snapshot
+            self.db_manager.rollback()
+            if not batch:
+                break
+
+            for row in batch:
+                if not full:
+                    sent.add(row.id)
+                if row.voided:
+                    tombstones += 1
+                    yield {
+                        "type": "tombstone",
+                        "id": row.id,
+                        "patient_identifier": row.patient_identifier,
+                        "version": row.version,
+                    }
+                else:
+                    patients += 1
+                    yield {"type": "patient", "values": [_sync_value(v) for v in row[:len(SYNC_COLUMNS)]]}
+            position = (batch[-1].change_seq, batch[-1].id)
+
+        # Patients that left this facility in (since_seq, high]: moved away and
+        # not back (a patient deleted since has only its patient_deletion row), or deleted
+        departures = [
+            (
+                PatientFacilityMove,
+                select(PatientFacilityMove.id, PatientFacilityMove.patient_id,
+                       func.coalesce(PatientARTData.patient_identifier,
+                                     PatientDeletion.patient_identifier).label("patient_identifier"),
+                       func.coalesce(PatientARTData.version, PatientDeletion.version).label("version"))
+                .outerjoin(PatientARTData, PatientARTData.id == PatientFacilityMove.patient_id)
+                .outerjoin(PatientDeletion, PatientDeletion.patient_id == PatientFacilityMove.patient_id)
+                .where(PatientFacilityMove.from_datim_code == datim_code),
+            ),
+            (
+                PatientDeletion,
+                select(PatientDeletion.id, PatientDeletion.patient_id,
+                       PatientDeletion.patient_identifier, PatientDeletion.version)
+                .where(PatientDeletion.datim_code == datim_code),
+            ),
+        ]
+        for table, departed in ([] if full else departures):
+            last_id = 0
+            while True:
+                batch = self.db_manager.execute(
+                    departed
+                    .where(table.change_seq > since_seq, table.change_seq <= high, table.id > last_id)
+                    .order_by(table.id)
+                    .limit(batch_size)
+                ).all()
+                self.db_manager.rollback()
+                if not batch:
+                    break
+                for row in batch:
+                    if row.patient_id in sent or row.patient_identifier is None:
+                        continue
+                    sent.add(row.patient_id)
+                    tombstones += 1
+                    yield {
+                        "type": "tombstone",
+                        "id": row.patient_id,
+                        "patient_identifier": row.patient_identifier,
+                        "version": row.version,
+                    }
+                last_id = batch[-1].id
+
+        # Everything up to high has been read, id 0 resumes after it unless the
+        # last row sent was itself written at high
+        if position is None or position[0] < high:
+            position = (high, 0)
+        yield {
+            "type": "end",
+            "watermark": encode_change_cursor(*position),
+            "patients": patients,
+            "tombstones": tombstones,
+        }
+
+    def apply_sync_edits(
+            self,
+            datim_code: str,
+            edits: List[Tuple[str, Optional[int], Dict[str, Any]]],
+        ) -> Dict[str, Any]:
+        """
+        Apply edits made offline at a facility.
+        Args:
+            edits: (patient_identifier, base_version, changes); base_version is
+                the version the device edited, None for a patient created offline
+        Returns:
+            Counts and one result per edit, in order. status is "applied",
+            "created", "conflict" (with the server's version and current values
+            of the edited fields), "not_found", "wrong_facility" or "rejected".
+        """
+        results: List[Optional[Dict[str, Any]]] = [None] * len(edits)
+
+        # Lock the edited rows so their versions cannot move before the updates commit
+        identifiers = list(dict.fromkeys(identifier for identifier, _, _ in edits))
+        current: Dict[str, PatientARTData] = {}
+        for start in range(0, len(identifiers), BULK_IN_CHUNK_SIZE):
+            for patient in (
+                self.db_manager.query(PatientARTData)
+                .filter(PatientARTData.patient_identifier.in_(identifiers[start:start + BULK_IN_CHUNK_SIZE]))
+                .with_for_update()
+                .all()
+            ):
+                current[patient.patient_identifier] = patient
+
+        updates: List[int] = []
+        creates: List[int] = []
+        for index, (identifier, base_version, changes) in enumerate(edits):
+            patient = current.get(identifier)
+            result = {"patient_identifier": identifier, "status": None, "version": None,
+                      "detail": None, "server_values": None}
+            results[index] = result
+            if patient is None:
+                if base_version is None:
+                    creates.append(index)
+                else:
+                    result.update(status="not_found", detail="Patient does not exist on the server")
+            elif patient.datim_code != datim_code:
+                result.update(status="wrong_facility", detail=f"Patient belongs to {patient.datim_code}")
+            elif patient.voided or base_version != patient.version:
+                result.update(
+                    status="conflict",
+                    version=patient.version,
+                    detail="Patient was voided on the server" if patient.voided
+                           else f"Patient is at version {patient.version} on the server",
+                    server_values={k: _sync_value(getattr(patient, k, None)) for k in changes},
+                )
+            else:
+                updates.append(index)
+
+        if updates:
+            versions = {edits[i][0]: current[edits[i][0]].version for i in updates}
+            # Commits, which releases the row locks
+            applied = self.bulk_update_patients([(edits[i][0], edits[i][2]) for i in updates])
+            for index, bulk_result in zip(updates, applied):
+                version = versions[edits[index][0]]
+                if bulk_result["status"] == "updated":
+                    results[index].update(status="applied", version=version + 1)
+                else:
+                    results[index].update(status=bulk_result["status"], version=version, detail=bulk_result.get("detail"))
+        else:
+            self.db_manager.rollback()
+
+        for index in creates:
+            identifier, _, changes = edits[index]
+            result = results[index]
+            try:
+                payload = PatientARTCreate(**{**changes, "patient_identifier": identifier, "datim_code": datim_code})
+                self.create_patient(payload)
+                result.update(status="created", version=1)
+            except HTTPException as e:
+                if e.status_code == status.HTTP_409_CONFLICT:
+                    result.update(status="conflict", detail="Patient was created on the server in the meantime")
+                else:
+                    result.update(status="rejected", detail=str(e.detail))
+            except ValueError as e:
+                result.update(status="rejected", detail=str(e))
+
+        counts = Counter(result["status"] for result in results)
+        print(f"✓ Sync upload for {datim_code}: {dict(counts)}")
+        return {
+            "applied": counts["applied"],
+            "created": counts["created"],
+            "conflicts": counts["conflict"],
+            "results": results,
+        }
+
+
+    def create_background_job(self, job_type: str, parameters: Dict[str, Any], requested_by: str) -> BackgroundJob:
+        """Register a background job in Processing state"""
+        job = BackgroundJob(
+            job_id=str(uuid.uuid4()),
+            job_type=job_type,
+            requested_by_id=requested_by,
+            job_status="Processing",
+            phase="queued",
+            parameters=json.dumps(parameters, default=str),
+            rows_processed=0,
+        )
+        self.db_manager.add(job)
+        self.db_manager.commit()
+        return job
+
+
+    def get_background_job(self, job_id: str) -> Optional[BackgroundJob]:
+        return self.db_manager.query(BackgroundJob).filter(BackgroundJob.job_id == job_id).first()
+
+
+    def get_background_job_response(self, job: BackgroundJob) -> BackgroundJobResponse:
+        """Serialize a background job with its progress and timings"""
+        def fmt(value: Optional[datetime]) -> Optional[str]:
+            return value.strftime("%Y-%m-%d %H:%M:%S") if value else None
+
+        duration_seconds = None
+        if job.started_at:
+            duration_seconds = round(((job.completed_at or datetime.now()) - job.started_at).total_seconds(), 1)
+
+        return BackgroundJobResponse(
+            job_id=job.job_id,
+            job_type=job.job_type,
+            requested_by=job.requested_by_id,
+            job_status=job.job_status,
+            phase=job.phase,
+            parameters=json.loads(job.parameters) if job.parameters else None,
+            rows_processed=job.rows_processed,
+            total_rows=job.total_rows,
+            result=json.loads(job.result) if job.result else None,
+            error_detail=job.error_detail,
+            created_at=fmt(job.created_at),
+            started_at=fmt(job.started_at),
+            completed_at=fmt(job.completed_at),
+            progress_at=fmt(job.progress_at),
+            duration_seconds=duration_seconds,
+        )
+
+
+    def get_line_list_query(
+            self,
+            datim_code: Optional[str] = None,
+            since: Optional[datetime] = None,
+            state: Optional[str] = None,
+            lga: Optional[str] = None,
+            since_seq: Optional[int] = None,
+        ):
+        """
+        Build the patient query behind every line list export.
+        Full exports only return non-voided rows; delta exports (since given)
+        return everything touched since the watermark, voided rows included.
+        Deltas chained from a previous export pass its watermark_seq as
+        since_seq and select on change_seq, which cannot miss late commits.
+        """
+        if since is not None and since_seq is not None:
+            query = (
+                self.db_manager
+                .query(PatientARTData).filter(PatientARTData.change_seq > since_seq)
+            )
+        elif since is None:
+            # Base query: only non-voided
+            query = (
+                self.db_manager
+                .query(PatientARTData).filter(PatientARTData.voided == False)
+            )
+        else:
+            # Delta query: everything touched since the watermark, voided included
+            query = (
+                self.db_manager
+                .query(PatientARTData).filter(
+                    or_(
+                        PatientARTData.updated_at >= since,
+                        PatientARTData.voided_date >= since,
+                    )
+                )
+            )
+
+        # Optional filters
+        if datim_code:
+            query = query.filter(facility_condition(datim_code))
+        if state:
+            query = query.filter(PatientARTData.state == state)
+        if lga:
+            query = query.filter(PatientARTData.lga == lga)
+
+        return query
+
+
+    def get_line_list_row(self, patient: PatientARTData, since: Optional[datetime] = None) -> Dict[str, Any]:
+        """Build one line list row from an ORM object"""
+        p = patient
+        row = {
+            "state": p.state,
+            "lga": p.lga,
+            "facility_name_all": p.facility_name_all,
+            "datim_code": p.datim_code,
+            "sex": p.sex,
+            "hospital_number": p.hospital_number,
+            "patient_identifier": p.patient_identifier,
+            "current_age": p.current_age,
+            "date_of_birth": p.date_of_birth,
+            "care_entry_point": p.care_entry_point,
+            "art_start_date": p.art_start_date,
+            "age_at_art_initiation": p.age_at_art_initiation,
+            "clients_current_art_status": self.get_art_outcome(
+                last_pickup_date=p.last_drug_pick_up_date,
+                days_of_arv_refill=p.no_of_days_of_refills,
+                ltfu_days=28,
+                end_date=date.today(),
+            ),
+            "educational_status": p.educational_status,
+            "residential_address": p.residential_address,
+            "last_drug_pick_up_date": p.last_drug_pick_up_date,
+            "last_viral_load_result": p.last_viral_load_result,
+            "cd4_test_cd4_result": p.cd4_test_cd4_result,
+            "adherence_outcome_classification": p.adherence_outcome_classification,
+            "marital_status": p.marital_status,
+            "employment_status": p.employment_status,
+            "no_of_days_of_refills": p.no_of_days_of_refills,
+            "who_stage_at_art_start": p.who_stage_at_art_start,
+            "last_drug_art_pick_up_date": p.last_drug_art_pick_up_date,
+            "duration_on_art_months": p.duration_on_art_months,
+            "previous_art_regimen": p.previous_art_regimen,
+            "current_art_regimen": p.current_art_regimen,
+            "current_art_regimen_line": p.current_art_regimen_line,
+            "last_viral_load_sample_collection_date": p.last_viral_load_sample_collection_date,
+            "last_viral_load_result_date": p.last_viral_load_result_date,
+            "cd4_test_sample_collection_date": p.cd4_test_sample_collection_date,
+            "cd4_test_result_date": p.cd4_test_result_date,
+            "date": getattr(p, "date", None),
+            "signature": p.signature,
+            "comment": p.comment,
+            "suggestion": p.suggestion,
+        }
+        if since is not None:
+            row["change_type"] = self.get_change_type(p, since)
+        return row
+
+
+    def iter_line_list_batches(
+            self,
+            datim_code: Optional[str] = None,
+            since: Optional[datetime] = None,
+            state: Optional[str] = None,
+            lga: Optional[str] = None,
+            batch_size: Optional[int] = None,
+            since_seq: Optional[int] = None,
+        ) -> Iterator[pd.DataFrame]:
+        """
+        Stream the line list query in batches of EXPORT_BATCH_SIZE rows.
+        Each batch is a DataFrame in LINE_LIST_COLUMNS order (plus
+        change_type for delta exports), so the full result is never held
+        as ORM objects in memory.
+        """
+        query = self.get_line_list_query(
+            datim_code=datim_code, since=since, state=state, lga=lga, since_seq=since_seq
+        )
+        batch_size = batch_size or EXPORT_BATCH_SIZE
+
+        columns = list(LINE_LIST_COLUMNS)
+        if since is not None:
+            columns.append("change_type")
+
+        rows = iter(query.order_by(PatientARTData.id).yield_per(batch_size))
+        while True:
+            data = [self.get_line_list_row(p, since) for p in islice(rows, batch_size)]
+            if not data:
+                break
+            batch = pd.DataFrame(data, columns=columns)
+            for column in LINE_LIST_INTEGER_COLUMNS:
+                batch[column] = batch[column].astype("Int64")
+            yield batch
+
+
+    def build_line_list_dataframe(
+            self,
+            datim_code: Optional[str] = None,
+            since: Optional[datetime] = None,
+            state: Optional[str] = None,
+            lga: Optional[str] = None,
+            since_seq: Optional[int] = None,
+        ) -> pd.DataFrame:
+        """Run the line list query and return the rows in LINE_LIST_COLUMNS order"""
+        batches = list(self.iter_line_list_batches(
+            datim_code=datim_code, since=since, state=state, lga=lga, since_seq=since_seq
+        ))
+        if not batches:
+            columns = list(LINE_LIST_COLUMNS)
+            if since is not None:
+                columns.append("change_type")
+            return pd.DataFrame(columns=columns)
+        return pd.concat(batches, ignore_index=True)
+
+
+    def build_export_info(
+            self,
+            row_count: int,
+            datim_code: Optional[str] = None,
+            since: Optional[datetime] = None,
+            watermark: Optional[datetime] = None,
+        ) -> pd.DataFrame:
+        """Export metadata, the watermark is what the next delta chains from"""
+        return pd.DataFrame(
+            [
+                ("export_type", "delta" if since is not None else "full"),
+                ("datim_code", datim_code or "ALL"),
+                ("since", since.strftime("%Y-%m-%d %H:%M:%S") if since else ""),
+                ("watermark", watermark.strftime("%Y-%m-%d %H:%M:%S") if watermark else ""),
+                ("row_count", row_count),
+            ],
+            columns=["field", "value"],
+        )
+
+
+    def write_line_list(
+            self,
+            output: BinaryIO,
+            export_format: str = "xlsx",
+            datim_code: Optional[str] = None,
+            since: Optional[datetime] = None,
+            watermark: Optional[datetime] = None,
+            state: Optional[str] = None,
+            lga: Optional[str] = None,
+            include_export_info: bool = True,
+            progress_callback: Optional[Callable[[str, int], None]] = None,
+            since_seq: Optional[int] = None,
+        ) -> Dict[str, int]:
+        """
+        Write the line list to output in the requested format.
+        csv, csv.gz and parquet are written batch by batch as the query
+        streams; xlsx is assembled in memory and limited to XLSX_MAX_ROWS.
+        progress_callback, when given, is called with (phase, rows processed)
+        as batches are written.
+        Returns:
+            Dict[str, int]: row counts by ART status
+        """
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError(f"Unsupported export format: {export_format}")
+
+        status_counts: Dict[str, int] = {}
+        batches = self.iter_line_list_batches(
+            datim_code=datim_code, since=since, state=state, lga=lga, since_seq=since_seq
+        )
+
+        def count_statuses(batch: pd.DataFrame):
+            for art_status, count in batch["clients_current_art_status"].value_counts().items():
+                status_counts[art_status] = status_counts.get(art_status, 0) + int(count)
+            if progress_callback:
+                progress_callback("writing", sum(status_counts.values()))
+
+        if export_format == "xlsx":
+            df = self.build_line_list_dataframe(
+                datim_code=datim_code, since=since, state=state, lga=lga, since_seq=since_seq
+            )
+            if len(df) > XLSX_MAX_ROWS:
+                raise ValueError(
+                    f"{len(df)} rows exceed the xlsx limit of {XLSX_MAX_ROWS}, use csv, csv.gz or parquet"
+                )
+            count_statuses(df)
+            with pd.ExcelWriter(output, engine="openpyxl") as writer:
+                df.to_excel(writer, index=False, sheet_name="Patient Line List")
+                if include_export_info:
+                    export_info = self.build_export_info(len(df), datim_code, since, watermark)
+                    export_info.to_excel(writer, index=False, sheet_name="Export Info")
+
+        elif export_format in ("csv", "csv.gz"):
+            if export_format == "csv.gz":
+                stream = gzip.GzipFile(fileobj=output, mode="wb")
+            else:
+                stream = output
+            text_stream = TextIOWrapper(stream, encoding="utf-8", newline="")
+            try:
+                header = True
+                for batch in batches:
+                    count_statuses(batch)
+                    batch.to_csv(text_stream, index=False, header=header, date_format="%Y-%m-%d")
+                    header = False
+                if header:
+                    # No rows, still write the header line
+                    columns = list(LINE_LIST_COLUMNS) + (["change_type"] if since is not None else [])
+                    pd.DataFrame(columns=columns).to_csv(text_stream, index=False)
+                text_stream.flush()
+            finally:
+                # Detach so closing the wrapper does not close the caller's buffer
+                text_stream.detach()
+                if export_format == "csv.gz":
+                    stream.close()
+
+        else:
+            try:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+            except ImportError:
+                raise ValueError("Parquet export requires the pyarrow package")
+
+            schema = self.get_line_list_arrow_schema(pa, since is not None)
+            if include_export_info:
+                schema = schema.with_metadata({
+                    "export_type": "delta" if since is not None else "full",
+                    "datim_code": datim_code or "ALL",
+                    "since": since.strftime("%Y-%m-%d %H:%M:%S") if since else "",
+                    "watermark": watermark.strftime("%Y-%m-%d %H:%M:%S") if watermark else "",
+                })
+            with pq.ParquetWriter(output, schema, compression="snappy") as writer:
+                for batch in batches:
+                    count_statuses(batch)
+                    writer.write_table(pa.Table.from_pandas(batch, schema=schema, preserve_index=False))
+
+        return status_counts
+
+
+    def get_line_list_arrow_schema(self, pa, include_change_type: bool = False):
+        """Fixed Arrow schema for parquet exports so every batch has the same types"""
+        fields = []
+        for column in LINE_LIST_COLUMNS:
+            if column in LINE_LIST_INTEGER_COLUMNS:
+                fields.append(pa.field(column, pa.int64()))
+            elif column in LINE_LIST_DATE_COLUMNS:
+                fields.append(pa.field(column, pa.date32()))
+            else:
+                fields.append(pa.field(column, pa.string()))
+        if include_change_type:
+            fields.append(pa.field("change_type", pa.string()))
+        return pa.schema(fields)
+
+    
+    def generate_patient_line_list(
+            self,  
+            datim_code: Optional[str] = None,
+            since: Optional[datetime] = None,
+            watermark: Optional[datetime] = None,
+            state: Optional[str] = None,
+            export_format: str = "xlsx",
+            progress_callback: Optional[Callable[[str, int], None]] = None,
+            since_seq: Optional[int] = None,
+        ) -> BytesIO:
+        """
+        Generate patient line list from the database.
+        Args:
+            datim_code (str, optional): Filter by facility DATIM code
+            since (datetime, optional): Only export rows created, updated or
+                voided at or after this time (delta export). Voided rows are
+                included and a change_type column is added.
+            watermark (datetime, optional): Time the export was taken, written
+                to the "Export Info" sheet
+            state (str, optional): Filter by state
+            export_format (str): One of EXPORT_FORMATS (xlsx, csv, csv.gz, parquet)
+            progress_callback (callable, optional): Called with (phase, rows processed)
+            since_seq (int, optional): watermark_seq of the export a delta chains
+                from, rows are then selected on change_seq instead of since
+        Returns:
+            BytesIO: An in-memory file containing the line list
+        """
+        try:
+            output = BytesIO()
+            self.write_line_list(
+                output,
+                export_format=export_format,
+                datim_code=datim_code,
+                since=since,
+                watermark=watermark,
+                state=state,
+                progress_callback=progress_callback,
+                since_seq=since_seq,
+            )
+            output.seek(0)
+
+            return output
+        except Exception as e:
+            print(f"✗ Error generating patient line list: {str(e)}")
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail=f"Error generating patient line list -> {str(e)}",
+            )
+
+
+    def get_partition_values(
+            self,
+            partition_by: str,
+            datim_code: Optional[str] = None,
+            since: Optional[datetime] = None,
+            state: Optional[str] = None,
+            since_seq: Optional[int] = None,
+        ) -> List[str]:
+        """Distinct datim_code or lga values covered by a partitioned export"""
+        partition_column = getattr(PatientARTData, partition_by)
+        query = self.get_line_list_query(datim_code=datim_code, since=since, state=state, since_seq=since_seq)
+        rows = (
+            query
+            .with_entities(partition_column)
+            .distinct()
+            .order_by(partition_column)
+            .all()
+        )
+        return [value for (value,) in rows if value is not None]
+
+
+    def generate_partitioned_line_list(
+            self,
+            partition_by: str = "datim_code",
+            partition_output: str = "zip",
+            datim_code: Optional[str] = None,
+            since: Optional[datetime] = None,
+            watermark: Optional[datetime] = None,
+            state: Optional[str] = None,
+            max_workers: Optional[int] = None,
+            export_format: str = "xlsx",
+            progress_callback: Optional[Callable[[str, int], None]] = None,
+            since_seq: Optional[int] = None,
+        ) -> BytesIO:
+        """
+        Generate one line list per facility (datim_code) or per LGA.
+        Each partition is queried and built in its own worker process.
+        Args:
+            partition_by (str): "datim_code" or "lga"
+            partition_output (str): "zip" for a zip of per-partition files,
+                "sheets" for one workbook with a sheet per partition
+            export_format (str): Format of the per-partition files in a zip,
+                "sheets" output is always xlsx
+            progress_callback (callable, optional): Called with (phase, rows
+                processed) as each partition finishes
+            max_workers (int, optional): Worker processes, defaults to
+                EXPORT_MAX_WORKERS or the number of CPUs
+            since_seq (int, optional): As for generate_patient_line_list
+        Returns:
+            BytesIO: The zip archive or workbook, both with a summary of
+                counts by ART status per partition
+        """
+        try:
+            if partition_by not in PARTITION_COLUMNS:
+                raise ValueError(f"Unsupported partition column: {partition_by}")
+            if partition_output not in ("zip", "sheets"):
+                raise ValueError(f"Unsupported partition output: {partition_output}")
+            if partition_output == "sheets" and export_format != "xlsx":
+                raise ValueError("Sheet per partition output is only available as xlsx")
+
+            partition_values = self.get_partition_values(
+                partition_by, datim_code=datim_code, since=since, state=state, since_seq=since_seq
+            )
+
+            results = []
+            if partition_values:
+                workers = max_workers or int(os.getenv("EXPORT_MAX_WORKERS", os.cpu_count() or 1))
+                workers = max(1, min(workers, len(partition_values)))
+
+                # spawn so workers never share the parent's pooled connections
+                with ProcessPoolExecutor(
+                    max_workers=workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                ) as executor:
+                    futures = [
+                        executor.submit(
+                            _build_line_list_partition,
+                            partition_by,
+                            value,
+                            partition_output,
+                            datim_code,
+                            since,
+                            state,
+                            export_format,
+                            since_seq,
+                        )
+                        for value in partition_values
+                    ]
+                    rows_processed = 0
+                    for future in as_completed(futures):
+                        _, _, status_counts, _ = future.result()
+                        rows_processed += sum(status_counts.values())
+                        if progress_callback:
+                            progress_callback("writing", rows_processed)
+                    # keep partitions in sorted order
+                    results = [future.result() for future in futures]
+
+                self.worker_peak_memory_kb = max(result[3] for result in results)
+
+            summary = self.build_partition_summary(partition_by, results)
+            export_info = self.build_export_info(int(summary["total"].sum()) if len(summary) else 0, datim_code, since, watermark)
+
+            output = BytesIO()
+            if partition_output == "zip":
+                with zipfile.ZipFile(output, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+                    used_names = set()
+                    for value, content, _, _ in results:
+                        file_name = _safe_file_name(value)
+                        while file_name in used_names:
+                            file_name += "_"
+                        used_names.add(file_name)
+                        archive.writestr(f"patient_line_list_{file_name}.{export_format}", content)
+
+                    summary_file = BytesIO()
+                    with pd.ExcelWriter(summary_file, engine="openpyxl") as writer:
+                        summary.to_excel(writer, index=False, sheet_name="Summary")
+                        export_info.to_excel(writer, index=False, sheet_name="Export Info")
+                    archive.writestr("summary.xlsx", summary_file.getvalue())
+            else:
+                with pd.ExcelWriter(output, engine="openpyxl") as writer:
+                    summary.to_excel(writer, index=False, sheet_name="Summary")
+                    export_info.to_excel(writer, index=False, sheet_name="Export Info")
+                    used_names = {"Summary", "Export Info"}
+                    for value, content, _, _ in results:
+                        content.to_excel(writer, index=False, sheet_name=_sheet_name(value, used_names))
+            output.seek(0)
+
+            return output
+        except Exception as e:
+            print(f"✗ Error generating partitioned patient line list: {str(e)}")
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail=f"Error generating partitioned patient line list -> {str(e)}",
+            )
+
+
+    def build_partition_summary(self, partition_by: str, results) -> pd.DataFrame:
+        """Counts by ART status for each partition, one row per partition"""
+        rows = []
+        for value, _, status_counts, _ in results:
+            row = {partition_by: value}
+            row.update({art_status: status_counts.get(art_status, 0) for art_status in ART_STATUSES})
+            row["total"] = sum(status_counts.values())
+            rows.append(row)
+        return pd.DataFrame(rows, columns=[partition_by, *ART_STATUSES, "total"])
+        
+
+    def get_patient_changes(
+            self,
+            cursor: Optional[str] = None,
+            limit: int = 1000,
+            datim_code: Optional[str] = None,
+        ) -> Dict[str, Any]:
+        """
+        Next batch of the patient change feed after cursor, ordered by (change_seq, id).
+        Rows are returned as stored, voided ones included, and hard-deleted patients
+        as "deleted" entries from patient_deletion. change_seq is handed out in
+        commit order, so no transaction can commit behind the cursor.
+        Returns:
+            {"changes": [...], "next_cursor": str, "has_more": bool}
+        """
+        position = decode_change_cursor(cursor)
+        limit = max(1, min(limit, CHANGE_FEED_MAX_LIMIT))
+
+        query = self.db_manager.query(PatientARTData)
+        deletions = self.db_manager.query(PatientDeletion)
+        if position is not None:
+            change_seq, patient_id = position
+            query = query.filter(or_(
+                PatientARTData.change_seq > change_seq,
+                and_(PatientARTData.change_seq == change_seq, PatientARTData.id > patient_id),
+            ))
+            deletions = deletions.filter(or_(
+                PatientDeletion.change_seq > change_seq,
+                and_(PatientDeletion.change_seq == change_seq, PatientDeletion.patient_id > patient_id),
+            ))
+        if datim_code:
+            query = query.filter(facility_condition(datim_code))
+            deletions = deletions.filter(PatientDeletion.datim_code == datim_code)
+
+        changes = []
+        for patient in query.order_by(PatientARTData.change_seq, PatientARTData.id).limit(limit + 1):
+            if patient.voided:
+                change_type = "voided"
+            elif patient.version == 1:
+                change_type = "created"
+            else:
+                change_type = "updated"
+            changes.append((patient.change_seq, patient.id, {
+                "change_type": change_type,
+                **{c.name: getattr(patient, c.name) for c in PatientARTData.__table__.columns},
+            }))
+        for deletion in deletions.order_by(PatientDeletion.change_seq, PatientDeletion.patient_id).limit(limit + 1):
+            changes.append((deletion.change_seq, deletion.patient_id, {
+                "change_type": "deleted",
+                "id": deletion.patient_id,
+                "patient_identifier": deletion.patient_identifier,
+                "datim_code": deletion.datim_code,
+                "version": deletion.version,
+                "change_seq": deletion.change_seq,
+                "deleted_at": deletion.deleted_at,
+            }))
+
+        # Merge both keysets, each already limited to limit + 1
+        changes.sort(key=lambda change: change[:2])
+        has_more = len(changes) > limit
+        changes = changes[:limit]
+
+        if changes:
+            next_cursor = encode_change_cursor(changes[-1][0], changes[-1][1])
+        else:
+            next_cursor = cursor or ""
+        return {"changes": [change for _, _, change in changes], "next_cursor": next_cursor, "has_more": has_more}
+
+
+    def get_change_type(self, patient: PatientARTData, since: datetime) -> str:
+        """Classify a delta export row as created, updated or voided"""
+        if patient.voided:
+            return "voided"
+        if patient.created_at is not None and patient.created_at >= since:
+            return "created"
+        return "updated"
+
+
+    def get_line_list_request(self, request_id: str) -> Optional[LineListRequest]:
+        """Fetch a single line list export request by its request id"""
+        return (
+            self.db_manager
+            .query(LineListRequest)
+            .options(defer(LineListRequest.file_data))
+            .filter(LineListRequest.request_id == request_id)
+            .first()
+        )
+        
+
+    def get_line_list_requests_by_id(self, request_ids: List[str]) -> List[LineListRequest]:
+        """Fetch several line list requests in one query, file blobs excluded"""
+        return (
+            self.db_manager
+            .query(LineListRequest)
+            .options(defer(LineListRequest.file_data))
+            .filter(LineListRequest.request_id.in_(request_ids))
+            .all()
+        )
+
+
+    def get_line_list_request_response(self, req: LineListRequest) -> LineListRequestResponse:
+        """Serialize a line list request with its progress and timings"""
+        def fmt(value: Optional[datetime]) -> Optional[str]:
+            return value.strftime("%Y-%m-%d %H:%M:%S") if value else None
+
+        duration_seconds = None
+        if req.started_at:
+            duration_seconds = round(((req.completed_at or datetime.now()) - req.started_at).total_seconds(), 1)
+
+        return LineListRequestResponse(
+            request_id=req.request_id,
+            requested_by=req.requested_by_id,
+            request_date=fmt(req.request_date),
+            request_status=req.request_status,
+            datim_code=req.datim_code,
+            since=fmt(req.since),
+            watermark=fmt(req.watermark),
+            export_format=req.export_format,
+            phase=req.phase,
+            rows_processed=req.rows_processed,
+            started_at=fmt(req.started_at),
+            completed_at=fmt(req.completed_at),
+            progress_at=fmt(req.progress_at),
+            duration_seconds=duration_seconds,
+            peak_memory_kb=req.peak_memory_kb,
+            file_size=req.file_size,
+            error_detail=req.error_detail,
+        )
+
+
+    def get_line_list_requests(self, skip, limit) -> List["LineListRequestResponse"]:
+        """
+        Fetch all line list export requests from the database,
+        ordered by most recent request date.
+        """
+        try:
+            line_list_data = (
+                self.db_manager
+                .query(LineListRequest)
+                .options(defer(LineListRequest.file_data))
+                .order_by(LineListRequest.request_date.desc())
+                .offset(skip)
+                .limit(limit)
+                .all()
+            )
+
+            line_list_requests = [
+                self.get_line_list_request_response(req)
+                for req in line_list_data
+            ]
+
+            return line_list_requests
+        except Exception as e:
             print(f"✗ Error fetching line list requests: {str(e)}")
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
@@ -636,44 +3930,7 @@ class PatientARTCRUD:
             BytesIO: in-memory Excel file with headers and styling.
         """
         try:
-            columns = [
-                "state",
-                "lga",
-                "facility_name_all",
-                "datim_code",
-                "sex",
-                "hospital_number",
-                "patient_identifier",
-                "current_age",
-                "date_of_birth",
-                "care_entry_point",
-                "art_start_date",
-                "age_at_art_initiation",
-                "clients_current_art_status",
-                "educational_status",
-                "residential_address",
-                "last_drug_pick_up_date",
-                "last_viral_load_result",
-                "cd4_test_cd4_result",
-                "adherence_outcome_classification",
-                "marital_status",
-                "employment_status",
-                "no_of_days_of_refills",
-                "who_stage_at_art_start",
-                "last_drug_art_pick_up_date",
-                "duration_on_art_months",
-                "previous_art_regimen",
-                "current_art_regimen",
-                "current_art_regimen_line",
-                "last_viral_load_sample_collection_date",
-                "last_viral_load_result_date",
-                "cd4_test_sample_collection_date",
-                "cd4_test_result_date",
-                "date",
-                "signature",
-                "comment",
-                "suggestion",
-            ]
+            columns = LINE_LIST_COLUMNS
 
             # Empty DataFrame with headers
             df = pd.DataFrame(columns=columns)
@@ -718,4 +3975,354 @@ class PatientARTCRUD:
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                 detail=f"Error generating patient line list template -> {e}",
-            )
\ No newline at end of file
+            )
+
+
+
+# =============================================
+# EXPORT JOB PROGRESS
+# =============================================
+def peak_memory_kb() -> Optional[int]:
+    """
+    Peak resident memory of the current process over its whole lifetime in
+    KB (None where unsupported). Only meaningful for per-job processes such
+    as the partitioned export workers, use MemorySampler in the web worker.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and KB on Linux
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def current_rss_kb() -> Optional[int]:
+    """Current resident memory of this process in KB (None where /proc is unavailable)"""
+    try:
+        with open("/proc/self/statm") as statm:
+            resident_pages = int(statm.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") // 1024
+
+
+class MemorySampler:
+    """
+    Peak growth of this process's resident memory while a job runs, sampled
+    from a daemon thread every interval seconds. ru_maxrss cannot be used in
+    the web worker: it is the high-water mark of the process's whole
+    lifetime, so every job after a large one would report that job's peak.
+    Concurrent jobs in the same process are counted in each other's growth.
+    """
+    def __init__(self, interval: float = 0.2):
+        self.interval = interval
+        self._baseline: Optional[int] = None
+        self._peak: Optional[int] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._baseline = self._peak = current_rss_kb()
+        if self._baseline is None:
+            return
+        self._thread = threading.Thread(target=self._run, name="memory-sampler", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def _sample(self):
+        rss = current_rss_kb()
+        if rss is not None and rss > (self._peak or 0):
+            self._peak = rss
+
+    def peak_kb(self) -> Optional[int]:
+        """Peak growth over the baseline so far, None if unsupported or not started"""
+        if self._baseline is None:
+            return None
+        self._sample()
+        return self._peak - self._baseline
+
+    def stop(self) -> Optional[int]:
+        self._stop.set()
+        return self.peak_kb()
+
+
+class ExportProgressTracker:
+    """
+    Records phase, rows processed, timings, peak memory and failures for a
+    line list request. Writes go through their own short sessions so they
+    never share a connection with the streaming export query, and row
+    updates are throttled to one every min_interval seconds. Every write is
+    also published to export_events for Server-Sent Events subscribers.
+    """
+    def __init__(self, db_session_factory, request_id: str, min_interval: float = 1.0):
+        self.db_session_factory = db_session_factory
+        self.request_id = request_id
+        self.min_interval = min_interval
+        self.phase: Optional[str] = None
+        self.rows_processed = 0
+        self.memory = MemorySampler()
+        self._last_write = 0.0
+
+    def _publish(self, event: str, **values):
+        export_events.publish(self.request_id, {
+            "event": event,
+            "request_status": values.get("request_status", "Processing"),
+            "phase": self.phase,
+            "rows_processed": self.rows_processed,
+            **{k: v for k, v in values.items() if k in ("file_size", "error_detail")},
+        })
+
+    def _write(self, **values):
+        values["progress_at"] = datetime.now()
+        self._publish("failed" if values.get("request_status") == "Failed" else "progress", **values)
+        db: Session = self.db_session_factory()
+        try:
+            db.execute(
+                update(LineListRequest)
+                .where(LineListRequest.request_id == self.request_id)
+                .values(**values)
+            )
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            print(f"✗ Error recording export progress for {self.request_id}: {str(e)}")
+        finally:
+            db.close()
+        self._last_write = time.monotonic()
+
+    def start(self):
+        self.phase = "querying"
+        self.memory.start()
+        self._write(phase=self.phase, rows_processed=0, started_at=datetime.now(), error_detail=None)
+
+    def set_phase(self, phase: str):
+        self.phase = phase
+        self._write(phase=phase, rows_processed=self.rows_processed)
+
+    def update(self, phase: str, rows_processed: int):
+        """progress_callback for the line list writers"""
+        self.rows_processed = rows_processed
+        if phase != self.phase:
+            self.set_phase(phase)
+        elif time.monotonic() - self._last_write >= self.min_interval:
+            self._write(rows_processed=rows_processed)
+
+    def complete(self, file_size: int):
+        """Publish completion, the request row itself is stored by the export task"""
+        self.phase = "done"
+        self.memory.stop()
+        self._publish("completed", request_status="Completed", file_size=file_size)
+
+    def fail(self, error: Exception):
+        self._write(
+            request_status="Failed",
+            completed_at=datetime.now(),
+            rows_processed=self.rows_processed,
+            peak_memory_kb=self.memory.stop(),
+            error_detail=f"{type(error).__name__}: {error}"[:5000],
+        )
+
+
+class BackgroundJobTracker:
+    """
+    Records phase, progress, result and failures of a BackgroundJob through
+    short sessions of its own, row updates throttled to one every
+    min_interval seconds.
+    """
+    def __init__(self, db_session_factory, job_id: str, min_interval: float = 1.0):
+        self.db_session_factory = db_session_factory
+        self.job_id = job_id
+        self.min_interval = min_interval
+        self.phase: Optional[str] = None
+        self.rows_processed = 0
+        self._last_write = 0.0
+
+    def _write(self, **values):
+        values["progress_at"] = datetime.now()
+        db: Session = self.db_session_factory()
+        try:
+            db.execute(
+                update(BackgroundJob)
+                .where(BackgroundJob.job_id == self.job_id)
+                .values(**values)
+            )
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            print(f"✗ Error recording job progress for {self.job_id}: {str(e)}")
+        finally:
+            db.close()
+        self._last_write = time.monotonic()
+
+    def start(self, phase: str, total_rows: Optional[int] = None):
+        self.phase = phase
+        self._write(phase=phase, rows_processed=0, total_rows=total_rows, started_at=datetime.now())
+
+    def set_total_rows(self, total_rows: Optional[int]):
+        self._write(total_rows=total_rows)
+
+    def update(self, phase: str, rows_processed: int):
+        """progress_callback for long running operations"""
+        self.rows_processed = rows_processed
+        if phase != self.phase:
+            self.phase = phase
+            self._write(phase=phase, rows_processed=rows_processed)
+        elif time.monotonic() - self._last_write >= self.min_interval:
+            self._write(rows_processed=rows_processed)
+
+    def complete(self, result: Optional[Dict[str, Any]] = None):
+        self.phase = "done"
+        self._write(
+            job_status="Completed",
+            phase="done",
+            rows_processed=self.rows_processed,
+            completed_at=datetime.now(),
+            result=json.dumps(result, default=str) if result is not None else None,
+        )
+
+    def fail(self, error: Exception):
+        self._write(
+            job_status="Failed",
+            completed_at=datetime.now(),
+            rows_processed=self.rows_processed,
+            error_detail=f"{type(error).__name__}: {error}"[:5000],
+        )
+
+
+# =============================================
+# PARTITIONED EXPORT WORKERS
+# =============================================
+_worker_db_manager = None
+
+def _build_line_list_partition(
+    partition_by: str,
+    partition_value: str,
+    partition_output: str,
+    datim_code: Optional[str] = None,
+    since: Optional[datetime] = None,
+    state: Optional[str] = None,
+    export_format: str = "xlsx",
+    since_seq: Optional[int] = None,
+):
+    """
+    Runs in a worker process: query one partition and build its output.
+    Returns (partition_value, file bytes or DataFrame, counts by ART status,
+    peak memory of the worker in KB).
+    """
+    global _worker_db_manager
+    if _worker_db_manager is None:
+        from .db_models import DatabaseManager
+        _worker_db_manager = DatabaseManager()
+
+    db = _worker_db_manager.get_session()
+    try:
+        patient_manager = PatientARTCRUD(db_manager=db)
+        filters = dict(
+            datim_code=partition_value if partition_by == "datim_code" else datim_code,
+            lga=partition_value if partition_by == "lga" else None,
+            since=since,
+            state=state,
+            since_seq=since_seq,
+        )
+
+        if partition_output == "sheets":
+            df = patient_manager.build_line_list_dataframe(**filters)
+            status_counts = df["clients_current_art_status"].value_counts().to_dict()
+            return partition_value, df, status_counts, peak_memory_kb()
+
+        output = BytesIO()
+        status_counts = patient_manager.write_line_list(
+            output,
+            export_format=export_format,
+            include_export_info=False,
+            **filters,
+        )
+        return partition_value, output.getvalue(), status_counts, peak_memory_kb()
+    finally:
+        db.close()
+
+
+# =============================================
+# DUPLICATE DETECTION WORKERS
+# =============================================
+def _duplicate_pair_score(a: tuple, b: tuple, threshold: float, block_fields: Tuple[str, ...] = ()) -> float:
+    """
+    Weighted similarity of two records laid out as (id, facility,
+    *DUPLICATE_FIELD_WEIGHTS fields), over the fields present on both and
+    not in block_fields, which the pair shares by construction.
+    Hospital numbers are issued per facility: different ones at the same
+    facility are different patients, at different facilities they are not
+    evidence either way. Exact fields are scored first and fuzzy matching
+    is skipped once the threshold is out of reach.
+    """
+    matched = 0.0
+    total = 0.0
+    fuzzy = []
+    same_facility = a[1] == b[1]
+    for index, (field, weight) in enumerate(DUPLICATE_FIELD_WEIGHTS, start=2):
+        x, y = a[index], b[index]
+        if x in (None, "") or y in (None, ""):
+            continue
+        if field == "hospital_number" and x != y:
+            if same_facility:
+                return 0.0
+            continue
+        if field in block_fields:
+            continue
+        total += weight
+        if x == y:
+            matched += weight
+        elif field in ("hospital_number", "residential_address", "current_art_regimen"):
+            fuzzy.append((weight, x, y))
+    if total < DUPLICATE_MIN_COMPARED_WEIGHT:
+        return 0.0
+    remaining = sum(weight for weight, _, _ in fuzzy)
+    for weight, x, y in fuzzy:
+        if (matched + remaining) / total < threshold:
+            return 0.0
+        matched += weight * SequenceMatcher(None, x, y).ratio()
+        remaining -= weight
+    return matched / total
+
+
+def _score_duplicate_blocks(
+        blocks: List[Tuple[str, List[tuple]]],
+        threshold: float,
+    ) -> Tuple[List[Tuple[int, int, float]], int]:
+    """
+    Runs in a worker process: compare every pair within each
+    (DUPLICATE_BLOCK_FIELDS key, records) block. Returns ((lower id,
+    higher id, score) for pairs at or above threshold, number of comparisons).
+    """
+    pairs = []
+    comparisons = 0
+    for block_key, block in blocks:
+        block_fields = DUPLICATE_BLOCK_FIELDS[block_key]
+        for i in range(len(block)):
+            for j in range(i + 1, len(block)):
+                comparisons += 1
+                score = _duplicate_pair_score(block[i], block[j], threshold, block_fields)
+                if score >= threshold:
+                    a, b = sorted((block[i][0], block[j][0]))
+                    pairs.append((a, b, round(score, 4)))
+    return pairs, comparisons
+
+
+def _safe_file_name(value: str) -> str:
+    """Make a partition value safe to use in a file name"""
+    return re.sub(r"[^A-Za-z0-9_-]+", "_", str(value)).strip("_") or "unknown"
+
+
+def _sheet_name(value: str, used_names: set) -> str:
+    """Excel sheet names are limited to 31 chars, unique, and exclude []:*?/\\"""
+    base = re.sub(r"[\[\]:*?/\\]", "_", str(value))[:31] or "unknown"
+    name, suffix = base, 1
+    while name in used_names:
+        suffix += 1
+        name = f"{base[:31 - len(str(suffix)) - 1]}~{suffix}"
+    used_names.add(name)
+    return name
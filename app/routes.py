@@ -1,20 +1,120 @@
-from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, BackgroundTasks, Query
-from fastapi.responses import FileResponse, StreamingResponse
+from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, BackgroundTasks, Query, Request, Response, Header
+from starlette.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from fastapi.encoders import jsonable_encoder
 from sqlalchemy.orm import Session
-from .schemas import PatientARTResponse, PatientARTUpdate, PatientARTCreate, LineListRequestResponse
-from .db_models import DatabaseManager, LineListRequest
-from .repo import PatientARTCRUD
-from typing import List, Optional
-from datetime import datetime
-import uuid, os
+from sqlalchemy.ext.asyncio import AsyncSession
+from .schemas import (
+    PatientARTResponse, PatientARTUpdate, PatientARTCreate, LineListRequestResponse,
+    PatientBulkUpdateItem, PatientBulkUpdateResponse, PatientBulkFilter, BackgroundJobResponse,
+    PatientChangeLogResponse, PatientARTAsOfResponse, PatientChangeFeedResponse,
+    RetentionSummaryResponse, ArtStatusTrendResponse, ArtStatusTransitionCount, RetentionCohortResponse,
+    ViralLoadSuppressionResponse, DuplicateClusterResponse, DuplicateClusterReview,
+    DataQualityReportResponse, FacilityBase, FacilityResponse, PatientSearchResult,
+    PatientSyncUpload, PatientSyncUploadResponse,
+)
+from .db_models import DatabaseManager, AsyncDatabaseManager, LineListRequest, PatientARTData
+from .async_repo import AsyncPatientARTCRUD
+from .events import export_events, TERMINAL_STATUSES
+from .jobs import run_job
+from .repo import (
+    PatientARTCRUD, ExportProgressTracker, BackgroundJobTracker,
+    make_patient_etag, parse_etag_version, etag_matches, facility_condition,
+    EXPORT_FORMATS, ZIP_MEDIA_TYPE, DELETE_CHUNK_SIZE, DELETE_PAUSE_SECONDS, VL_SUPPRESSION_THRESHOLD,
+    DUPLICATE_MATCH_THRESHOLD, DATA_QUALITY_RULES, SEARCH_MAX_LIMIT,
+    SYNC_FORMATS, SYNC_MAX_EDITS, SYNC_MAX_UPLOAD_BYTES, SYNC_MAX_DECOMPRESSED_BYTES,
+    encode_sync_bundle, decode_change_cursor,
+)
+from typing import List, Literal, Optional
+from pydantic import ValidationError
+from datetime import date, datetime
+from email.utils import formatdate, parsedate_to_datetime
+import asyncio, hashlib, importlib.util, json, time, uuid, os, zlib
 from io import BytesIO
 db_manager = DatabaseManager()
+# Read-only routes are async and use their own async engine
+async_db_manager = AsyncDatabaseManager()
 
 
 # Create router
 router = APIRouter(prefix="/patient_data")
 
 
+def _set_validators(response: Response, etag: str, last_modified: datetime):
+    response.headers["ETag"] = etag
+    response.headers["Last-Modified"] = formatdate(last_modified.timestamp(), usegmt=True)
+
+
+def _not_modified(request: Request, etag: str, last_modified: datetime) -> Optional[Response]:
+    """
+    304 response when the client's cached copy is still current.
+    If-None-Match takes precedence; If-Modified-Since is only used without it.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        fresh = etag_matches(if_none_match, etag)
+    else:
+        try:
+            since = parsedate_to_datetime(request.headers["if-modified-since"])
+            fresh = int(last_modified.timestamp()) <= since.timestamp()
+        except (KeyError, TypeError, ValueError):
+            fresh = False
+
+    if not fresh:
+        return None
+    response = Response(status_code=status.HTTP_304_NOT_MODIFIED)
+    _set_validators(response, etag, last_modified)
+    return response
+
+
+# ============================================
+# IDEMPOTENCY KEYS
+# ============================================
+# POST routes accept an Idempotency-Key header; a retry with the same key
+# replays the stored response instead of repeating the work
+
+def _request_fingerprint(*parts) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode())
+        digest.update(b"\x1f")
+    return digest.hexdigest()
+
+
+def _upload_fingerprint(upload: UploadFile) -> str:
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: upload.file.read(1024 * 1024), b""):
+        digest.update(chunk)
+    upload.file.seek(0)
+    return digest.hexdigest()
+
+
+def _begin_idempotent(patient_manager: PatientARTCRUD, key: str | None, route: str, fingerprint: str) -> Optional[JSONResponse]:
+    """Stored response to replay for a retried key, None when the request must be processed"""
+    if not key:
+        return None
+    replay = patient_manager.begin_idempotent_request(key, route, fingerprint)
+    if replay is None:
+        return None
+    status_code, body = replay
+    return JSONResponse(content=body, status_code=status_code, headers={"Idempotent-Replayed": "true"})
+
+
+def _complete_idempotent(patient_manager: PatientARTCRUD, key: str | None, route: str, status_code: int, result):
+    if key:
+        patient_manager.complete_idempotent_request(key, route, status_code, jsonable_encoder(result))
+    return result
+
+
+def _release_idempotent(patient_manager: PatientARTCRUD, key: str | None, route: str):
+    if not key:
+        return
+    try:
+        patient_manager.release_idempotent_request(key, route)
+    except Exception as e:
+        print(f"✗ Error releasing idempotency key {key}: {str(e)}")
+
+
 # ============================================
 # CREATE WAREHOUSE
 # ============================================
@@ -27,16 +127,26 @@ router = APIRouter(prefix="/patient_data")
 )
 def import_patient_line_list(
     line_list_data_import: UploadFile,
-    db: Session = Depends(db_manager.get_session),
+    idempotency_key: str | None = Header(default=None, description="Retries with the same key return the original result"),
+    db: Session = Depends(db_manager.get_db),
 ):
+    patient_manager = PatientARTCRUD(db_manager=db)
+    replay = _begin_idempotent(
+        patient_manager, idempotency_key, "import", _upload_fingerprint(line_list_data_import)
+    )
+    if replay is not None:
+        return replay
+
     try:
-        patient_import = PatientARTCRUD(db_manager=db)
-        patient_import = patient_import.create_patient_from_line_list(
+        patient_import = patient_manager.create_patient_from_line_list(
             line_list_data=line_list_data_import
         )
 
-        return patient_import
+        return _complete_idempotent(
+            patient_manager, idempotency_key, "import", status.HTTP_201_CREATED, patient_import
+        )
     except Exception as e:
+        _release_idempotent(patient_manager, idempotency_key, "import")
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=f"Patient import failed -> {e}"
@@ -51,14 +161,28 @@ def import_patient_line_list(
 )
 def create_patient(
     patient_payload: PatientARTCreate,
-    db: Session = Depends(db_manager.get_session),
+    idempotency_key: str | None = Header(default=None, description="Retries with the same key return the original result"),
+    db: Session = Depends(db_manager.get_db),
 ):
+    patient_manager = PatientARTCRUD(db_manager=db)
+    replay = _begin_idempotent(
+        patient_manager, idempotency_key, "single", _request_fingerprint(patient_payload.model_dump_json())
+    )
+    if replay is not None:
+        return replay
+
     try:
-        patient_manager = PatientARTCRUD(db_manager=db)
         new_patient = patient_manager.create_patient(patient_payload=patient_payload)
-        return new_patient
+        return _complete_idempotent(
+            patient_manager, idempotency_key, "single", status.HTTP_201_CREATED, new_patient
+        )
 
+    except HTTPException:
+        # Duplicate patient_identifier keeps its 409
+        _release_idempotent(patient_manager, idempotency_key, "single")
+        raise
     except Exception as e:
+        _release_idempotent(patient_manager, idempotency_key, "single")
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=f"Patient creation failed -> {e}",
@@ -71,14 +195,28 @@ def create_patient(
     summary="Get complete patient information by patient identifier",
     description="This route is to be used to fetch all information about a patient"
 )
-def get_patient_by_identifier(
+async def get_patient_by_identifier(
     patient_identifier: str,
-    db: Session = Depends(db_manager.get_session),
+    request: Request,
+    response: Response,
+    db: AsyncSession = Depends(async_db_manager.get_db),
 ):
     try:
-        patient_manager = PatientARTCRUD(db_manager=db)
-        patient_record = patient_manager.get_patient_by_identifier(patient_identifier=patient_identifier)
+        patient_manager = AsyncPatientARTCRUD(db_manager=db)
+        validators = await patient_manager.get_patient_validators(patient_identifier)
+        if validators is not None:
+            not_modified = _not_modified(request, *validators)
+            if not_modified is not None:
+                return not_modified
 
+        patient_record = await patient_manager.get_patient_by_identifier(patient_identifier=patient_identifier)
+
+        # Clients send the ETag back as If-None-Match, or If-Match when updating
+        _set_validators(
+            response,
+            make_patient_etag(patient_record.version),
+            patient_manager.get_last_modified([patient_record.updated_at]),
+        )
         return patient_record
     except Exception as e:
         raise HTTPException(
@@ -95,14 +233,14 @@ def get_patient_by_identifier(
     summary="Get all patient identifiers",
     description="Fetch paginated list of all patients' DATIM codes and identifiers",
 )
-def get_all_patient_identifiers(
+async def get_all_patient_identifiers(
     skip: int = 0,
     limit: int = 100,
-    db: Session = Depends(db_manager.get_session),
+    db: AsyncSession = Depends(async_db_manager.get_db),
 ):
     try:
-        patient_manager = PatientARTCRUD(db_manager=db)
-        identifiers = patient_manager.get_all_patient_identifiers(skip=skip, limit=limit)
+        patient_manager = AsyncPatientARTCRUD(db_manager=db)
+        identifiers = await patient_manager.get_all_patient_identifiers(skip=skip, limit=limit)
         return [
             {"state": s, "datim_code": d, "patient_identifier": pid}
             for s, d, pid in identifiers
@@ -119,14 +257,22 @@ def get_all_patient_identifiers(
     summary="Get all patient records",
     description="Fetch all patient records stored in the system",
 )
-def get_all_patients(
-    db: Session = Depends(db_manager.get_session),
+async def get_all_patients(
+    request: Request,
+    response: Response,
+    db: AsyncSession = Depends(async_db_manager.get_db),
     skip:int = 0,
     limit:int = 100
 ):
     try:
-        patient_manager = PatientARTCRUD(db_manager=db)
-        patients = patient_manager.get_all_patients(skip, limit)
+        patient_manager = AsyncPatientARTCRUD(db_manager=db)
+        validators = await patient_manager.get_patient_list_validators(skip, limit)
+        not_modified = _not_modified(request, *validators)
+        if not_modified is not None:
+            return not_modified
+
+        patients = await patient_manager.get_patients(skip, limit)
+        _set_validators(response, *validators)
         return patients
     except Exception as e:
         raise HTTPException(
@@ -145,17 +291,27 @@ def get_all_patients(
     summary="Get all patients by facility",
     description="Fetch all patients linked to a specific facility using DATIM code",
 )
-def get_patients_by_facility(
+async def get_patients_by_facility(
     datim_code: str,
+    request: Request,
+    response: Response,
     skip:int = 0,
     limit:int = 100,
-    db: Session = Depends(db_manager.get_session),
+    db: AsyncSession = Depends(async_db_manager.get_db),
 ):
     try:
-        patient_manager = PatientARTCRUD(db_manager=db)
-        patients = patient_manager.get_patients_by_datim_code(
-            datim_code, skip, limit
+        patient_manager = AsyncPatientARTCRUD(db_manager=db)
+        validators = await patient_manager.get_patient_list_validators(
+            skip, limit, facility_condition(datim_code)
         )
+        not_modified = _not_modified(request, *validators)
+        if not_modified is not None:
+            return not_modified
+
+        patients = await patient_manager.get_patients(
+            skip, limit, facility_condition(datim_code)
+        )
+        _set_validators(response, *validators)
         return patients
     except Exception as e:
         raise HTTPException(
@@ -174,17 +330,27 @@ def get_patients_by_facility(
     summary="Get all patients by state",
     description="Fetch all patients mapped to a specific state",
 )
-def get_patients_by_state(
+async def get_patients_by_state(
     state_name: str,
+    request: Request,
+    response: Response,
     skip: int = 0,
     limit: int = 0,
-    db: Session = Depends(db_manager.get_session),
+    db: AsyncSession = Depends(async_db_manager.get_db),
 ):
     try:
-        patient_manager = PatientARTCRUD(db_manager=db)
-        patients = patient_manager.get_patients_by_state(
-            state_name, skip, limit
+        patient_manager = AsyncPatientARTCRUD(db_manager=db)
+        validators = await patient_manager.get_patient_list_validators(
+            skip, limit, PatientARTData.state == state_name
+        )
+        not_modified = _not_modified(request, *validators)
+        if not_modified is not None:
+            return not_modified
+
+        patients = await patient_manager.get_patients(
+            skip, limit, PatientARTData.state == state_name
         )
+        _set_validators(response, *validators)
         return patients
     except Exception as e:
         raise HTTPException(
@@ -193,6 +359,110 @@ def get_patients_by_state(
         )
     
 
+# ============================================================
+# Patient change history
+# ============================================================
+@router.get(
+    "/patient_identifier/history",
+    response_model=List[PatientChangeLogResponse],
+    summary="Get the change history of a patient",
+    description="Field-level changes from creation/import, updates, voids, restores and deletes, newest first",
+)
+def get_patient_history(
+    patient_identifier: str,
+    skip: int = 0,
+    limit: int = 100,
+    db: Session = Depends(db_manager.get_db),
+):
+    try:
+        patient_manager = PatientARTCRUD(db_manager=db)
+        return patient_manager.get_patient_history(patient_identifier, skip, limit)
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Failed to fetch patient history -> {e}"
+        )
+
+
+@router.get(
+    "/patient_identifier/as_of",
+    response_model=PatientARTAsOfResponse,
+    summary="Get a patient record as it was at a point in time",
+    description="Reconstructed from the change log; ART status is computed against the as_of date",
+)
+def get_patient_as_of(
+    patient_identifier: str,
+    as_of: datetime,
+    db: Session = Depends(db_manager.get_db),
+):
+    try:
+        patient_manager = PatientARTCRUD(db_manager=db)
+        record = patient_manager.get_patient_as_of(patient_identifier, as_of)
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Failed to reconstruct patient record -> {e}"
+        )
+
+    if record is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Patient {patient_identifier} did not exist at {as_of.isoformat()}",
+        )
+    return record
+
+
+# ============================================================
+# Change feed for downstream synchronization
+# ============================================================
+# Long-poll: how often to re-check for changes and the longest wait allowed
+CHANGE_FEED_POLL_SECONDS = float(os.getenv("CHANGE_FEED_POLL_SECONDS", 1))
+CHANGE_FEED_MAX_WAIT_SECONDS = 60
+
+
+def _load_patient_changes(cursor: Optional[str], limit: int, datim_code: Optional[str]) -> dict:
+    db: Session = db_manager.get_session()
+    try:
+        patient_manager = PatientARTCRUD(db_manager=db)
+        return patient_manager.get_patient_changes(cursor=cursor, limit=limit, datim_code=datim_code)
+    finally:
+        db.close()
+
+
+@router.get(
+    "/changes",
+    response_model=PatientChangeFeedResponse,
+    summary="Incremental feed of changed patient records",
+    description=(
+        "Returns patient rows changed after `cursor` (inserts, updates, voids and deletes) ordered by "
+        "commit order, with the cursor for the next call. Omit `cursor` to start from the "
+        "beginning. With `wait` > 0 the call long-polls until changes arrive or the wait ends."
+    ),
+)
+async def get_patient_changes(
+    request: Request,
+    cursor: Optional[str] = None,
+    limit: int = Query(1000, ge=1, le=5000),
+    datim_code: Optional[str] = None,
+    wait: int = Query(0, ge=0, le=CHANGE_FEED_MAX_WAIT_SECONDS, description="Seconds to long-poll when there are no changes"),
+):
+    deadline = time.monotonic() + wait
+    while True:
+        try:
+            feed = await run_in_threadpool(_load_patient_changes, cursor, limit, datim_code)
+        except ValueError as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+        except Exception as e:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Failed to fetch patient changes -> {e}"
+            )
+
+        if feed["changes"] or time.monotonic() >= deadline or await request.is_disconnected():
+            return feed
+        await asyncio.sleep(min(CHANGE_FEED_POLL_SECONDS, max(deadline - time.monotonic(), 0)))
+
+
 # ============================================================
 # 4. UPDATE patient
 # ============================================================
@@ -205,15 +475,26 @@ def get_patients_by_state(
 def update_patient(
     patient_identifier: str,
     payload: PatientARTUpdate,
-    db: Session = Depends(db_manager.get_session),
+    response: Response,
+    if_match: str | None = Header(default=None, description="ETag from GET /patient_identifier; 409 if the record changed since"),
+    db: Session = Depends(db_manager.get_db),
 ):
     try:
+        try:
+            expected_version = parse_etag_version(if_match)
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Invalid If-Match header: {if_match}",
+            )
+
         patient_manager = PatientARTCRUD(db_manager=db)
         update_data = payload.dict(exclude_unset=True)
 
         updated_patient = patient_manager.update_patient(
             patient_identifier=patient_identifier,
             update_data=update_data,
+            expected_version=expected_version,
         )
 
         if not updated_patient:
@@ -222,6 +503,7 @@ def update_patient(
                 detail=f"Patient with identifier {patient_identifier} not found",
             )
 
+        response.headers["ETag"] = make_patient_etag(updated_patient.version)
         return updated_patient
 
     except HTTPException:
@@ -233,6 +515,41 @@ def update_patient(
         )
 
 
+@router.patch(
+    "/bulk",
+    response_model=PatientBulkUpdateResponse,
+    summary="Update many patient records in one request",
+    description=(
+        "Applies a list of partial updates in a single transaction and returns a status "
+        "for each item: updated, not_found or no_changes"
+    ),
+)
+def bulk_update_patients(
+    payload: List[PatientBulkUpdateItem],
+    db: Session = Depends(db_manager.get_db),
+):
+    try:
+        patient_manager = PatientARTCRUD(db_manager=db)
+        results = patient_manager.bulk_update_patients(
+            items=[
+                (item.patient_identifier, item.changes.model_dump(exclude_unset=True))
+                for item in payload
+            ]
+        )
+        return {
+            "message": "Bulk update completed",
+            "total_updated": sum(1 for r in results if r["status"] == "updated"),
+            "results": results,
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Failed to bulk update patients -> {e}"
+        )
+
+
 @router.delete(
     "/patient_identifier",
     summary="Soft delete (void) a patient record",
@@ -240,7 +557,7 @@ def update_patient(
 )
 def soft_delete_patient(
     patient_identifier: str,
-    db: Session = Depends(db_manager.get_session),
+    db: Session = Depends(db_manager.get_db),
 ):
     try:
         patient_manager = PatientARTCRUD(db_manager=db)
@@ -280,7 +597,7 @@ def soft_delete_patient(
 )
 def restore_patient(
     patient_identifier: str,
-    db: Session = Depends(db_manager.get_session),
+    db: Session = Depends(db_manager.get_db),
 ):
     try:
         patient_manager = PatientARTCRUD(db_manager=db)
@@ -308,122 +625,1289 @@ def restore_patient(
         )
     
 
+@router.post(
+    "/bulk/void",
+    summary="Void all patient records matching a filter",
+    description="Soft deletes every non-voided patient matching datim_code, patient_identifiers and/or a created_at window",
+)
+def bulk_void_patients(
+    payload: PatientBulkFilter,
+    db: Session = Depends(db_manager.get_db),
+):
+    try:
+        patient_manager = PatientARTCRUD(db_manager=db)
+        voided = patient_manager.bulk_void_patients(
+            voided_by="SUPER USER",
+            **payload.model_dump(),
+        )
+        return {
+            "message": "Patients voided successfully",
+            "total_voided": voided,
+        }
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Failed to bulk void patients -> {e}"
+        )
+
+
+@router.post(
+    "/bulk/restore",
+    summary="Restore all voided patient records matching a filter",
+    description="Unvoids every voided patient matching datim_code, patient_identifiers and/or a created_at window",
+)
+def bulk_restore_patients(
+    payload: PatientBulkFilter,
+    db: Session = Depends(db_manager.get_db),
+):
+    try:
+        patient_manager = PatientARTCRUD(db_manager=db)
+        restored = patient_manager.bulk_restore_patients(**payload.model_dump())
+        return {
+            "message": "Patients restored successfully",
+            "total_restored": restored,
+        }
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Failed to bulk restore patients -> {e}"
+        )
+    
+
 @router.delete(
     "/delete/all",
+    status_code=status.HTTP_202_ACCEPTED,
     summary="Delete ALL patient records",
-    description="⚠️ Irreversibly deletes all patient records from the patient_art_data table",
+    description=(
+        "⚠️ Irreversibly deletes all patient records from the patient_art_data table. "
+        "Runs as a background job deleting in primary key ordered chunks; returns a job id "
+        "whose progress is available from GET /jobs/job_id"
+    ),
 )
 def drop_all_patients(
+    background_tasks: BackgroundTasks,
     datim_code: str | None = Query(default=None, description="If provided, only deletes patients from the specified facility"),
-    db: Session = Depends(db_manager.get_session),
+    chunk_size: int = Query(default=DELETE_CHUNK_SIZE, ge=1, le=50000, description="Rows deleted per transaction"),
+    pause_seconds: float = Query(default=DELETE_PAUSE_SECONDS, ge=0, le=60, description="Pause between chunks"),
+    db: Session = Depends(db_manager.get_db),
 ):
     try:
         patient_manager = PatientARTCRUD(db_manager=db)
-        deleted = patient_manager.drop_all_patients(datim_code=datim_code)
+        job = patient_manager.create_background_job(
+            job_type="patient_delete",
+            parameters={"datim_code": datim_code, "chunk_size": chunk_size, "pause_seconds": pause_seconds},
+            requested_by="SUPER USER",
+        )
+
+        def work(patient_manager: PatientARTCRUD, tracker: BackgroundJobTracker) -> dict:
+            tracker.set_total_rows(patient_manager.count_patients(datim_code=datim_code))
+            deleted = patient_manager.drop_all_patients(
+                datim_code=datim_code,
+                chunk_size=chunk_size,
+                pause_seconds=pause_seconds,
+                progress_callback=tracker.update,
+            )
+            return {"patients": deleted, "total_deleted": deleted}
+
+        background_tasks.add_task(
+            run_job,
+            db_manager.get_session,
+            job.job_id,
+            "patient_delete",
+            "deleting",
+            work,
+        )
         return {
-            "message": "All patient records deleted successfully",
-            "total_deleted": deleted,
+            "message": "Patient deletion started",
+            "job_id": job.job_id,
         }
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=f"Error deleting all patient records -> {e}",
         )
-    
 
-EXPORT_DIR = "exports"
-os.makedirs(EXPORT_DIR, exist_ok=True)
-def _background_generate_line_list(
-    db_session_factory,
-    request_id: str,
-    datim_code: str | None,
+
+@router.get(
+    "/jobs/job_id",
+    response_model=BackgroundJobResponse,
+    summary="Fetch the status, progress and result of a background job",
+)
+def get_background_job(
+    job_id: str,
+    db: Session = Depends(db_manager.get_db),
+):
+    patient_manager = PatientARTCRUD(db_manager=db)
+    job = patient_manager.get_background_job(job_id)
+    if not job:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Background job {job_id} not found",
+        )
+    return patient_manager.get_background_job_response(job)
+
+
+# ============================================================
+# Retention summary
+# ============================================================
+SummaryDimension = Literal["state", "lga", "datim_code", "sex", "age_band", "art_status"]
+
+
+@router.get(
+    "/summary",
+    response_model=RetentionSummaryResponse,
+    summary="Patient counts by state, LGA, facility, sex, age band and ART status",
+    description=(
+        "Answered from the pre-aggregated retention summary, not from patient rows. "
+        "ART statuses are computed against `status_date`, the date of the last rebuild."
+    ),
+)
+def get_retention_summary(
+    group_by: List[SummaryDimension] = Query(default=["state"], description="Dimensions to group by"),
+    state: str | None = None,
+    lga: str | None = None,
+    datim_code: str | None = None,
+    sex: str | None = None,
+    age_band: str | None = None,
+    art_status: str | None = None,
+    db: Session = Depends(db_manager.get_db),
 ):
-    # Create a new session inside background task
-    db: Session = db_session_factory()
     try:
         patient_manager = PatientARTCRUD(db_manager=db)
-        excel_bytes = patient_manager.generate_patient_line_list(datim_code=datim_code)
-        
-        # fetch the request record
-        request_record = db.query(LineListRequest).filter(LineListRequest.request_id==request_id).first()
-
-        file_content = excel_bytes.getvalue()
-        request_record.file_data=file_content
-        request_record.file_size = len(file_content)
-        request_record.request_status="Completed"
-        db.commit()
-        print(f"✓ Export stored in database for request {request_id}")
-    finally:
-        db.close()
+        return patient_manager.get_retention_summary(
+            group_by=list(dict.fromkeys(group_by)),
+            state=state, lga=lga, datim_code=datim_code, sex=sex,
+            age_band=age_band, art_status=art_status,
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Failed to fetch retention summary -> {e}"
+        )
 
 
 @router.post(
-    "/line-list/export",
-    summary="Request patient line list export",
-    description="Triggers background generation of the patient line list. Returns a job id.",
+    "/summary/rebuild",
+    status_code=status.HTTP_202_ACCEPTED,
+    summary="Rebuild the retention summary",
+    description=(
+        "Recomputes the summary from all non-voided patients with ART status as of `status_date` "
+        "(default today). Runs as a background job, progress at GET /jobs/job_id. "
+        "Schedule it daily so statuses follow the calendar."
+    ),
 )
-def request_line_list_export(
+def rebuild_retention_summary(
     background_tasks: BackgroundTasks,
-    datim_code: str | None = Query(default=None),
-    db: Session = Depends(db_manager.get_session),
+    status_date: date | None = Query(default=None),
+    db: Session = Depends(db_manager.get_db),
 ):
-    # Generate a job ID
-    request_id = str(uuid.uuid4())
-
-    # schedule background work
-    background_tasks.add_task(
-        _background_generate_line_list,
-        db_manager.get_session, 
-        request_id,
-        datim_code,
-    )
-
-    new_request = LineListRequest(
-        request_id=request_id,
-        requested_by_id="SUPER USER",
-        request_date=datetime.now(),
-        request_status="Processing"
-    )
-    db.add(new_request)
-    db.commit()
+    try:
+        patient_manager = PatientARTCRUD(db_manager=db)
+        job = patient_manager.create_background_job(
+            job_type="retention_summary_rebuild",
+            parameters={"status_date": status_date},
+            requested_by="SUPER USER",
+        )
+        background_tasks.add_task(
+            run_job,
+            db_manager.get_session,
+            job.job_id,
+            "retention_summary_rebuild",
+            "aggregating",
+            lambda patient_manager, tracker: patient_manager.rebuild_retention_summary(
+                status_date=status_date,
+                progress_callback=tracker.update,
+            ),
+        )
+        return {
+            "message": "Retention summary rebuild started",
+            "job_id": job.job_id,
+        }
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Error starting retention summary rebuild -> {e}",
+        )
 
-    return {
-        "message": "Export started",
-        "request_id": request_id,
-    }
 
 
 @router.get(
-    "/line-list/requests/all",
-    response_model=List[LineListRequestResponse],
-    summary="Fetch all the request records for line lists generation"
+    "/cohorts",
+    response_model=RetentionCohortResponse,
+    summary="Retention by ART start month or quarter",
+    description=(
+        "Share of each ART start cohort still Active 3, 6, 12 and 24 months after starting, "
+        "and as of `as_of` (default today). Milestones after `as_of` are left out of their "
+        "denominator. Results are cached per filter and `as_of` until patient data changes."
+    ),
 )
-def get_line_list_requests(
-    skip: int = 0,
-    limit: int = 10,
-    db: Session = Depends(db_manager.get_session),
+def get_retention_cohorts(
+    as_of: date | None = Query(default=None),
+    period: Literal["month", "quarter"] = Query(default="month"),
+    datim_code: str | None = None,
+    state: str | None = None,
+    sex: str | None = None,
+    age_band: str | None = None,
+    db: Session = Depends(db_manager.get_db),
 ):
     try:
         patient_manager = PatientARTCRUD(db_manager=db)
-        line_list_requests = patient_manager.get_line_list_requests(skip, limit)
-
-        return line_list_requests
+        return patient_manager.get_retention_cohorts(
+            as_of=as_of, period=period,
+            datim_code=datim_code, state=state, sex=sex, age_band=age_band,
+        )
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"Error: -> {str(e)}"
+            detail=f"Failed to compute retention cohorts -> {e}"
         )
 
 
+# ============================================================
+# Lab results
+# ============================================================
+@router.post(
+    "/lab-results/backfill",
+    status_code=status.HTTP_202_ACCEPTED,
+    summary="Derive numeric viral load and CD4 values for existing records",
+    description=(
+        "New writes derive them automatically. Only records never derived are processed "
+        "unless `recompute`. Runs as a background job, progress at GET /jobs/job_id."
+    ),
+)
+def backfill_lab_values(
+    background_tasks: BackgroundTasks,
+    recompute: bool = Query(default=False),
+    db: Session = Depends(db_manager.get_db),
+):
+    try:
+        patient_manager = PatientARTCRUD(db_manager=db)
+        job = patient_manager.create_background_job(
+            job_type="lab_value_backfill",
+            parameters={"recompute": recompute},
+            requested_by="SUPER USER",
+        )
+        background_tasks.add_task(
+            run_job,
+            db_manager.get_session,
+            job.job_id,
+            "lab_value_backfill",
+            "backfilling",
+            lambda patient_manager, tracker: patient_manager.backfill_lab_values(
+                recompute=recompute,
+                progress_callback=tracker.update,
+            ),
+        )
+        return {
+            "message": "Lab value backfill started",
+            "job_id": job.job_id,
+        }
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Error starting lab value backfill -> {e}",
+        )
+
 
 @router.get(
-    "/line-list/download/request_id",
-    summary="Download generated patient line list",
+    "/viral-load/suppression",
+    response_model=ViralLoadSuppressionResponse,
+    summary="Viral load suppression per facility",
+    description=(
+        "Suppressed, unsuppressed, missing and overdue viral load counts per facility. "
+        "A result below `threshold` copies/ml (including undetectable and \"<n\" results) is suppressed. "
+        "Overdue: on ART for 6 months as of `as_of` with no result in the last 12 months."
+    ),
 )
-def download_line_list(request_id: str, db: Session = Depends(db_manager.get_session),):
-    request_record = db.query(LineListRequest).filter(
-        LineListRequest.request_id == request_id
-    ).first()
+def get_viral_load_suppression(
+    as_of: date | None = Query(default=None),
+    threshold: float = Query(default=VL_SUPPRESSION_THRESHOLD, gt=0),
+    state: str | None = None,
+    datim_code: str | None = None,
+    db: Session = Depends(db_manager.get_db),
+):
+    try:
+        patient_manager = PatientARTCRUD(db_manager=db)
+        return patient_manager.get_viral_load_suppression(
+            as_of=as_of, threshold=threshold, state=state, datim_code=datim_code,
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Failed to compute viral load suppression -> {e}"
+        )
+
+
+# ============================================================
+# Duplicate detection
+# ============================================================
+@router.post(
+    "/duplicates/run",
+    status_code=status.HTTP_202_ACCEPTED,
+    summary="Detect probable duplicate patient records",
+    description=(
+        "Compares records sharing sex + date of birth + ART start date, or sex + normalized "
+        "hospital number, and groups pairs scoring at least `threshold` into clusters for review. "
+        "Pending clusters are replaced, reviewed ones are kept. "
+        "Runs as a background job, progress at GET /jobs/job_id."
+    ),
+)
+def detect_duplicates(
+    background_tasks: BackgroundTasks,
+    threshold: float = Query(default=DUPLICATE_MATCH_THRESHOLD, gt=0, le=1),
+    db: Session = Depends(db_manager.get_db),
+):
+    try:
+        patient_manager = PatientARTCRUD(db_manager=db)
+        job = patient_manager.create_background_job(
+            job_type="duplicate_detection",
+            parameters={"threshold": threshold},
+            requested_by="SUPER USER",
+        )
+        background_tasks.add_task(
+            run_job,
+            db_manager.get_session,
+            job.job_id,
+            "duplicate_detection",
+            "reading",
+            lambda patient_manager, tracker: patient_manager.detect_duplicates(
+                job_id=tracker.job_id,
+                threshold=threshold,
+                progress_callback=tracker.update,
+            ),
+        )
+        return {
+            "message": "Duplicate detection started",
+            "job_id": job.job_id,
+        }
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Error starting duplicate detection -> {e}",
+        )
+
+
+@router.get(
+    "/duplicates/clusters",
+    response_model=List[DuplicateClusterResponse],
+    summary="Duplicate candidate clusters for review",
+    description="Highest scoring first. `datim_code` keeps clusters with a member at that facility.",
+)
+def get_duplicate_clusters(
+    cluster_status: Literal["pending", "confirmed", "not_duplicate"] | None = Query(default="pending", alias="status"),
+    datim_code: str | None = None,
+    skip: int = Query(default=0, ge=0),
+    limit: int = Query(default=50, ge=1, le=500),
+    db: Session = Depends(db_manager.get_db),
+):
+    try:
+        patient_manager = PatientARTCRUD(db_manager=db)
+        return patient_manager.get_duplicate_clusters(
+            cluster_status=cluster_status, datim_code=datim_code, skip=skip, limit=limit,
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Failed to fetch duplicate clusters -> {e}"
+        )
+
+
+@router.post(
+    "/duplicates/cluster/review",
+    response_model=DuplicateClusterResponse,
+    summary="Confirm or reject a duplicate cluster",
+    description="Rejected (`not_duplicate`) clusters are not proposed again while their members stay the same.",
+)
+def review_duplicate_cluster(
+    review: DuplicateClusterReview,
+    cluster_id: int = Query(...),
+    db: Session = Depends(db_manager.get_db),
+):
+    try:
+        patient_manager = PatientARTCRUD(db_manager=db)
+        cluster = patient_manager.review_duplicate_cluster(
+            cluster_id=cluster_id,
+            cluster_status=review.status,
+            reviewed_by=review.reviewed_by,
+            note=review.note,
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Failed to review duplicate cluster -> {e}"
+        )
+    if cluster is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Duplicate cluster not found"
+        )
+    return cluster
+
+
+# ============================================================
+# Data quality
+# ============================================================
+DataQualityRule = Literal[tuple(DATA_QUALITY_RULES)]
+
+
+@router.post(
+    "/data-quality/scan",
+    status_code=status.HTTP_202_ACCEPTED,
+    summary="Scan patient records for data quality problems",
+    description=(
+        "Checks every non-voided record against the data quality rules, dates compared with "
+        "`as_of` (default today). Runs as a background job, progress at GET /jobs/job_id, "
+        "results at GET /data-quality/report."
+    ),
+)
+def run_data_quality_scan(
+    background_tasks: BackgroundTasks,
+    as_of: date | None = Query(default=None),
+    db: Session = Depends(db_manager.get_db),
+):
+    try:
+        patient_manager = PatientARTCRUD(db_manager=db)
+        job = patient_manager.create_background_job(
+            job_type="data_quality_scan",
+            parameters={"as_of": as_of},
+            requested_by="SUPER USER",
+        )
+        background_tasks.add_task(
+            run_job,
+            db_manager.get_session,
+            job.job_id,
+            "data_quality_scan",
+            "scanning",
+            lambda patient_manager, tracker: patient_manager.run_data_quality_scan(
+                job_id=tracker.job_id,
+                as_of=as_of,
+                progress_callback=tracker.update,
+            ),
+        )
+        return {
+            "message": "Data quality scan started",
+            "job_id": job.job_id,
+        }
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Error starting data quality scan -> {e}",
+        )
+
+
+@router.get(
+    "/data-quality/report",
+    response_model=DataQualityReportResponse,
+    summary="Data quality violations per rule and facility",
+    description="From the scan `job_id`, default the latest completed scan.",
+)
+def get_data_quality_report(
+    job_id: str | None = None,
+    datim_code: str | None = None,
+    rule: DataQualityRule | None = None,
+    db: Session = Depends(db_manager.get_db),
+):
+    try:
+        patient_manager = PatientARTCRUD(db_manager=db)
+        report = patient_manager.get_data_quality_report(job_id=job_id, datim_code=datim_code, rule=rule)
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Failed to fetch data quality report -> {e}"
+        )
+    if report is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="No completed data quality scan found"
+        )
+    return report
+
+
+# ============================================================
+# Facilities
+# ============================================================
+@router.get(
+    "/facilities",
+    response_model=List[FacilityResponse],
+    summary="List facilities from the reference table",
+)
+def get_facilities(
+    state: str | None = None,
+    lga: str | None = None,
+    db: Session = Depends(db_manager.get_db),
+):
+    try:
+        patient_manager = PatientARTCRUD(db_manager=db)
+        return patient_manager.get_facilities(state=state, lga=lga)
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Failed to fetch facilities -> {e}"
+        )
+
+
+@router.post(
+    "/facilities",
+    summary="Add or update facilities",
+    description=(
+        "Upserts by datim_code and links existing patients with that datim_code. When "
+        "FACILITY_VALIDATION is on, creates, imports and updates with an unregistered "
+        "datim_code are rejected; turn it on after running the facility backfill."
+    ),
+)
+def upsert_facilities(
+    facilities: List[FacilityBase],
+    db: Session = Depends(db_manager.get_db),
+):
+    try:
+        patient_manager = PatientARTCRUD(db_manager=db)
+        count = patient_manager.upsert_facilities([f.model_dump() for f in facilities])
+        return {"message": "Facilities saved", "total_facilities": count}
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Failed to save facilities -> {e}"
+        )
+
+
+@router.post(
+    "/facilities/refresh",
+    summary="Reload the facility lookup cache",
+    description="Reloads this worker's cache now, other workers reload within FACILITY_CACHE_TTL_SECONDS.",
+)
+def refresh_facility_registry(db: Session = Depends(db_manager.get_db)):
+    try:
+        patient_manager = PatientARTCRUD(db_manager=db)
+        return {"message": "Facility registry reloaded", "total_facilities": patient_manager.refresh_facility_registry()}
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Failed to reload facility registry -> {e}"
+        )
+
+
+@router.post(
+    "/facilities/backfill",
+    status_code=status.HTTP_202_ACCEPTED,
+    summary="Link existing patients to facilities",
+    description=(
+        "Adds every datim_code found on patients to the facility table, then sets facility_id "
+        "on patients without one. Runs as a background job, progress at GET /jobs/job_id."
+    ),
+)
+def backfill_facility_ids(
+    background_tasks: BackgroundTasks,
+    db: Session = Depends(db_manager.get_db),
+):
+    try:
+        patient_manager = PatientARTCRUD(db_manager=db)
+        job = patient_manager.create_background_job(
+            job_type="facility_backfill",
+            parameters={},
+            requested_by="SUPER USER",
+        )
+        background_tasks.add_task(
+            run_job,
+            db_manager.get_session,
+            job.job_id,
+            "facility_backfill",
+            "backfilling",
+            lambda patient_manager, tracker: patient_manager.backfill_facility_ids(
+                progress_callback=tracker.update,
+            ),
+        )
+        return {
+            "message": "Facility backfill started",
+            "job_id": job.job_id,
+        }
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Error starting facility backfill -> {e}",
+        )
+
+
+# ============================================================
+# Search
+# ============================================================
+@router.get(
+    "/search",
+    response_model=List[PatientSearchResult],
+    summary="Search patients of a facility",
+    description=(
+        "Matches `q` against the patient identifier and hospital number, exactly or as a prefix, "
+        "ignoring case, separators and leading zeros (\"720/19\" finds \"00720/19\"), and against "
+        "the residential address. Best matches first."
+    ),
+)
+def search_patients(
+    q: str = Query(..., min_length=1, max_length=100),
+    datim_code: str = Query(...),
+    skip: int = Query(default=0, ge=0),
+    limit: int = Query(default=20, ge=1, le=SEARCH_MAX_LIMIT),
+    db: Session = Depends(db_manager.get_db),
+):
+    try:
+        patient_manager = PatientARTCRUD(db_manager=db)
+        return patient_manager.search_patients(query=q, datim_code=datim_code, skip=skip, limit=limit)
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Failed to search patients -> {e}"
+        )
+
+
+@router.post(
+    "/search/backfill",
+    status_code=status.HTTP_202_ACCEPTED,
+    summary="Compute search keys for existing records",
+    description="New writes set them automatically. Runs as a background job, progress at GET /jobs/job_id.",
+)
+def backfill_search_keys(
+    background_tasks: BackgroundTasks,
+    db: Session = Depends(db_manager.get_db),
+):
+    try:
+        patient_manager = PatientARTCRUD(db_manager=db)
+        job = patient_manager.create_background_job(
+            job_type="search_key_backfill",
+            parameters={},
+            requested_by="SUPER USER",
+        )
+        background_tasks.add_task(
+            run_job,
+            db_manager.get_session,
+            job.job_id,
+            "search_key_backfill",
+            "backfilling",
+            lambda patient_manager, tracker: patient_manager.backfill_search_keys(
+                progress_callback=tracker.update,
+            ),
+        )
+        return {
+            "message": "Search key backfill started",
+            "job_id": job.job_id,
+        }
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Error starting search key backfill -> {e}",
+        )
+
+
+# ============================================================
+# Offline facility sync
+# ============================================================
+def _stream_sync_bundle(datim_code: str, since: str | None, bundle_format: str):
+    # Own session, the request's is closed before a streamed body finishes
+    db: Session = db_manager.get_session()
+    try:
+        patient_manager = PatientARTCRUD(db_manager=db)
+        yield from encode_sync_bundle(patient_manager.iter_sync_records(datim_code, since), bundle_format)
+    finally:
+        db.close()
+
+
+@router.get(
+    "/sync/download",
+    summary="Download a facility's patients changed since the last sync",
+    description=(
+        "gzip-compressed bundle: NDJSON (default) or MessagePack records. A header lists the "
+        "patient columns, each patient is one record of values in that order, patients voided, deleted "
+        "or moved to another facility since `since` come as tombstones, and the final record "
+        "carries the `watermark` to pass as `since` next time. Without `since` the whole "
+        "facility is sent."
+    ),
+)
+def download_sync_bundle(
+    datim_code: str = Query(...),
+    since: str | None = Query(default=None, description="Watermark from the previous bundle"),
+    bundle_format: Literal["ndjson", "msgpack"] = Query(default="ndjson", alias="format"),
+):
+    try:
+        decode_change_cursor(since)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    if bundle_format == "msgpack" and importlib.util.find_spec("msgpack") is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="MessagePack bundles are not available, the msgpack package is not installed",
+        )
+    return StreamingResponse(
+        _stream_sync_bundle(datim_code, since, bundle_format),
+        media_type=SYNC_FORMATS[bundle_format],
+        headers={"Content-Encoding": "gzip", "Cache-Control": "no-store"},
+    )
+
+
+async def _read_sync_upload_body(request: Request) -> bytes:
+    """
+    Request body of a sync upload, gunzipped when Content-Encoding is gzip.
+    Reading stops with a 413 as soon as the raw body passes SYNC_MAX_UPLOAD_BYTES
+    or the decompressed one passes SYNC_MAX_DECOMPRESSED_BYTES
+    """
+    too_large = HTTPException(
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail=f"Upload is larger than {SYNC_MAX_UPLOAD_BYTES} bytes "
+               f"({SYNC_MAX_DECOMPRESSED_BYTES} bytes decompressed)",
+    )
+    content_length = request.headers.get("content-length", "")
+    if content_length.isdigit() and int(content_length) > SYNC_MAX_UPLOAD_BYTES:
+        raise too_large
+    gzipped = request.headers.get("content-encoding", "").lower() == "gzip"
+    decompressor = zlib.decompressobj(wbits=31) if gzipped else None
+    received = 0
+    chunks = []
+    size = 0
+    try:
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > SYNC_MAX_UPLOAD_BYTES:
+                raise too_large
+            if decompressor is not None:
+                # Never inflate more than one byte past the limit
+                chunk = decompressor.decompress(chunk, SYNC_MAX_DECOMPRESSED_BYTES - size + 1)
+                if decompressor.unconsumed_tail:
+                    raise too_large
+            size += len(chunk)
+            if size > SYNC_MAX_DECOMPRESSED_BYTES:
+                raise too_large
+            chunks.append(chunk)
+        if decompressor is not None and not decompressor.eof:
+            raise zlib.error("truncated gzip stream")
+    except zlib.error as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid gzip body -> {e}")
+    return b"".join(chunks)
+
+
+@router.post(
+    "/sync/upload",
+    response_model=PatientSyncUploadResponse,
+    summary="Upload edits made offline at a facility",
+    description=(
+        "Each edit carries the `base_version` it was made on. Edits on an outdated or voided record "
+        "are not applied and come back as conflicts with the server's version and values. "
+        "Edits without `base_version` register new patients. The body may be gzip-compressed "
+        "(`Content-Encoding: gzip`)."
+    ),
+)
+async def upload_sync_edits(
+    request: Request,
+    datim_code: str = Query(...),
+    db: Session = Depends(db_manager.get_db),
+):
+    body = await _read_sync_upload_body(request)
+    try:
+        upload = PatientSyncUpload.model_validate_json(body)
+    except ValidationError as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=jsonable_encoder(e.errors(include_url=False, include_context=False)),
+        )
+    if len(upload.edits) > SYNC_MAX_EDITS:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"At most {SYNC_MAX_EDITS} edits per upload",
+        )
+
+    try:
+        patient_manager = PatientARTCRUD(db_manager=db)
+        return await run_in_threadpool(
+            patient_manager.apply_sync_edits,
+            datim_code,
+            [
+                (edit.patient_identifier, edit.base_version, edit.changes.model_dump(exclude_unset=True))
+                for edit in upload.edits
+            ],
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Failed to apply offline edits -> {e}"
+        )
+
+
+# ============================================================
+# Daily ART status snapshots
+# ============================================================
+@router.post(
+    "/snapshots/run",
+    status_code=status.HTTP_202_ACCEPTED,
+    summary="Take the daily ART status snapshot",
+    description=(
+        "Stores patient counts per state, LGA, facility, sex, age band and ART status as of "
+        "`snapshot_date` (default today), and one transition per patient whose status changed "
+        "since the previous snapshot. Re-running a day replaces it. "
+        "Runs as a background job, progress at GET /jobs/job_id. "
+        "Normally scheduled nightly with `python -m app.jobs nightly`."
+    ),
+)
+def take_art_status_snapshot(
+    background_tasks: BackgroundTasks,
+    snapshot_date: date | None = Query(default=None),
+    db: Session = Depends(db_manager.get_db),
+):
+    try:
+        patient_manager = PatientARTCRUD(db_manager=db)
+        job = patient_manager.create_background_job(
+            job_type="art_status_snapshot",
+            parameters={"snapshot_date": snapshot_date},
+            requested_by="SUPER USER",
+        )
+        background_tasks.add_task(
+            run_job,
+            db_manager.get_session,
+            job.job_id,
+            "art_status_snapshot",
+            "snapshotting",
+            lambda patient_manager, tracker: patient_manager.take_art_status_snapshot(
+                snapshot_date=snapshot_date,
+                progress_callback=tracker.update,
+            ),
+        )
+        return {
+            "message": "ART status snapshot started",
+            "job_id": job.job_id,
+        }
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Error starting ART status snapshot -> {e}",
+        )
+
+
+@router.get(
+    "/snapshots/trend",
+    response_model=ArtStatusTrendResponse,
+    summary="Patient counts over time from the daily ART status snapshots",
+    description="`interval=month` uses the first snapshot of each month.",
+)
+def get_art_status_trend(
+    date_from: date = Query(...),
+    date_to: date = Query(...),
+    interval: Literal["day", "month"] = Query(default="day"),
+    group_by: List[SummaryDimension] = Query(default=["art_status"], description="Dimensions to group by"),
+    state: str | None = None,
+    lga: str | None = None,
+    datim_code: str | None = None,
+    sex: str | None = None,
+    age_band: str | None = None,
+    art_status: str | None = None,
+    db: Session = Depends(db_manager.get_db),
+):
+    try:
+        patient_manager = PatientARTCRUD(db_manager=db)
+        return patient_manager.get_art_status_trend(
+            date_from=date_from,
+            date_to=date_to,
+            group_by=list(dict.fromkeys(group_by)),
+            interval=interval,
+            state=state, lga=lga, datim_code=datim_code, sex=sex,
+            age_band=age_band, art_status=art_status,
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Failed to fetch ART status trend -> {e}"
+        )
+
+
+@router.get(
+    "/snapshots/transitions",
+    response_model=List[ArtStatusTransitionCount],
+    summary="Number of patients changing ART status per snapshot day",
+)
+def get_art_status_transitions(
+    date_from: date = Query(...),
+    date_to: date = Query(...),
+    datim_code: str | None = None,
+    db: Session = Depends(db_manager.get_db),
+):
+    try:
+        patient_manager = PatientARTCRUD(db_manager=db)
+        return patient_manager.get_art_status_transitions(
+            date_from=date_from, date_to=date_to, datim_code=datim_code,
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Failed to fetch ART status transitions -> {e}"
+        )
+    
+
+EXPORT_DIR = "exports"
+os.makedirs(EXPORT_DIR, exist_ok=True)
+def _background_generate_line_list(
+    db_session_factory,
+    request_id: str,
+    datim_code: str | None,
+    since: datetime | None = None,
+    state: str | None = None,
+    partition_by: str | None = None,
+    partition_output: str = "zip",
+    export_format: str = "xlsx",
+    since_seq: int | None = None,
+):
+    # Create a new session inside background task
+    db: Session = db_session_factory()
+    tracker = ExportProgressTracker(db_session_factory, request_id)
+    try:
+        tracker.start()
+        patient_manager = PatientARTCRUD(db_manager=db)
+        # Read before the query runs: every change up to watermark_seq has committed and
+        # is exported, later ones land in the next delta (or in both, never in neither)
+        watermark = datetime.now()
+        watermark_seq = patient_manager.get_change_sequence()
+        if partition_by:
+            excel_bytes = patient_manager.generate_partitioned_line_list(
+                partition_by=partition_by,
+                partition_output=partition_output,
+                datim_code=datim_code,
+                since=since,
+                watermark=watermark,
+                state=state,
+                export_format=export_format,
+                progress_callback=tracker.update,
+                since_seq=since_seq,
+            )
+        else:
+            excel_bytes = patient_manager.generate_patient_line_list(
+                datim_code=datim_code,
+                since=since,
+                watermark=watermark,
+                state=state,
+                export_format=export_format,
+                progress_callback=tracker.update,
+                since_seq=since_seq,
+            )
+
+        if partition_by and partition_output == "zip":
+            file_name, content_type = "patient_line_list.zip", ZIP_MEDIA_TYPE
+        else:
+            extension, content_type = EXPORT_FORMATS[export_format]
+            file_name = f"patient_line_list.{extension}"
+
+        tracker.set_phase("storing")
+        
+        # fetch the request record
+        request_record = db.query(LineListRequest).filter(LineListRequest.request_id==request_id).first()
+
+        file_content = excel_bytes.getvalue()
+        request_record.file_data=file_content
+        request_record.file_size = len(file_content)
+        request_record.file_name = file_name
+        request_record.content_type = content_type
+        request_record.watermark = watermark
+        request_record.watermark_seq = watermark_seq
+        request_record.rows_processed = tracker.rows_processed
+        request_record.phase = "done"
+        request_record.completed_at = datetime.now()
+        request_record.progress_at = request_record.completed_at
+        # Memory growth of this process during the export, or the largest worker process's peak
+        request_record.peak_memory_kb = max(
+            tracker.memory.peak_kb() or 0, patient_manager.worker_peak_memory_kb or 0
+        ) or None
+        request_record.request_status="Completed"
+        db.commit()
+        tracker.complete(file_size=len(file_content))
+        print(f"✓ Export stored in database for request {request_id}")
+    except Exception as e:
+        db.rollback()
+        print(f"✗ Export failed for request {request_id}: {str(e)}")
+        tracker.fail(e)
+    finally:
+        db.close()
+
+
+@router.post(
+    "/line-list/export",
+    summary="Request patient line list export",
+    description=(
+        "Triggers background generation of the patient line list. Returns a job id. "
+        "Pass `since` or `since_request_id` to export only rows created, updated or voided "
+        "after that point (delta export). Pass `partition_by` to build one file or sheet "
+        "per facility (datim_code) or LGA in parallel worker processes."
+    ),
+)
+def request_line_list_export(
+    background_tasks: BackgroundTasks,
+    datim_code: str | None = Query(default=None),
+    state: str | None = Query(default=None),
+    since: datetime | None = Query(default=None, description="Export only rows changed at or after this timestamp"),
+    since_request_id: str | None = Query(default=None, description="Chain from the watermark of a previous export"),
+    partition_by: Literal["datim_code", "lga"] | None = Query(default=None, description="Split the export per facility or per LGA"),
+    partition_output: Literal["zip", "sheets"] = Query(default="zip", description="Zip of per-partition files or one workbook with a sheet per partition"),
+    export_format: Literal["xlsx", "csv", "csv.gz", "parquet"] = Query(default="xlsx", alias="format", description="Output file format"),
+    idempotency_key: str | None = Header(default=None, description="Retries with the same key return the original request id"),
+    db: Session = Depends(db_manager.get_db),
+):
+    patient_manager = PatientARTCRUD(db_manager=db)
+    fingerprint = _request_fingerprint(
+        datim_code, state, since, since_request_id, partition_by, partition_output, export_format
+    )
+    replay = _begin_idempotent(patient_manager, idempotency_key, "line-list/export", fingerprint)
+    if replay is not None:
+        return replay
+    try:
+        return _complete_idempotent(
+            patient_manager, idempotency_key, "line-list/export", status.HTTP_200_OK,
+            _start_line_list_export(
+                background_tasks, db, datim_code, state, since, since_request_id,
+                partition_by, partition_output, export_format,
+            ),
+        )
+    except Exception:
+        _release_idempotent(patient_manager, idempotency_key, "line-list/export")
+        raise
+
+
+def _start_line_list_export(
+    background_tasks: BackgroundTasks,
+    db: Session,
+    datim_code: str | None,
+    state: str | None,
+    since: datetime | None,
+    since_request_id: str | None,
+    partition_by: str | None,
+    partition_output: str,
+    export_format: str,
+) -> dict:
+    if partition_by and partition_output == "sheets" and export_format != "xlsx":
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Sheet per partition output is only available as xlsx",
+        )
+    if export_format == "parquet" and importlib.util.find_spec("pyarrow") is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Parquet export is not available, the pyarrow package is not installed",
+        )
+
+    if since and since_request_id:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Provide either since or since_request_id, not both",
+        )
+
+    since_seq = None
+    if since_request_id:
+        patient_manager = PatientARTCRUD(db_manager=db)
+        previous_request = patient_manager.get_line_list_request(since_request_id)
+        if not previous_request:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Line list request {since_request_id} not found",
+            )
+        if previous_request.request_status != "Completed" or previous_request.watermark is None:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Line list request {since_request_id} has no watermark to chain from",
+            )
+        if datim_code and previous_request.datim_code and datim_code != previous_request.datim_code:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Line list request {since_request_id} was exported for a different facility",
+            )
+        since = previous_request.watermark
+        # Exports from before change_seq chain on the timestamp
+        since_seq = previous_request.watermark_seq
+        datim_code = datim_code or previous_request.datim_code
+        state = state or previous_request.state
+
+    # Generate a job ID
+    request_id = str(uuid.uuid4())
+
+    # schedule background work
+    background_tasks.add_task(
+        _background_generate_line_list,
+        db_manager.get_session, 
+        request_id,
+        datim_code,
+        since,
+        state,
+        partition_by,
+        partition_output,
+        export_format,
+        since_seq,
+    )
+
+    new_request = LineListRequest(
+        request_id=request_id,
+        requested_by_id="SUPER USER",
+        request_date=datetime.now(),
+        request_status="Processing",
+        datim_code=datim_code,
+        since=since,
+        state=state,
+        partition_by=partition_by,
+        export_format=export_format,
+    )
+    db.add(new_request)
+    db.commit()
+
+    return {
+        "message": "Export started",
+        "request_id": request_id,
+        "export_type": "delta" if since else "full",
+        "since": since,
+        "partition_by": partition_by,
+        "format": export_format,
+    }
+
+
+@router.get(
+    "/line-list/requests/all",
+    response_model=List[LineListRequestResponse],
+    summary="Fetch all the request records for line lists generation"
+)
+def get_line_list_requests(
+    skip: int = 0,
+    limit: int = 10,
+    db: Session = Depends(db_manager.get_db),
+):
+    try:
+        patient_manager = PatientARTCRUD(db_manager=db)
+        line_list_requests = patient_manager.get_line_list_requests(skip, limit)
+
+        return line_list_requests
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Error: -> {str(e)}"
+        )
+
+
+
+@router.get(
+    "/line-list/requests/request_id",
+    response_model=LineListRequestResponse,
+    summary="Fetch the status, progress and timings of a line list export",
+)
+def get_line_list_request_status(
+    request_id: str,
+    db: Session = Depends(db_manager.get_db),
+):
+    patient_manager = PatientARTCRUD(db_manager=db)
+    request_record = patient_manager.get_line_list_request(request_id)
+    if not request_record:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Line list request {request_id} not found",
+        )
+    return patient_manager.get_line_list_request_response(request_record)
+
+
+EVENTS_KEEPALIVE_SECONDS = 15
+# Multi-worker deployments: a subscriber may not share a process with the
+# export worker, so unfinished requests are re-read from the DB this often
+EVENTS_FALLBACK_POLL_SECONDS = int(os.getenv("EXPORT_EVENTS_FALLBACK_POLL_SECONDS", 60))
+
+
+def _load_line_list_request_events(request_ids: List[str]) -> List[dict]:
+    """One status query for the subscribed requests, file blobs excluded"""
+    db: Session = db_manager.get_session()
+    try:
+        patient_manager = PatientARTCRUD(db_manager=db)
+        events = []
+        for request_record in patient_manager.get_line_list_requests_by_id(request_ids):
+            events.append({
+                "request_id": request_record.request_id,
+                "event": "status",
+                "request_status": request_record.request_status,
+                "phase": request_record.phase,
+                "rows_processed": request_record.rows_processed,
+                "file_size": request_record.file_size,
+                "error_detail": request_record.error_detail,
+            })
+        return events
+    finally:
+        db.close()
+
+
+def _format_sse(event: dict) -> str:
+    return f"event: {event['event']}\ndata: {json.dumps(event, default=str)}\n\n"
+
+
+@router.get(
+    "/line-list/events",
+    summary="Subscribe to line list export progress with Server-Sent Events",
+    description=(
+        "Streams `status`, `progress`, `completed` and `failed` events for the given "
+        "request ids. The stream closes once every subscribed export has finished."
+    ),
+)
+async def stream_line_list_events(
+    request: Request,
+    request_id: List[str] = Query(..., description="One or more export request ids"),
+):
+    request_ids = list(dict.fromkeys(request_id))
+    # Subscribe before reading the current state so no event is missed in between
+    queue = export_events.subscribe(request_ids)
+
+    async def event_stream():
+        try:
+            initial = await run_in_threadpool(_load_line_list_request_events, request_ids)
+            known = {event["request_id"] for event in initial}
+            for missing_id in [r for r in request_ids if r not in known]:
+                yield _format_sse({"request_id": missing_id, "event": "not_found"})
+
+            pending = set()
+            for event in initial:
+                # An in-process event may be newer than the row just read
+                latest = export_events.get_latest(event["request_id"])
+                if latest and latest["request_status"] in TERMINAL_STATUSES:
+                    event = {**latest, "event": "status"}
+                yield _format_sse(event)
+                if event["request_status"] not in TERMINAL_STATUSES:
+                    pending.add(event["request_id"])
+
+            last_poll = time.monotonic()
+            while pending:
+                if await request.is_disconnected():
+                    break
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=EVENTS_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    if time.monotonic() - last_poll >= EVENTS_FALLBACK_POLL_SECONDS:
+                        last_poll = time.monotonic()
+                        for event in await run_in_threadpool(_load_line_list_request_events, list(pending)):
+                            if event["request_status"] in TERMINAL_STATUSES:
+                                yield _format_sse(event)
+                                pending.discard(event["request_id"])
+                    continue
+
+                if event["request_id"] not in pending:
+                    continue
+                yield _format_sse(event)
+                if event["request_status"] in TERMINAL_STATUSES:
+                    pending.discard(event["request_id"])
+        finally:
+            export_events.unsubscribe(request_ids, queue)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get(
+    "/line-list/download/request_id",
+    summary="Download generated patient line list",
+)
+def download_line_list(request_id: str, db: Session = Depends(db_manager.get_db),):
+    request_record = db.query(LineListRequest).filter(
+        LineListRequest.request_id == request_id
+    ).first()
+
+    if not request_record:
+        raise HTTPException(status_code=404, detail=f"Line list request {request_id} not found")
+
+    if request_record.request_status == "Failed":
+        raise HTTPException(status_code=400, detail=f"Export failed -> {request_record.error_detail}")
 
     if request_record.request_status != "Completed":
         raise HTTPException(status_code=400, detail="Export not ready yet")
@@ -434,8 +1918,8 @@ def download_line_list(request_id: str, db: Session = Depends(db_manager.get_ses
 
     return StreamingResponse(
         content=file_stream,
-        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        headers={"Content-Disposition": f"attachment; filename=patient_line_list.xlsx"}
+        media_type=request_record.content_type or EXPORT_FORMATS["xlsx"][1],
+        headers={"Content-Disposition": f"attachment; filename={request_record.file_name or 'patient_line_list.xlsx'}"}
     )
 
 
@@ -445,7 +1929,7 @@ def download_line_list(request_id: str, db: Session = Depends(db_manager.get_ses
     description="Generate and download an empty Excel template for patient line list upload",
 )
 def download_line_list_template(
-    db: Session = Depends(db_manager.get_session),
+    db: Session = Depends(db_manager.get_db),
 ):
     patient_manager = PatientARTCRUD(db_manager=db)
     excel_file = patient_manager.generate_empty_line_list_template()
@@ -1,6 +1,6 @@
 from datetime import date, datetime
-from typing import Optional
-from pydantic import BaseModel
+from typing import Any, Dict, List, Literal, Optional
+from pydantic import BaseModel, model_validator
 
 class PatientARTCreate(BaseModel):
     # Required-ish identifiers
@@ -116,11 +116,42 @@ class PatientARTResponse(BaseModel):
     signature: Optional[str] = None
     comment: Optional[str] = None
     suggestion: Optional[str] = None
+    last_viral_load_value: Optional[float] = None
+    last_viral_load_parse_status: Optional[str] = None
+    cd4_test_cd4_value: Optional[float] = None
+    cd4_test_parse_status: Optional[str] = None
+    facility_id: Optional[int] = None
+    version: Optional[int] = None
     
     class Config:
         orm_mode = True
 
 
+class PatientChangeLogResponse(BaseModel):
+    patient_identifier: str
+    change_type: str
+    # field -> [old, new]
+    changes: Dict[str, List[Any]]
+    changed_by: Optional[str] = None
+    changed_at: str
+
+
+class PatientARTAsOfResponse(PatientARTResponse):
+    voided: Optional[int] = None
+    voided_by: Optional[str] = None
+    voided_date: Optional[datetime] = None
+    as_of: str
+
+
+class PatientChangeFeedResponse(BaseModel):
+    # Stored patient rows with a change_type of created, updated or voided, and
+    # deleted entries (id, patient_identifier, datim_code, version, change_seq, deleted_at)
+    changes: List[Dict[str, Any]]
+    # Pass back as cursor to continue after the last change
+    next_cursor: str
+    has_more: bool
+
+
 class PatientARTUpdate(BaseModel):
     # all fields optional for partial update
     state: Optional[str] = None
@@ -163,11 +194,314 @@ class PatientARTUpdate(BaseModel):
 
 
 
+class PatientBulkUpdateItem(BaseModel):
+    patient_identifier: str
+    changes: PatientARTUpdate
+
+    class Config:
+        extra = "forbid"
+        json_schema_extra = {
+            "example": {
+                "patient_identifier": "PAT-0001-ABIA-2025",
+                "changes": {
+                    "last_drug_pick_up_date": "2025-02-10",
+                    "no_of_days_of_refills": 90,
+                    "last_viral_load_result": "Undetectable",
+                    "last_viral_load_result_date": "2025-02-01"
+                }
+            }
+        }
+
+
+class PatientBulkUpdateResult(BaseModel):
+    patient_identifier: str
+    status: str
+    detail: Optional[str] = None
+
+
+class PatientBulkUpdateResponse(BaseModel):
+    message: str
+    total_updated: int
+    results: List[PatientBulkUpdateResult]
+
+
+class PatientBulkFilter(BaseModel):
+    datim_code: Optional[str] = None
+    patient_identifiers: Optional[List[str]] = None
+    created_from: Optional[datetime] = None
+    created_to: Optional[datetime] = None
+
+    @model_validator(mode="after")
+    def require_a_filter(self):
+        if not (self.datim_code or self.patient_identifiers or self.created_from or self.created_to):
+            raise ValueError("Provide at least one of datim_code, patient_identifiers, created_from or created_to")
+        return self
+
+    class Config:
+        extra = "forbid"
+        json_schema_extra = {
+            "example": {
+                "datim_code": "NBpPdHsoZge",
+                "created_from": "2025-01-10T00:00:00",
+                "created_to": "2025-01-11T00:00:00"
+            }
+        }
+
+
 class LineListRequestResponse(BaseModel):
     request_id: str
     requested_by: str
     request_date: str
     request_status: str
+    datim_code: Optional[str] = None
+    since: Optional[str] = None
+    watermark: Optional[str] = None
+    export_format: Optional[str] = None
+
+    # Progress and timings
+    phase: Optional[str] = None
+    rows_processed: Optional[int] = None
+    started_at: Optional[str] = None
+    completed_at: Optional[str] = None
+    progress_at: Optional[str] = None
+    duration_seconds: Optional[float] = None
+    peak_memory_kb: Optional[int] = None
+    file_size: Optional[int] = None
+    error_detail: Optional[str] = None
 
     class Config:
-        from_attributes = True
\ No newline at end of file
+        from_attributes = True
+
+
+class BackgroundJobResponse(BaseModel):
+    job_id: str
+    job_type: str
+    requested_by: Optional[str] = None
+    job_status: str
+    phase: Optional[str] = None
+    parameters: Optional[Dict[str, Any]] = None
+    rows_processed: Optional[int] = None
+    total_rows: Optional[int] = None
+    result: Optional[Dict[str, Any]] = None
+    error_detail: Optional[str] = None
+    created_at: Optional[str] = None
+    started_at: Optional[str] = None
+    completed_at: Optional[str] = None
+    progress_at: Optional[str] = None
+    duration_seconds: Optional[float] = None
+
+
+class RetentionSummaryResponse(BaseModel):
+    # ART statuses in the summary are as of this date, None before the first rebuild
+    status_date: Optional[date] = None
+    total: int
+    # Requested dimensions plus patient_count (and facility_name_all when grouped by datim_code)
+    rows: List[Dict[str, Any]]
+
+
+class ArtStatusTrendResponse(BaseModel):
+    # Snapshot dates included, one per day or the first of each month
+    dates: List[date]
+    # snapshot_date, requested dimensions and patient_count
+    rows: List[Dict[str, Any]]
+
+
+class ArtStatusTransitionCount(BaseModel):
+    snapshot_date: date
+    # None for patients seen for the first time
+    from_status: Optional[str] = None
+    # "Removed" for patients voided or deleted since the previous snapshot
+    to_status: str
+    patient_count: int
+
+
+class RetentionCohortMilestone(BaseModel):
+    months: int
+    # Patients whose milestone date is on or before as_of
+    eligible: int
+    active: int
+    retention_rate: Optional[float] = None
+
+
+class RetentionCohort(BaseModel):
+    # ART start month "2024-01" or quarter "2024Q1"
+    cohort: str
+    patients: int
+    # Active as of the reference date
+    active: int
+    retention_rate: Optional[float] = None
+    milestones: List[RetentionCohortMilestone]
+
+
+class RetentionCohortResponse(BaseModel):
+    as_of: date
+    period: str
+    milestone_months: List[int]
+    cohorts: List[RetentionCohort]
+
+
+class ViralLoadSuppressionRow(BaseModel):
+    datim_code: Optional[str] = None
+    facility_name_all: Optional[str] = None
+    patients: int
+    # Last result below the threshold, including undetectable and "<n" results
+    suppressed: int
+    unsuppressed: int
+    # No result, or a result that could not be parsed
+    missing: int
+    unparsed: int
+    # On ART long enough to need a result, and none within the overdue window
+    overdue: int
+    # suppressed / (suppressed + unsuppressed)
+    suppression_rate: Optional[float] = None
+
+
+class ViralLoadSuppressionResponse(BaseModel):
+    as_of: date
+    threshold: float
+    facilities: List[ViralLoadSuppressionRow]
+
+
+class DuplicateClusterMemberResponse(BaseModel):
+    patient_id: int
+    patient_identifier: str
+    datim_code: Optional[str] = None
+    # Best match score of this record with another member
+    score: float
+    facility_name_all: Optional[str] = None
+    hospital_number: Optional[str] = None
+    sex: Optional[str] = None
+    date_of_birth: Optional[date] = None
+    art_start_date: Optional[date] = None
+    last_drug_pick_up_date: Optional[date] = None
+    # True once the record was voided (or deleted) after detection
+    voided: bool
+
+
+class DuplicateClusterResponse(BaseModel):
+    id: int
+    status: str
+    member_count: int
+    max_score: float
+    created_at: Optional[datetime] = None
+    reviewed_by: Optional[str] = None
+    reviewed_at: Optional[datetime] = None
+    review_note: Optional[str] = None
+    members: List[DuplicateClusterMemberResponse]
+
+
+class DuplicateClusterReview(BaseModel):
+    status: Literal["pending", "confirmed", "not_duplicate"]
+    reviewed_by: str
+    note: Optional[str] = None
+
+    class Config:
+        extra = "forbid"
+        json_schema_extra = {
+            "example": {
+                "status": "confirmed",
+                "reviewed_by": "data.officer@example.org",
+                "note": "Transferred from Aba General Hospital, re-registered",
+            }
+        }
+
+
+class DataQualityRuleCount(BaseModel):
+    rule: str
+    description: str
+    violations: int
+
+
+class DataQualityFacility(BaseModel):
+    datim_code: str
+    patients_checked: int
+    # rule -> count, rules without violations left out
+    violations: Dict[str, int]
+    # rule -> up to 10 patient identifiers
+    sample_identifiers: Dict[str, List[str]]
+
+
+class DataQualityReportResponse(BaseModel):
+    job_id: str
+    scanned_at: Optional[datetime] = None
+    parameters: Optional[Dict[str, Any]] = None
+    rules: List[DataQualityRuleCount]
+    facilities: List[DataQualityFacility]
+
+
+class FacilityBase(BaseModel):
+    datim_code: str
+    facility_name: Optional[str] = None
+    state: Optional[str] = None
+    lga: Optional[str] = None
+
+    class Config:
+        extra = "forbid"
+        json_schema_extra = {
+            "example": {
+                "datim_code": "NBpPdHsoZge",
+                "facility_name": "Aba General Hospital",
+                "state": "Abia",
+                "lga": "Aba South",
+            }
+        }
+
+
+class FacilityResponse(FacilityBase):
+    id: int
+
+
+class PatientSearchResult(BaseModel):
+    # Higher is better: exact identifier 100, exact hospital number 90,
+    # identifier prefix 70, hospital number prefix 60, address 20+
+    search_rank: float
+    matched_on: Optional[str] = None
+    patient: PatientARTResponse
+
+
+class PatientSyncEdit(BaseModel):
+    patient_identifier: str
+    # Version the device edited, None for a patient registered offline
+    base_version: Optional[int] = None
+    changes: PatientARTUpdate
+
+    class Config:
+        extra = "forbid"
+
+
+class PatientSyncUpload(BaseModel):
+    device_id: Optional[str] = None
+    edits: List[PatientSyncEdit]
+
+    class Config:
+        extra = "forbid"
+        json_schema_extra = {
+            "example": {
+                "device_id": "tablet-07",
+                "edits": [
+                    {
+                        "patient_identifier": "PAT-0001-ABIA-2025",
+                        "base_version": 3,
+                        "changes": {"last_drug_pick_up_date": "2025-02-10", "no_of_days_of_refills": 90},
+                    }
+                ],
+            }
+        }
+
+
+class PatientSyncEditResult(BaseModel):
+    patient_identifier: str
+    # applied, created, conflict, not_found, wrong_facility, rejected or no_changes
+    status: str
+    # Server version after the edit, or the conflicting server version
+    version: Optional[int] = None
+    detail: Optional[str] = None
+    # On conflict: current server values of the edited fields
+    server_values: Optional[Dict[str, Any]] = None
+
+
+class PatientSyncUploadResponse(BaseModel):
+    applied: int
+    created: int
+    conflicts: int
+    results: List[PatientSyncEditResult]
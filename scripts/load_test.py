@@ -0,0 +1,95 @@
+"""
+Load test for the patient read endpoints.
+Simulates many tablet clients each issuing requests back to back and reports
+sustained requests per second and latency percentiles.
+
+Usage (against a running server):
+    python scripts/load_test.py --base-url http://localhost:8005 --clients 500 --duration 60 \
+        --path "/app/v1/patient_data/patient_identifier?patient_identifier=PID789012" \
+        --path "/app/v1/patient_data/facility/datim_code?datim_code=DATIM001&limit=50"
+
+To compare with the sync read routes served before the async engine, run the
+commit before it from a second worktree on another port, with the same
+DATABASE_URL and worker count, and load test both:
+    git worktree add ../baseline "$(git log --format=%H -1 --grep='^\[user-041\] Serve patient reads')^"
+    (cd ../baseline && uvicorn app.main:app --port 8006 --workers 4)
+    uvicorn app.main:app --port 8005 --workers 4
+"""
+
+import argparse
+import asyncio
+import itertools
+import time
+from typing import Dict, List
+
+import httpx
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+async def run_client(client: httpx.AsyncClient, paths, deadline: float, latencies: List[float], statuses: Dict[int, int]):
+    for path in paths:
+        if time.monotonic() >= deadline:
+            return
+        start = time.perf_counter()
+        try:
+            response = await client.get(path)
+            status_code = response.status_code
+        except httpx.HTTPError:
+            status_code = 0
+        latencies.append(time.perf_counter() - start)
+        statuses[status_code] = statuses.get(status_code, 0) + 1
+
+
+async def run_load_test(base_url: str, paths: List[str], clients: int, duration: float, timeout: float) -> Dict:
+    latencies: List[float] = []
+    statuses: Dict[int, int] = {}
+    limits = httpx.Limits(max_connections=clients, max_keepalive_connections=clients)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=timeout) as client:
+        started = time.monotonic()
+        deadline = started + duration
+        await asyncio.gather(*[
+            # Each client cycles through the paths from a different offset
+            run_client(client, itertools.islice(itertools.cycle(paths), i % len(paths), None),
+                       deadline, latencies, statuses)
+            for i in range(clients)
+        ])
+        elapsed = time.monotonic() - started
+
+    return {
+        "clients": clients,
+        "duration_seconds": round(elapsed, 1),
+        "requests": len(latencies),
+        "requests_per_second": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        "max_ms": round(max(latencies, default=0) * 1000, 1),
+        "status_codes": statuses,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the patient read endpoints")
+    parser.add_argument("--base-url", default="http://localhost:8005")
+    parser.add_argument("--path", action="append", dest="paths",
+                        help="Request path, repeat for several (default: list endpoint)")
+    parser.add_argument("--clients", type=int, default=500, help="Concurrent clients")
+    parser.add_argument("--duration", type=float, default=60, help="Seconds to run")
+    parser.add_argument("--timeout", type=float, default=30, help="Per-request timeout in seconds")
+    args = parser.parse_args()
+
+    paths = args.paths or ["/app/v1/patient_data/?limit=50"]
+    result = asyncio.run(run_load_test(args.base_url, paths, args.clients, args.duration, args.timeout))
+    for key, value in result.items():
+        print(f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    main()
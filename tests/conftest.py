@@ -0,0 +1,72 @@
+"""
+Shared fixtures for the API tests.
+
+Tests run against TEST_DATABASE_URL when set (a scratch database, its tables
+are dropped afterwards), otherwise against a SQLite file in WAL mode:
+    python -m pytest tests
+"""
+import os
+
+# routes builds its DatabaseManager at import time
+os.environ.setdefault("DATABASE_URL", "sqlite:///unused.db")
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, event, insert
+from sqlalchemy.orm import sessionmaker
+
+from app.audit import change_log
+from app.db_models import Base, ChangeSequence, CHANGE_SEQUENCES
+from app.main import app
+from app.routes import db_manager
+
+
+# Enough connections for the concurrency tests' parallel requests
+POOL_SIZE = 8
+
+
+@pytest.fixture
+def engine(tmp_path):
+    database_url = os.getenv("TEST_DATABASE_URL")
+    if database_url:
+        engine = create_engine(database_url, future=True, pool_size=POOL_SIZE)
+    else:
+        engine = create_engine(
+            f"sqlite:///{tmp_path / 'test.db'}",
+            future=True,
+            pool_size=POOL_SIZE,
+            connect_args={"timeout": 30, "check_same_thread": False},
+        )
+
+        @event.listens_for(engine, "connect")
+        def _wal(dbapi_connection, _):
+            dbapi_connection.execute("PRAGMA journal_mode=WAL")
+
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(insert(ChangeSequence), [{"name": name, "value": 0} for name in CHANGE_SEQUENCES])
+    yield engine
+    change_log.flush()
+    # The writer binds the first engine it is given, let the next test's engine bind
+    change_log._engine = None
+    Base.metadata.drop_all(engine)
+    engine.dispose()
+
+
+@pytest.fixture
+def client(engine):
+    session_factory = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+
+    def get_db():
+        session = session_factory()
+        try:
+            yield session
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    app.dependency_overrides[db_manager.get_db] = get_db
+    yield TestClient(app)
+    app.dependency_overrides.pop(db_manager.get_db, None)
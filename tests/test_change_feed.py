@@ -0,0 +1,68 @@
+"""
+Change feed paging: following next_cursor batch after batch must return every
+change exactly once in commit order, including several rows stamped with one
+change_seq by a bulk update and split across batches.
+"""
+import pytest
+from sqlalchemy.orm import Session
+
+from app.repo import PatientARTCRUD
+
+
+URL = "/app/v1/patient_data"
+
+
+def create_patients(client, identifiers):
+    for identifier in identifiers:
+        response = client.post(f"{URL}/single", json={
+            "facility_name_all": "General Hospital Aba",
+            "datim_code": "NBpPdHsoZge",
+            "patient_identifier": identifier,
+        })
+        assert response.status_code == 201
+
+
+def read_feed(engine, cursor=None, limit=2):
+    """All changes after cursor, limit per batch, and the cursor to resume from"""
+    changes = []
+    with Session(engine) as session:
+        patient_manager = PatientARTCRUD(db_manager=session)
+        while True:
+            feed = patient_manager.get_patient_changes(cursor=cursor, limit=limit)
+            changes += feed["changes"]
+            cursor = feed["next_cursor"]
+            if not feed["has_more"]:
+                return changes, cursor
+
+
+def test_cursor_pages_through_every_change_once(client, engine):
+    create_patients(client, ["P1", "P2", "P3", "P4", "P5"])
+    changes, cursor = read_feed(engine)
+    assert [c["patient_identifier"] for c in changes] == ["P1", "P2", "P3", "P4", "P5"]
+    assert {c["change_type"] for c in changes} == {"created"}
+
+    # One transaction, one change_seq for three rows, read two per batch
+    response = client.patch(f"{URL}/bulk", json=[
+        {"patient_identifier": identifier, "changes": {"comment": "bulk"}}
+        for identifier in ("P4", "P2", "P5")
+    ])
+    assert response.status_code == 200
+    client.delete(f"{URL}/patient_identifier", params={"patient_identifier": "P1"})
+
+    changes, cursor = read_feed(engine, cursor)
+    assert [(c["patient_identifier"], c["change_type"]) for c in changes] == [
+        ("P2", "updated"), ("P4", "updated"), ("P5", "updated"), ("P1", "voided"),
+    ]
+    assert len({c["change_seq"] for c in changes[:3]}) == 1
+    assert [c["change_seq"] for c in changes] == sorted(c["change_seq"] for c in changes)
+
+    # Caught up: nothing new until the next write
+    assert read_feed(engine, cursor) == ([], cursor)
+    client.put(f"{URL}/patient_identifier", params={"patient_identifier": "P3"}, json={"comment": "later"})
+    changes, _ = read_feed(engine, cursor)
+    assert [(c["patient_identifier"], c["comment"]) for c in changes] == [("P3", "later")]
+
+
+def test_invalid_cursor_is_rejected(engine):
+    with Session(engine) as session, pytest.raises(ValueError):
+        PatientARTCRUD(db_manager=session).get_patient_changes(cursor="not-a-cursor")
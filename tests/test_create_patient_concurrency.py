@@ -0,0 +1,52 @@
+"""
+Concurrent creates of one patient_identifier through POST /single.
+Exactly one request may win, the others must get a 409 and only one row
+may be stored.
+
+Uses the engine and client fixtures from conftest.py.
+"""
+import threading
+
+from sqlalchemy import func, select
+
+from app.db_models import PatientARTData
+
+
+CONCURRENT_REQUESTS = 8
+PATIENT = {
+    "state": "Abia",
+    "lga": "Aba North",
+    "facility_name_all": "General Hospital Aba",
+    "datim_code": "NBpPdHsoZge",
+    "sex": "F",
+    "hospital_number": "HN-0001",
+    "patient_identifier": "PAT-RACE-0001",
+    "current_age": 34,
+}
+
+
+def test_concurrent_creates_store_one_patient(client, engine):
+    barrier = threading.Barrier(CONCURRENT_REQUESTS)
+    statuses = []
+    lock = threading.Lock()
+
+    def post():
+        barrier.wait()
+        response = client.post("/app/v1/patient_data/single", json=PATIENT)
+        with lock:
+            statuses.append(response.status_code)
+
+    threads = [threading.Thread(target=post) for _ in range(CONCURRENT_REQUESTS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(statuses) == [201] + [409] * (CONCURRENT_REQUESTS - 1)
+    with engine.connect() as connection:
+        stored = connection.execute(
+            select(func.count())
+            .select_from(PatientARTData)
+            .where(PatientARTData.patient_identifier == PATIENT["patient_identifier"])
+        ).scalar_one()
+    assert stored == 1
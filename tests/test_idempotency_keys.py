@@ -0,0 +1,80 @@
+"""
+Idempotency-Key on POST /single: a retry replays the stored response without
+creating the patient again, a key reused for a different request is
+rejected, and a key left in progress by a dead worker can be reclaimed once
+its lease runs out.
+"""
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, insert, select
+
+from app.db_models import IdempotencyKey, PatientARTData
+from app.repo import IDEMPOTENCY_IN_PROGRESS_LEASE_MINUTES
+from app.routes import _request_fingerprint
+from app.schemas import PatientARTCreate
+
+
+URL = "/app/v1/patient_data/single"
+PATIENT = {
+    "facility_name_all": "General Hospital Aba",
+    "datim_code": "NBpPdHsoZge",
+    "patient_identifier": "PAT-KEY-0001",
+}
+
+
+def stored_count(engine):
+    with engine.connect() as connection:
+        return connection.execute(select(func.count()).select_from(PatientARTData)).scalar_one()
+
+
+def test_retry_replays_the_original_response(client, engine):
+    headers = {"Idempotency-Key": "retry-1"}
+    first = client.post(URL, json=PATIENT, headers=headers)
+    retry = client.post(URL, json=PATIENT, headers=headers)
+
+    assert first.status_code == retry.status_code == 201
+    assert retry.json() == first.json()
+    assert "idempotent-replayed" not in first.headers
+    assert retry.headers["idempotent-replayed"] == "true"
+    assert stored_count(engine) == 1
+
+
+def test_key_reused_for_another_request_is_rejected(client, engine):
+    headers = {"Idempotency-Key": "reused-1"}
+    assert client.post(URL, json=PATIENT, headers=headers).status_code == 201
+    other = client.post(URL, json={**PATIENT, "patient_identifier": "PAT-KEY-0002"}, headers=headers)
+
+    assert other.status_code == 422
+    assert stored_count(engine) == 1
+
+
+def test_failed_request_releases_its_key(client, engine):
+    assert client.post(URL, json=PATIENT).status_code == 201
+    headers = {"Idempotency-Key": "failed-1"}
+    # Duplicate identifier, the key must not keep the 409
+    assert client.post(URL, json=PATIENT, headers=headers).status_code == 409
+    retry = client.post(URL, json={**PATIENT, "patient_identifier": "PAT-KEY-0002"}, headers=headers)
+
+    assert retry.status_code == 201
+    assert stored_count(engine) == 2
+
+
+def test_abandoned_in_progress_key_is_reclaimed_after_its_lease(client, engine):
+    now = datetime.now()
+    fingerprint = _request_fingerprint(PatientARTCreate(**PATIENT).model_dump_json())
+    with engine.begin() as connection:
+        connection.execute(insert(IdempotencyKey), [
+            {"idempotency_key": key, "route": "single", "fingerprint": fingerprint,
+             "state": "in_progress", "created_at": created_at, "expires_at": now + timedelta(hours=1)}
+            for key, created_at in (
+                ("abandoned-1", now - timedelta(minutes=IDEMPOTENCY_IN_PROGRESS_LEASE_MINUTES + 1)),
+                ("running-1", now),
+            )
+        ])
+
+    reclaimed = client.post(URL, json=PATIENT, headers={"Idempotency-Key": "abandoned-1"})
+    running = client.post(URL, json=PATIENT, headers={"Idempotency-Key": "running-1"})
+
+    assert reclaimed.status_code == 201
+    assert running.status_code == 409
+    assert stored_count(engine) == 1
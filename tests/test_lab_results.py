@@ -0,0 +1,43 @@
+"""
+parse_lab_result: only a whole, unambiguous number (with an optional limit
+sign and unit) is numeric, anything else is unparsed rather than guessed
+"""
+import pytest
+
+from app.repo import parse_lab_result
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("550", (550.0, "numeric")),
+    ("1,200 copies/ml", (1200.0, "numeric")),
+    ("1,200.5", (1200.5, "numeric")),
+    ("1 200", (1200.0, "numeric")),
+    ("1.200.000", (1200000.0, "numeric")),
+    ("1.200,5", (1200.5, "numeric")),
+    ("1,5", (1.5, "numeric")),
+    ("4.52", (4.52, "numeric")),
+    ("1.2e3", (1200.0, "numeric")),
+    ("1.2 x 10^3", (1200.0, "numeric")),
+    ("450 cells/mm3", (450.0, "numeric")),
+    ("<20 cp/ml", (20.0, "below_limit")),
+    (">10000000", (10000000.0, "above_limit")),
+    ("Undetectable", (0.0, "undetectable")),
+    ("  ", (None, "missing")),
+    (None, (None, "missing")),
+])
+def test_parsed(value, expected):
+    assert parse_lab_result(value) == expected
+
+
+@pytest.mark.parametrize("value", [
+    # 1.2 or 1200 copies
+    "1.200",
+    ">10,000000",
+    "1,2,3",
+    "1 2",
+    "12abc",
+    "20 copies/ml repeat",
+    "pending",
+])
+def test_unparsed(value):
+    assert parse_lab_result(value) == (None, "unparsed")
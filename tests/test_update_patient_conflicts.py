@@ -0,0 +1,77 @@
+"""
+Optimistic concurrency on PUT /patient_identifier: an update made with an
+If-Match ETag of an older version must get a 409 and leave the stored record
+as the winning write left it.
+"""
+import threading
+
+from sqlalchemy import select
+
+from app.db_models import PatientARTData
+
+
+PATIENT = {
+    "state": "Abia",
+    "lga": "Aba North",
+    "facility_name_all": "General Hospital Aba",
+    "datim_code": "NBpPdHsoZge",
+    "sex": "M",
+    "hospital_number": "HN-0002",
+    "patient_identifier": "PAT-EDIT-0001",
+    "current_age": 41,
+}
+URL = "/app/v1/patient_data/patient_identifier"
+PARAMS = {"patient_identifier": PATIENT["patient_identifier"]}
+CONCURRENT_REQUESTS = 8
+
+
+def stored(engine):
+    with engine.connect() as connection:
+        return connection.execute(
+            select(PatientARTData.comment, PatientARTData.version)
+            .where(PatientARTData.patient_identifier == PATIENT["patient_identifier"])
+        ).one()
+
+
+def test_stale_if_match_is_rejected(client, engine):
+    assert client.post("/app/v1/patient_data/single", json=PATIENT).status_code == 201
+    first = client.put(URL, params=PARAMS, json={"comment": "clerk A"})
+    assert first.status_code == 200
+    etag = first.headers["etag"]
+
+    second = client.put(URL, params=PARAMS, json={"comment": "clerk B"}, headers={"If-Match": etag})
+    assert second.status_code == 200
+    stale = client.put(URL, params=PARAMS, json={"comment": "clerk C"}, headers={"If-Match": etag})
+
+    assert stale.status_code == 409
+    assert tuple(stored(engine)) == ("clerk B", 3)
+
+
+def test_concurrent_updates_with_one_etag_apply_once(client, engine):
+    created = client.post("/app/v1/patient_data/single", json=PATIENT)
+    assert created.status_code == 201
+    etag = client.put(URL, params=PARAMS, json={"comment": "base"}).headers["etag"]
+    barrier = threading.Barrier(CONCURRENT_REQUESTS)
+    statuses = []
+    lock = threading.Lock()
+
+    def put(i):
+        barrier.wait()
+        response = client.put(URL, params=PARAMS, json={"comment": f"clerk {i}"}, headers={"If-Match": etag})
+        with lock:
+            statuses.append(response.status_code)
+
+    threads = [threading.Thread(target=put, args=(i,)) for i in range(CONCURRENT_REQUESTS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(statuses) == [200] + [409] * (CONCURRENT_REQUESTS - 1)
+    assert stored(engine).version == 3
+
+
+def test_invalid_if_match_is_rejected(client):
+    assert client.post("/app/v1/patient_data/single", json=PATIENT).status_code == 201
+    response = client.put(URL, params=PARAMS, json={"comment": "x"}, headers={"If-Match": "not-an-etag"})
+    assert response.status_code == 400